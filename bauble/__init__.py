@@ -335,6 +335,10 @@ def main(uri=None):
     # initialize threading
     gobject.threads_init()
 
+    # memoize the partial parses of the search strings
+    import bauble.search as search
+    search.enable_packrat()
+
     try:
         import bauble.db as db
     except Exception, e:
@@ -433,6 +437,13 @@ def main(uri=None):
                                                      gtk.MESSAGE_ERROR)
                         logger.error("%s(%s)" % (type(e), e))
             else:
+                if db.needs_upgrade():
+                    msg = _('The database at the current connection was '
+                            'created by a previous version of Bauble and '
+                            'its schema needs to be upgraded.\n\n'
+                            '<i>Would you like to upgrade it now?</i>')
+                    if utils.yes_no_dialog(msg):
+                        pluginmgr.upgrade()
                 pluginmgr.init()
         except Exception, e:
             logger.warning("%s\n%s(%s)"
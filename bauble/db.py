@@ -26,11 +26,21 @@ from sqlalchemy.orm import class_mapper
 
 import datetime
 import os
+import threading
 import bauble.error as error
 from bauble.i18n import _
 
 SQLALCHEMY_DEBUG = False
 
+## the version of the schema the mappers expect, stored in the bauble
+## meta table under meta.SCHEMA_KEY.  bump it with each change that
+## needs an upgrade of the existing databases: new columns or indexes,
+## or data the plugins have to migrate in their upgrade().
+##
+## 1: tagged_class, _sort_key and _distribution_str
+## 2: _sort_key chunks joined by u'\x01', "C" collation on PostgreSQL
+SCHEMA_VERSION = 2
+
 try:
     import sqlalchemy as sa
     parts = tuple(int(i) for i in sa.__version__.split('.')[:2])
@@ -80,11 +90,50 @@ def natsort(attr, obj):
     partial(natsort, 'accessions')(species)
     partial(natsort, 'species.accessions')(vern_name)
     """
-    from bauble import utils
     jumps = attr.split('.')
     for attr in jumps:
         obj = getattr(obj, attr)
-    return sorted(obj, key=utils.natsort_key)
+    return sorted(obj, key=sort_key)
+
+
+def _history_user():
+    """
+    Return the name of the user to record in the history table.
+    """
+    user = None
+    from bauble import db
+    try:
+        if db.engine.name in ('postgres', 'postgresql'):
+            import bauble.plugins.users as users
+            user = users.current_user()
+    except:
+        if 'USER' in os.environ and os.environ['USER']:
+            user = os.environ['USER']
+        elif 'USERNAME' in os.environ and os.environ['USERNAME']:
+            user = os.environ['USERNAME']
+    return user
+
+
+def add_history(session, table, operation, rows):
+    """
+    Record the operation on rows of table in the history table, with
+    one executemany INSERT, as HistoryExtension does for the objects
+    flushed by the mappers.
+
+    meant for the statements bypassing the mappers, session can be a
+    connection as well, the rows are dictionaries of the column values,
+    holding at least the id.
+    """
+    if not rows:
+        return
+    user = _history_user()
+    timestamp = datetime.datetime.today()
+    session.execute(History.__table__.insert(), [
+        dict(table_name=table.name, table_id=row['id'],
+             values=str(dict((key, utils.utf8(value))
+                             for key, value in row.items())),
+             operation=operation, user=user, timestamp=timestamp)
+        for row in rows])
 
 
 class HistoryExtension(orm.MapperExtension):
@@ -99,18 +148,7 @@ class HistoryExtension(orm.MapperExtension):
         """
         Add a new entry to the history table.
         """
-        user = None
-        from bauble import db
-        try:
-            if db.engine.name in ('postgres', 'postgresql'):
-                import bauble.plugins.users as users
-                user = users.current_user()
-        except:
-            if 'USER' in os.environ and os.environ['USER']:
-                user = os.environ['USER']
-            elif 'USERNAME' in os.environ and os.environ['USERNAME']:
-                user = os.environ['USERNAME']
-
+        user = _history_user()
         row = {}
         for c in mapper.local_table.c:
             row[c.name] = utils.utf8(getattr(instance, c.name))
@@ -130,6 +168,236 @@ class HistoryExtension(orm.MapperExtension):
         self._add('delete', mapper, instance)
 
 
+class SortKeyExtension(orm.MapperExtension):
+    """
+    SortKeyExtension is a
+    :class:`~sqlalchemy.orm.interfaces.MapperExtension` that is added
+    to all classes that inherit from bauble.db.Base, it keeps the
+    `_sort_key` column of the :class:`NaturalSortKey` classes up to
+    date.
+    """
+    def _update(self, instance):
+        """
+        Set the sort key of instance, return True if it changed.
+        """
+        if not isinstance(instance, NaturalSortKey):
+            return False
+        key = instance.compute_sort_key()
+        changed = key != instance._sort_key
+        instance._sort_key = key
+        return changed
+
+    def before_insert(self, mapper, connection, instance):
+        self._update(instance)
+
+    def before_update(self, mapper, connection, instance):
+        # after_update needs to know, the key is no longer in the
+        # history by then
+        instance._sort_key_changed = self._update(instance)
+
+    def after_update(self, mapper, connection, instance):
+        """
+        The string of some objects depends on their parent, like the
+        plant code includes the accession code, update the dependents
+        listed in sort_key_dependents.
+
+        the dependents are only loaded if the sort key of instance
+        changed, their new keys are written by one executemany UPDATE
+        per relation.
+        """
+        if not getattr(instance, '_sort_key_changed', False):
+            return
+        instance._sort_key_changed = False
+        for attr in getattr(instance, 'sort_key_dependents', []):
+            changed = []
+            for dependent in getattr(instance, attr):
+                key = dependent.compute_sort_key()
+                if key != dependent._sort_key:
+                    changed.append((dependent, key))
+            if not changed:
+                continue
+            table = changed[0][0].__table__
+            connection.execute(
+                table.update().
+                where(table.c.id == sa.bindparam('b_id')).
+                values(_sort_key=sa.bindparam('b_key')),
+                [{'b_id': dependent.id, 'b_key': key}
+                 for dependent, key in changed])
+            # the incremental CSV exports find the changed rows there
+            add_history(connection, table, 'update',
+                        [{'id': dependent.id, '_sort_key': key}
+                         for dependent, key in changed])
+            for dependent, key in changed:
+                orm.attributes.set_committed_value(
+                    dependent, '_sort_key', key)
+
+
+class StatisticsExtension(orm.MapperExtension):
+    """
+    StatisticsExtension is a
+    :class:`~sqlalchemy.orm.interfaces.MapperExtension` that is added
+    to all classes that inherit from bauble.db.Base, it drops the
+    values in :data:`statistics` that depend on the table of the
+    inserted, updated or deleted objects.
+    """
+    def after_update(self, mapper, connection, instance):
+        statistics.invalidate(mapper.local_table.name)
+
+    def after_insert(self, mapper, connection, instance):
+        statistics.invalidate(mapper.local_table.name)
+
+    def after_delete(self, mapper, connection, instance):
+        statistics.invalidate(mapper.local_table.name)
+
+
+class NaturalSortKey(object):
+    """
+    NaturalSortKey is a mixin for the mapped classes whose objects are
+    presented in natural order of their string.
+
+    It adds the indexed `_sort_key` column, holding the result of
+    :func:`bauble.utils.natsort_string` on the object's string, so
+    that the database can order the objects.  The column is maintained
+    by :class:`SortKeyExtension`, and compared by code point, see
+    :func:`collate_sort_keys`.
+    """
+    _sort_key = sa.Column('_sort_key', sa.Unicode(256), index=True)
+
+    ## names of the relations holding the objects whose string depends
+    ## on the string of this object
+    sort_key_dependents = []
+
+    def compute_sort_key(self):
+        return utils.natsort_string(utils.to_unicode(str(self)))[:256]
+
+    @classmethod
+    def update_sort_keys(cls, session, only_missing=False):
+        """
+        Recompute the sort key of the rows in the table of cls, only
+        of those without one if only_missing.
+
+        the values are written with one executemany UPDATE, bypassing
+        the mapper extensions, so the history is not involved.
+        """
+        table = cls.__table__
+        query = session.query(cls)
+        if only_missing:
+            query = query.filter(cls._sort_key == None)
+        values = [{'b_id': obj.id, 'b_key': obj.compute_sort_key()}
+                  for obj in query]
+        if values:
+            session.execute(table.update().
+                            where(table.c.id == sa.bindparam('b_id')).
+                            values(_sort_key=sa.bindparam('b_key')),
+                            values)
+        return len(values)
+
+
+def sort_key(obj):
+    """
+    Return the natural sort key of obj, as stored in the database if
+    obj is a :class:`NaturalSortKey`.
+
+    use like: sorted(some_list, key=db.sort_key)
+    """
+    if isinstance(obj, NaturalSortKey):
+        return obj._sort_key or obj.compute_sort_key()
+    return utils.natsort_key(obj)
+
+
+def update_sort_keys(tables=None, only_missing=True):
+    """
+    Fill the sort keys of the :class:`NaturalSortKey` classes mapped
+    to tables, or of all of them if tables is None.
+    """
+    session = Session()
+    try:
+        for cls in Base._decl_class_registry.values():
+            if not isinstance(cls, type) or \
+                    not issubclass(cls, NaturalSortKey):
+                continue
+            if tables is not None and cls.__table__ not in tables:
+                continue
+            n = cls.update_sort_keys(session, only_missing)
+            logger.debug('updated %s sort keys of %s' % (n, cls.__name__))
+        session.commit()
+    finally:
+        session.close()
+
+
+class Statistics(object):
+    """
+    A cache of aggregate values about the objects in the database, like
+    the number of plants of a family, so that the infoboxes don't query
+    them every time the selection changes.
+
+    a statistic is registered with :meth:`register` under a name,
+    together with the tables it depends on, its values are computed on
+    demand, one per object id, and dropped by :class:`StatisticsExtension`
+    when a row of one of those tables changes through the mappers.
+    changes that bypass the mappers, like an import, must call
+    :meth:`invalidate`.
+
+    the statistics named after a table hold values about the objects
+    of that table, the SearchView prefetches them for the rows next to
+    the cursor.
+    """
+
+    def __init__(self):
+        self._functions = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, func, tables):
+        """
+        :param name: the name of the statistic
+        :param func: a callable of the form C{func(session, id)}
+            returning the value of the statistic for the object with id
+        :param tables: the names of the tables the value depends on
+        """
+        with self._lock:
+            self._functions[name] = (func, set(tables))
+            self._values[name] = {}
+
+    def __contains__(self, name):
+        return name in self._functions
+
+    def get(self, name, obj_id):
+        """
+        Return the value of the statistic name for the object with
+        obj_id, computing it in a new session if it isn't cached.
+        """
+        with self._lock:
+            values = self._values[name]
+            if obj_id in values:
+                return values[obj_id]
+        func, tables = self._functions[name]
+        session = Session()
+        try:
+            value = func(session, obj_id)
+        finally:
+            session.close()
+        with self._lock:
+            # don't cache a value invalidated while computing it
+            if self._values[name] is values:
+                values[obj_id] = value
+        return value
+
+    def invalidate(self, table=None):
+        """
+        Drop the values depending on table, all the values if table is
+        None.
+        """
+        with self._lock:
+            for name, (func, tables) in self._functions.iteritems():
+                if table is None or table in tables:
+                    self._values[name] = {}
+
+
+statistics = Statistics()
+"""The :class:`Statistics` cache used by the infoboxes."""
+
+
 class MapperBase(DeclarativeMeta):
     """
     MapperBase adds the id, _created and _last_updated columns to all
@@ -149,7 +417,12 @@ class MapperBase(DeclarativeMeta):
                                           types.DateTime(True),
                                           default=sa.func.now(),
                                           onupdate=sa.func.now())
-            cls.__mapper_args__ = {'extension': HistoryExtension()}
+            # the extensions declared by the class come after ours
+            extensions = [HistoryExtension(), SortKeyExtension(),
+                          StatisticsExtension()]
+            extensions.extend(
+                dict_.get('__mapper_args__', {}).get('extension', []))
+            cls.__mapper_args__ = {'extension': extensions}
         super(MapperBase, cls).__init__(classname, bases, dict_)
 
 
@@ -274,6 +547,9 @@ def open(uri, verify=True, show_error_dialogs=False):
         engine = new_engine
         metadata.bind = engine  # make engine implicit for metadata
         Session = sessionmaker(bind=engine, autoflush=False)
+        statistics.invalidate()
+        import bauble.fulltext as fulltext
+        fulltext.invalidate()
 
     if new_engine is not None and not verify:
         _bind()
@@ -286,6 +562,137 @@ def open(uri, verify=True, show_error_dialogs=False):
     return engine
 
 
+def schema_version():
+    """
+    Return the schema version stored in the bauble meta table of the
+    current connection, 0 for a database created before the schema
+    was versioned.
+    """
+    import bauble.meta as meta
+    session = Session()
+    try:
+        value = session.query(meta.BaubleMeta.value).\
+            filter_by(name=meta.SCHEMA_KEY).scalar()
+    finally:
+        session.close()
+    return int(value or 0)
+
+
+def needs_upgrade():
+    """
+    Return True if the database of the current connection was created
+    with an older schema than SCHEMA_VERSION, see
+    :func:`bauble.pluginmgr.upgrade`.
+    """
+    return schema_version() < SCHEMA_VERSION
+
+
+def upgrade(engine):
+    """
+    Bring the schema of the database up to date with the tables in the
+    metadata, as far as it can be done without touching the data:
+    create the missing tables, add the missing columns and indexes and
+    fill the new `_sort_key` columns, or recompute all of them if the
+    database stores them in an older format.
+
+    This runs DDL statements, so it is never run when connecting, only
+    from :func:`bauble.pluginmgr.upgrade` once the plugins tables are
+    known.
+    """
+    for table in metadata.sorted_tables:
+        if not engine.has_table(table.name):
+            logger.info('creating table %s' % table.name)
+            table.create(bind=engine)
+    added = add_missing_columns(engine)
+    add_missing_indexes(engine)
+    collate_sort_keys(engine)
+    if schema_version() < 2:
+        update_sort_keys(only_missing=False)
+    elif [c for c in added if c.name == '_sort_key']:
+        update_sort_keys(set(c.table for c in added))
+
+
+def add_missing_columns(engine):
+    """
+    Add to the database tables the columns that are in the metadata
+    and not in the database, add_missing_indexes creates their indexes.
+    This lets a database created with a previous version get the
+    columns added since, without exporting and importing its data.
+
+    Return the list of the added columns.
+    """
+    added = []
+    for table in metadata.sorted_tables:
+        if not engine.has_table(table.name):
+            continue
+        existing = sa.Table(table.name, sa.MetaData(), autoload=True,
+                            autoload_with=engine)
+        for column in table.c:
+            if column.name in existing.c:
+                continue
+            logger.info('adding column %s.%s' % (table.name, column.name))
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, column.name,
+                column.type.compile(dialect=engine.dialect)))
+            added.append(column)
+    return added
+
+
+def collate_sort_keys(bind):
+    """
+    Give the `_sort_key` columns the "C" collation on PostgreSQL, so
+    that the database orders them by code point as python compares
+    them, and not by the rules of the locale, which skip the
+    punctuation and the separators of
+    :func:`bauble.utils.natsort_string`.  The indexes on the columns
+    get rebuilt with the new collation.
+
+    Return the list of the altered tables.
+    """
+    if bind.dialect.name != 'postgresql':
+        return []
+    altered = []
+    for table in metadata.sorted_tables:
+        if '_sort_key' not in table.c:
+            continue
+        collation = bind.execute(sa.text(
+            "SELECT collation_name FROM information_schema.columns "
+            "WHERE table_name = :table AND column_name = '_sort_key'"),
+            table=table.name).fetchall()
+        if not collation or collation[0][0] == 'C':
+            continue
+        logger.info('collating %s._sort_key' % table.name)
+        bind.execute('ALTER TABLE %s ALTER COLUMN _sort_key TYPE %s '
+                     'COLLATE "C"' % (table.name, table.c._sort_key.type.
+                                      compile(dialect=bind.dialect)))
+        altered.append(table)
+    return altered
+
+
+def add_missing_indexes(engine):
+    """
+    Create the indexes that are in the metadata and not in the
+    database, by name.
+
+    Return the list of the created indexes.
+    """
+    from sqlalchemy.engine import reflection
+    inspector = reflection.Inspector.from_engine(engine)
+    created = []
+    for table in metadata.sorted_tables:
+        if not table.indexes or not engine.has_table(table.name):
+            continue
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            logger.info('creating index %s' % index.name)
+            index.create(bind=engine)
+            created.append(index)
+    return created
+
+
 def create(import_defaults=True):
     """
     Create new Bauble database at the current connection
@@ -315,6 +722,7 @@ def create(import_defaults=True):
         # plugins, maybe with an uninstall() method on Plugin
         metadata.drop_all(bind=connection, checkfirst=True)
         metadata.create_all(bind=connection)
+        collate_sort_keys(connection)
 
         # fill in the bauble meta table and install all the plugins
         meta_table = meta.BaubleMeta.__table__
@@ -324,6 +732,9 @@ def create(import_defaults=True):
         meta_table.insert(bind=connection).\
             execute(name=meta.CREATED_KEY,
                     value=unicode(datetime.datetime.now())).close()
+        meta_table.insert(bind=connection).\
+            execute(name=meta.SCHEMA_KEY,
+                    value=unicode(SCHEMA_VERSION)).close()
     except GeneratorExit, e:
         # this is here in case the main windows is closed in the middle
         # of a task
@@ -69,6 +69,10 @@ class RegistryError(DatabaseError):
     pass
 
 
+class SchemaError(DatabaseError):
+    pass
+
+
 class VersionError(DatabaseError):
 
     def __init__(self, version):
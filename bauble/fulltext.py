@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+#
+# fulltext.py
+#
+"""
+The fulltext module manages an optional index on the properties
+registered with :meth:`bauble.search.MapperSearch.add_meta` and on the
+notes registered with :meth:`bauble.search.MapperSearch.add_notes`, so
+that substring searches (`ilike '%value%'`) need not scan whole tables.
+
+On SQLite every indexed table gets an external content FTS5 table
+using the trigram tokenizer, kept in sync with its content table by
+triggers.  On PostgreSQL every indexed column gets a pg_trgm GIN index,
+which the database maintains and uses for ILIKE on its own.
+
+The index is created with :func:`create` and removed with
+:func:`drop`, it is used by the search as soon as it exists.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+#logger.setLevel(logging.DEBUG)
+
+import sqlalchemy as sa
+from sqlalchemy.orm import class_mapper
+
+import bauble.db as db
+import bauble.utils as utils
+from bauble import pluginmgr
+from bauble.error import BaubleError
+from bauble.i18n import _
+
+
+FTS_SUFFIX = '_fts'
+
+## cache of the indexed columns per engine, see indexed_columns()
+_indexed = {}
+
+
+def invalidate():
+    """
+    Forget the indexed columns found so far, db.open() calls this
+    for the new connection.
+    """
+    _indexed.clear()
+
+
+def _fts_name(table):
+    return '%s%s' % (table.name, FTS_SUFFIX)
+
+
+def _searched_tables():
+    """
+    Return the list of (table, column names) pairs to index.
+    """
+    from bauble.search import MapperSearch
+    result = []
+    for cls, properties in sorted(MapperSearch._properties.items() +
+                                  MapperSearch._notes.items(),
+                                  key=lambda x: x[0].__name__):
+        mapper = class_mapper(cls)
+        result.append((mapper.local_table,
+                       [mapper.c[p].name for p in properties]))
+    return result
+
+
+def is_supported(engine=None):
+    """
+    Return True if the database behind engine can hold the index.
+    """
+    if engine is None:
+        engine = db.engine
+    if engine.name == 'postgresql':
+        return True
+    if engine.name != 'sqlite':
+        return False
+    try:
+        engine.execute("CREATE VIRTUAL TABLE temp.fts_probe "
+                       "USING fts5(a, tokenize='trigram')")
+        engine.execute("DROP TABLE temp.fts_probe")
+    except sa.exc.DBAPIError, e:
+        logger.debug('fts5 not available: %s' % utils.utf8(e))
+        return False
+    return True
+
+
+def _fts_tables(engine):
+    """
+    Return the dictionary of the FTS5 indexed tables in the SQLite
+    database behind engine, mapping table names to the sets of indexed
+    column names.  the result is cached per engine.
+    """
+    if engine not in _indexed:
+        found = {}
+        names = [row[0] for row in engine.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' "
+            "AND sql LIKE 'CREATE VIRTUAL TABLE%fts5%'")]
+        for name in names:
+            if not name.endswith(FTS_SUFFIX):
+                continue
+            found[name[:-len(FTS_SUFFIX)]] = set(
+                row[1] for row in engine.execute(
+                    'PRAGMA table_info("%s")' % name))
+        _indexed[engine] = found
+    return _indexed[engine]
+
+
+def indexed_columns(table, engine=None):
+    """
+    Return the set of names of the columns of table covered by the
+    FTS5 index, empty if the table is not indexed.
+
+    only SQLite needs this, on PostgreSQL the trigram indexes are used
+    transparently.
+    """
+    if engine is None:
+        engine = db.engine
+    if engine is None or engine.name != 'sqlite':
+        return set()
+    return _fts_tables(engine).get(table.name, set())
+
+
+def exists(engine=None):
+    """
+    Return True if the database holds any part of the index.
+    """
+    if engine is None:
+        engine = db.engine
+    if engine.name == 'postgresql':
+        stmt = sa.text("SELECT count(*) FROM pg_indexes "
+                       "WHERE indexname LIKE :pattern")
+        pattern = '%%\\%s' % FTS_SUFFIX
+        return engine.execute(stmt, pattern=pattern).scalar() > 0
+    elif engine.name == 'sqlite':
+        return len(_fts_tables(engine)) > 0
+    return False
+
+
+def ilike(mapper, col, val, engine=None):
+    """
+    Return a case insensitive LIKE clause for the column named col in
+    the mapper, the same as :func:`bauble.utils.ilike`, but resolved
+    on the FTS5 index when the column is indexed.
+    """
+    column = mapper.c[col]
+    table = mapper.local_table
+    if column.name not in indexed_columns(table, engine):
+        return utils.ilike(column, val, engine)
+    fts = sa.table(_fts_name(table), sa.column('rowid'),
+                   sa.column(column.name))
+    # the trigram tokenizer makes LIKE case insensitive
+    matching = sa.select([fts.c.rowid], fts.c[column.name].like(val))
+    return table.c.id.in_(matching)
+
+
+def _create_sqlite(conn, table, columns):
+    fts = _fts_name(table)
+    cols = ', '.join('"%s"' % c for c in columns)
+    new = ', '.join('new."%s"' % c for c in columns)
+    old = ', '.join('old."%s"' % c for c in columns)
+    values = dict(fts=fts, table=table.name, cols=cols, new=new, old=old)
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS %(fts)s USING fts5(%(cols)s, "
+        "tokenize='trigram', content='%(table)s', content_rowid='id')",
+        "INSERT INTO %(fts)s(%(fts)s) VALUES('rebuild')",
+        "CREATE TRIGGER IF NOT EXISTS %(fts)s_ai AFTER INSERT ON %(table)s "
+        "BEGIN INSERT INTO %(fts)s(rowid, %(cols)s) "
+        "VALUES (new.id, %(new)s); END",
+        "CREATE TRIGGER IF NOT EXISTS %(fts)s_ad AFTER DELETE ON %(table)s "
+        "BEGIN INSERT INTO %(fts)s(%(fts)s, rowid, %(cols)s) "
+        "VALUES ('delete', old.id, %(old)s); END",
+        "CREATE TRIGGER IF NOT EXISTS %(fts)s_au AFTER UPDATE ON %(table)s "
+        "BEGIN INSERT INTO %(fts)s(%(fts)s, rowid, %(cols)s) "
+        "VALUES ('delete', old.id, %(old)s); "
+        "INSERT INTO %(fts)s(rowid, %(cols)s) "
+        "VALUES (new.id, %(new)s); END",
+        ]
+    for stmt in statements:
+        conn.execute(stmt % values)
+
+
+def _drop_sqlite(conn, table):
+    fts = _fts_name(table)
+    for suffix in ('_ai', '_ad', '_au'):
+        conn.execute('DROP TRIGGER IF EXISTS %s%s' % (fts, suffix))
+    conn.execute('DROP TABLE IF EXISTS %s' % fts)
+
+
+def _create_postgresql(conn, table, columns):
+    for col in columns:
+        conn.execute('CREATE INDEX IF NOT EXISTS %s_%s%s ON %s '
+                     'USING gin ("%s" gin_trgm_ops)'
+                     % (table.name, col, FTS_SUFFIX, table.name, col))
+
+
+def _drop_postgresql(conn, table, columns):
+    for col in columns:
+        conn.execute('DROP INDEX IF EXISTS %s_%s%s'
+                     % (table.name, col, FTS_SUFFIX))
+
+
+def create(engine=None):
+    """
+    Create, or bring up to date, the index for all searched tables.
+
+    on SQLite an FTS5 table is only dropped and created again if its
+    columns are not the searched ones, otherwise its missing triggers
+    are created and its rows rebuilt.
+    """
+    if engine is None:
+        engine = db.engine
+    if not is_supported(engine):
+        raise BaubleError(
+            _('The full text index is not supported by this database'))
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        indexed = {}
+        if engine.name == 'postgresql':
+            conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        else:
+            indexed = _fts_tables(engine)
+        for table, columns in _searched_tables():
+            if engine.name == 'postgresql':
+                _create_postgresql(conn, table, columns)
+                continue
+            if indexed.get(table.name) != set(columns):
+                _drop_sqlite(conn, table)
+            _create_sqlite(conn, table, columns)
+    except Exception, e:
+        logger.warning('fulltext.create(): %s' % utils.utf8(e))
+        trans.rollback()
+        raise
+    else:
+        trans.commit()
+    finally:
+        conn.close()
+        _indexed.pop(engine, None)
+
+
+def rebuild(engine=None):
+    """
+    Refill the FTS5 tables from their content tables.
+
+    needed after the content tables are changed with triggers disabled,
+    or dropped and recreated, like the CSV importer does.
+    """
+    if engine is None:
+        engine = db.engine
+    for table, columns in _searched_tables():
+        if indexed_columns(table, engine):
+            fts = _fts_name(table)
+            engine.execute("INSERT INTO %s(%s) VALUES('rebuild')"
+                           % (fts, fts))
+
+
+def drop(engine=None):
+    """
+    Remove the index from all searched tables.
+    """
+    if engine is None:
+        engine = db.engine
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        for table, columns in _searched_tables():
+            if engine.name == 'postgresql':
+                _drop_postgresql(conn, table, columns)
+            elif engine.name == 'sqlite':
+                _drop_sqlite(conn, table)
+    except Exception, e:
+        logger.warning('fulltext.drop(): %s' % utils.utf8(e))
+        trans.rollback()
+        raise
+    else:
+        trans.commit()
+    finally:
+        conn.close()
+        _indexed.pop(engine, None)
+
+
+class FullTextCommandHandler(pluginmgr.CommandHandler):
+
+    command = 'fulltext'
+
+    def __call__(self, cmd, arg):
+        action = {'create': create,
+                  'rebuild': rebuild,
+                  'drop': drop,
+                  }.get((arg or 'create').strip())
+        if action is None:
+            utils.message_dialog(
+                _('usage: :fulltext=create|rebuild|drop'))
+            return
+        action()
@@ -28,6 +28,7 @@ import bauble.utils as utils
 VERSION_KEY = u'version'
 CREATED_KEY = u'created'
 REGISTRY_KEY = u'registry'
+SCHEMA_KEY = u'schema'
 
 # date format strings:
 # yy - short year
@@ -32,6 +32,9 @@ populates the plugins dict (happens in load())
 installed plugins in to the registry (happens in load())
 
 3. initialize the plugins (happens in init())
+
+A database created with an older schema is brought up to date by
+upgrade(), between load() and init(), see db.SCHEMA_VERSION.
 """
 
 import logging
@@ -328,6 +331,53 @@ def install(plugins_to_install, import_defaults=True, force=False):
         raise
 
 
+def upgrade(force=False):
+    """
+    Bring a database created with an older schema up to
+    db.SCHEMA_VERSION: create the missing tables, columns and indexes
+    with db.upgrade(), call upgrade() for each of the loaded plugins in
+    order of dependency and store the new schema version.
+
+    This alters the tables, so it is never run when connecting, but
+    from the scripts/bauble-upgrade-schema script or when the user
+    accepts it at startup.  Call it after load() and before init().
+
+    :param force:  Upgrade even if the stored schema version is current.
+    :type force: bool
+
+    Return True if the database was upgraded.
+    """
+    if not force and not db.needs_upgrade():
+        return False
+    import bauble.meta as meta
+    logger.info('upgrading the schema from version %s to %s'
+                % (db.schema_version(), db.SCHEMA_VERSION))
+    db.upgrade(db.engine)
+
+    to_upgrade = plugins.values()
+    depends, unmet = _create_dependency_pairs(to_upgrade)
+    to_upgrade = utils.topological_sort(to_upgrade, depends)
+    if not to_upgrade and plugins:
+        raise BaubleError(_('The plugins contain a dependency loop. This '
+                            'can happen if two plugins directly or '
+                            'indirectly rely on each other'))
+    session = db.Session()
+    try:
+        for p in to_upgrade:
+            logger.debug('upgrade: %s' % p)
+            p.upgrade(session)
+        version = meta.get_default(meta.SCHEMA_KEY, u'0', session)
+        version.value = unicode(db.SCHEMA_VERSION)
+        session.commit()
+    except Exception, e:
+        logger.warning('bauble.pluginmgr.upgrade(): %s' % utils.utf8(e))
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return True
+
+
 class PluginRegistry(db.Base):
     """
     The PluginRegistry contains a list of plugins that have been installed
@@ -453,6 +503,15 @@ class Plugin(object):
         '''
         pass
 
+    @classmethod
+    def upgrade(cls, session):
+        '''
+        upgrade() is run by pluginmgr.upgrade() on a database created
+        with an older schema, after the missing columns were added, to
+        migrate the data of the plugin, the caller commits
+        '''
+        pass
+
 
 class EditorPlugin(Plugin):
     '''
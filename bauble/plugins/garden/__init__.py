@@ -70,9 +70,11 @@ class GardenPlugin(pluginmgr.Plugin):
         mapper_search = search.get_strategy('MapperSearch')
 
         from functools import partial
-        mapper_search.add_meta(('accession', 'acc'), Accession, ['code'])
+        mapper_search.add_meta(('accession', 'acc'), Accession, ['code'],
+                               eager=['species.genus'])
         SearchView.row_meta[Accession].set(
             children=partial(db.natsort, "plants"),
+            children_count='plants',
             infobox=AccessionInfoBox,
             context_menu=acc_context_menu,
             markup_func=acc_markup_func)
@@ -80,11 +82,13 @@ class GardenPlugin(pluginmgr.Plugin):
         mapper_search.add_meta(('location', 'loc'), Location, ['name', 'code'])
         SearchView.row_meta[Location].set(
             children=partial(db.natsort, 'plants'),
+            children_count='plants',
             infobox=LocationInfoBox,
             context_menu=loc_context_menu,
             markup_func=loc_markup_func)
 
-        mapper_search.add_meta(('plant', 'plants'), Plant, ['code'])
+        mapper_search.add_meta(('plant', 'plants'), Plant, ['code'],
+                               eager=['accession.species.genus'])
         search.add_strategy(PlantSearch)  # special search value strategy
         #search.add_strategy(SpeciesSearch)  # special search value strategy
         SearchView.row_meta[Plant].set(
@@ -109,7 +113,8 @@ class GardenPlugin(pluginmgr.Plugin):
             context_menu=source_detail_context_menu)
 
         mapper_search.add_meta(('collection', 'col', 'coll'),
-                               Collection, ['locale'])
+                               Collection, ['locale'],
+                               eager=['source.accession.species.genus'])
         coll_kids = lambda coll: sorted(coll.source.accession.plants,
                                         key=utils.natsort_key)
         SearchView.row_meta[Collection].set(
@@ -118,8 +123,12 @@ class GardenPlugin(pluginmgr.Plugin):
             markup_func=coll_markup_func,
             context_menu=collection_context_menu)
 
+        mapper_search.add_notes(AccessionNote, 'accession')
+        mapper_search.add_notes(PlantNote, 'plant')
+
         # done here b/c the Species table is not part of this plugin
         SearchView.row_meta[Species].child = "accessions"
+        SearchView.row_meta[Species].children_count = 'accessions'
 
         if bauble.gui is not None:
             bauble.gui.add_to_insert_menu(AccessionEditor, _('Accession'))
@@ -483,7 +483,7 @@ class AccessionNote(db.Base, db.Serializable):
         return result
 
 
-class Accession(db.Base, db.Serializable):
+class Accession(db.Base, db.Serializable, db.NaturalSortKey):
     """
     :Table name: accession
 
@@ -552,6 +552,9 @@ class Accession(db.Base, db.Serializable):
     __mapper_args__ = {'order_by': 'accession.code',
                        'extension': AccessionMapperExtension()}
 
+    # the plant strings include the accession code
+    sort_key_dependents = ['plants']
+
     # columns
     #: the accession code
     code = Column(Unicode(20), nullable=False, unique=True)
@@ -28,7 +28,7 @@ import logging
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.DEBUG)
 
-from sqlalchemy import Column, Unicode, UnicodeText
+from sqlalchemy import Column, Unicode, UnicodeText, func
 from sqlalchemy.orm import relation, backref, validates
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.exc import DBAPIError
@@ -100,7 +100,7 @@ def loc_markup_func(location):
         return utils.xml_safe(str(location))
 
 
-class Location(db.Base, db.Serializable):
+class Location(db.Base, db.Serializable, db.NaturalSortKey):
     """
     :Table name: location
 
@@ -435,6 +435,21 @@ class LocationEditor(GenericModelViewPresenterEditor):
 from bauble.view import InfoBox, InfoExpander, PropertiesExpander
 
 
+def location_statistics(session, location_id):
+    """
+    Return a dict with the number of plants at the location with
+    location_id.  registered as the 'location' statistic of
+    :data:`bauble.db.statistics`.
+    """
+    from bauble.plugins.garden.plant import Plant
+    nplants = session.query(func.count(Plant.id)).\
+        filter(Plant.location_id == location_id).scalar()
+    return {'nplants': nplants}
+
+
+db.statistics.register('location', location_statistics, ['plant'])
+
+
 class GeneralLocationExpander(InfoExpander):
     """
     general expander for the PlantInfoBox
@@ -451,13 +466,11 @@ class GeneralLocationExpander(InfoExpander):
     def update(self, row):
         '''
         '''
-        from bauble.plugins.garden.plant import Plant
         self.widget_set_value('loc_name_data',
                               '<big>%s</big>' % utils.xml_safe(str(row)),
                               markup=True)
-        session = object_session(row)
-        nplants = session.query(Plant).filter_by(location_id=row.id).count()
-        self.widget_set_value('loc_nplants_data', nplants)
+        stats = db.statistics.get('location', row.id)
+        self.widget_set_value('loc_nplants_data', stats['nplants'])
 
 
 class DescriptionExpander(InfoExpander):
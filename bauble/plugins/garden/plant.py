@@ -415,7 +415,8 @@ acc_type_values = {u'Plant': _('Plant'),
                    None: ''}
 
 
-class Plant(db.Base, db.Serializable, db.DefiningPictures):
+class Plant(db.Base, db.Serializable, db.DefiningPictures,
+            db.NaturalSortKey):
     """
     :Table name: plant
 
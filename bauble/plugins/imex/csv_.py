@@ -26,14 +26,18 @@
 
 import os
 import csv
+import gzip
+import struct
 import traceback
+from StringIO import StringIO
 
 import logging
 logger = logging.getLogger(__name__)
 
 import gtk
 
-from sqlalchemy import ColumnDefault, Boolean
+from sqlalchemy import ColumnDefault, Boolean, Text, and_, bindparam, cast, \
+    func, select, text
 
 import bauble
 import bauble.db as db
@@ -72,6 +76,334 @@ QUOTE_STYLE = csv.QUOTE_MINIMAL
 QUOTE_CHAR = '"'
 
 
+def open_csv(filename, mode='rb'):
+    """
+    Open the CSV file filename, through gzip if its name ends with .gz
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def csv_size(filename):
+    """
+    Return the size of the content of the CSV file filename, for a
+    gzip file as written in its trailer, that is modulo 4GB.
+    """
+    if not filename.endswith('.gz'):
+        return os.path.getsize(filename)
+    f = open(filename, 'rb')
+    try:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+    finally:
+        f.close()
+
+
+def table_name_of(filename):
+    """
+    Return the name of the table of the CSV file filename, its base
+    name without the extension, e.g. family for /tmp/family.txt.gz
+    """
+    base = os.path.basename(filename)
+    if base.endswith('.gz'):
+        base = base[:-3]
+    return os.path.splitext(base)[0]
+
+
+class LineCounter(object):
+    """
+    Iterate over the lines of the file f, counting in offset the bytes
+    read so far, so that the progress of an import can be told without
+    reading the files twice.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+
+    def __iter__(self):
+        for line in self.f:
+            self.offset += len(line)
+            yield line
+
+
+def has_rows(filename):
+    """
+    Tell whether the CSV file filename has any line after the header.
+    """
+    f = open_csv(filename)
+    try:
+        f.readline()
+        return f.readline().strip() != ''
+    finally:
+        f.close()
+
+
+## the pragmas set on an SQLite database for the duration of an
+## import, a crash in the meanwhile can corrupt the database but the
+## import would have to be repeated anyway
+sqlite_import_pragmas = {'journal_mode': 'MEMORY', 'synchronous': 'OFF'}
+
+
+def set_sqlite_pragmas(connection, pragmas):
+    """
+    Set the pragmas on the SQLite connection and return their previous
+    values, so that they can be restored by a second call.
+    """
+    previous = {}
+    for name, value in pragmas.iteritems():
+        result = connection.execute('PRAGMA %s' % name)
+        previous[name] = result.scalar()
+        result = connection.execute('PRAGMA %s = %s' % (name, value))
+        result.close()
+    return previous
+
+
+def can_copy(connection):
+    """
+    Tell whether rows can be loaded with COPY FROM STDIN on connection,
+    that is on PostgreSQL through psycopg2.
+    """
+    dialect = connection.dialect
+    return dialect.name in ('postgres', 'postgresql') and \
+        getattr(dialect, 'driver', 'psycopg2') == 'psycopg2'
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        value = value and 'true' or 'false'
+    value = utils.to_unicode(value).encode('utf-8')
+    return '"%s"' % value.replace('"', '""')
+
+
+def copy_rows(connection, table, column_keys, rows):
+    """
+    Load the row dictionaries into table with one COPY FROM STDIN,
+    see :func:`can_copy`.  The rows are formatted as CSV, with the
+    unquoted \\N standing for NULL and every other value quoted, so
+    that a string \\N is not taken for NULL.
+    """
+    preparer = connection.dialect.identifier_preparer
+    buf = StringIO()
+    for row in rows:
+        buf.write(','.join(_copy_value(row.get(key))
+                           for key in column_keys))
+        buf.write('\n')
+    buf.seek(0)
+    stmt = "COPY %s (%s) FROM STDIN WITH CSV NULL '\\N'" % (
+        preparer.format_table(table),
+        ', '.join(preparer.format_column(table.c[key])
+                  for key in column_keys))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(stmt, buf)
+    finally:
+        cursor.close()
+
+
+def can_load_in_parallel(bind):
+    """
+    Tell whether the tables of an import or an export can be loaded or
+    dumped on concurrent connections of bind: not on SQLite, where the
+    writers lock the whole database and an in memory database is
+    private to its connection.
+    """
+    from sqlalchemy.engine import Engine
+    return isinstance(bind, Engine) and bind.name != 'sqlite'
+
+
+class TableLoad(object):
+    """
+    The state of the load of one CSV file into its table, shared by
+    the importer and the thread loading it.
+
+    :ivar offset: the bytes of the file read so far
+    :ivar rows: the rows inserted so far
+    :ivar deferred: the indexes to create once the rows are inserted
+    :ivar upsert: whether the rows update those with the same id
+    :ivar ids: the ids of the rows written, when upsert
+    """
+
+    def __init__(self, table, filename, deferred=(), upsert=False):
+        self.table = table
+        self.filename = filename
+        self.deferred = list(deferred)
+        self.upsert = upsert
+        self.ids = set()
+        self.offset = 0
+        self.rows = 0
+        self.done = False
+        self.error = None
+
+
+## the files of an export that are not tables: the watermark of the
+## export and, in an incremental export, the deleted rows
+WATERMARK_FILE = '_watermark'
+DELETED_FILE = '_deleted'
+
+
+class Watermark(object):
+    """
+    The point in the changes of a database an export was made at, as
+    written in the _watermark file of the export: the id of the last
+    row of the history table.  The rows inserted, updated or deleted
+    since are those of the later history rows.
+
+    The history ids are given in the order of the inserts, not of the
+    commits.  On PostgreSQL a transaction writing when the watermark is
+    taken could commit a history row below it afterwards, the export
+    waits for those transactions to end, see :meth:`settled`.  SQLite
+    has one writer at a time.  The `_last_updated` column can't be
+    used instead, on PostgreSQL it holds the start time of the
+    transaction that wrote the row, not the time of its commit.
+
+    :ivar snapshot: the PostgreSQL transaction snapshot the watermark
+        was taken in, None elsewhere
+    """
+
+    def __init__(self, history_id, snapshot=None):
+        self.history_id = history_id
+        self.snapshot = snapshot
+
+    @classmethod
+    def current(cls, connection):
+        """
+        Return the watermark of the database of connection as of now.
+        """
+        history = db.History.__table__
+        columns = [func.max(history.c.id)]
+        if connection.dialect.name in ('postgres', 'postgresql'):
+            # in the same statement, the transactions not running in
+            # the snapshot wrote the history rows they can see
+            columns.append(
+                cast(func.txid_current_snapshot(), Text).label('snapshot'))
+        row = connection.execute(select(columns)).first()
+        snapshot = None
+        if len(row) > 1:
+            snapshot = row[1]
+        return cls(row[0] or 0, snapshot)
+
+    def settled(self, connection):
+        """
+        Tell whether the transactions that were writing when the
+        watermark was taken have ended, their history rows are then
+        read by the export.
+        """
+        if self.snapshot is None:
+            return True
+        stmt = text("SELECT count(*) FROM "
+                    "(SELECT txid_snapshot_xip(CAST(:snapshot AS "
+                    "txid_snapshot)) AS xid) AS running "
+                    "WHERE NOT txid_visible_in_snapshot("
+                    "running.xid, txid_current_snapshot())")
+        return not connection.execute(stmt, snapshot=self.snapshot).scalar()
+
+    @classmethod
+    def read(cls, path):
+        """
+        Return the watermark of the export in the directory path.
+        """
+        f = open(os.path.join(path, '%s.txt' % WATERMARK_FILE), 'rb')
+        try:
+            row = UnicodeReader(f, quotechar=QUOTE_CHAR,
+                                quoting=QUOTE_STYLE).next()
+        finally:
+            f.close()
+        return cls(int(row['history_id']))
+
+    def write(self, path):
+        """
+        Write the watermark to the directory path.
+        """
+        f = open(os.path.join(path, '%s.txt' % WATERMARK_FILE), 'wb')
+        try:
+            writer = UnicodeWriter(f, quotechar=QUOTE_CHAR,
+                                   quoting=QUOTE_STYLE)
+            writer.writerow(['history_id'])
+            writer.writerow([self.history_id])
+        finally:
+            f.close()
+
+    def changed(self, table):
+        """
+        Return the clause selecting the rows of table inserted or
+        updated since the watermark, None to select them all.
+        """
+        history = db.History.__table__
+        if table is history:
+            return table.c.id > self.history_id
+        if 'id' not in table.c:
+            return None
+        return table.c.id.in_(
+            select([history.c.table_id],
+                   and_(history.c.table_name == table.name,
+                        history.c.operation != 'delete',
+                        history.c.id > self.history_id)))
+
+    def deleted(self):
+        """
+        Return the select of the table name and the id of the rows
+        deleted since the watermark, as recorded by the history table.
+        Like the changed rows, rows deleted bypassing the mappers are
+        only recorded where the deleting code calls
+        :func:`bauble.db.add_history`, like the tag plugin does.
+        """
+        history = db.History.__table__
+        return select([history.c.table_name, history.c.table_id],
+                      and_(history.c.operation == 'delete',
+                           history.c.id > self.history_id)).\
+            order_by(history.c.id)
+
+
+def _distribution_species(connection, metadata, ids):
+    """
+    Return the set of the species ids of the species_distribution rows
+    with ids.
+    """
+    species_ids = set()
+    table = metadata.tables.get('species_distribution')
+    if table is None or not ids:
+        return species_ids
+    ids = sorted(ids)
+    for start in range(0, len(ids), 500):
+        stmt = select([table.c.species_id],
+                      table.c.id.in_(ids[start:start+500]))
+        species_ids.update(r[0] for r in connection.execute(stmt))
+    return species_ids
+
+
+def upsert_rows(connection, table, insert, column_keys, rows):
+    """
+    Write the row dictionaries to table, updating the rows with the
+    same id and inserting the others with the compiled insert, that is
+    one SELECT of the existing ids 500 at a time and two executemany.
+    """
+    ids = [int(row['id']) for row in rows]
+    existing = set()
+    for start in range(0, len(ids), 500):
+        stmt = select([table.c.id], table.c.id.in_(ids[start:start+500]))
+        existing.update(r[0] for r in connection.execute(stmt))
+    updates = []
+    inserts = []
+    for row_id, row in zip(ids, rows):
+        if row_id in existing:
+            updates.append(dict(('b_%s' % key, row.get(key))
+                                for key in column_keys))
+        else:
+            inserts.append(row)
+    if updates:
+        # the bind names can't be the column names
+        stmt = table.update().where(table.c.id == bindparam('b_id')).\
+            values(**dict((key, bindparam('b_%s' % key))
+                          for key in column_keys if key != 'id'))
+        connection.execute(stmt, updates)
+    if inserts:
+        connection.execute(insert, *inserts)
+
+
 class UnicodeReader(object):
 
     def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
@@ -149,8 +481,21 @@ class CSVImporter(Importer):
     import order, each file being imported will completely replace any
     existing data in the corresponding table.
 
-    The CSVImporter imports the rows of the CSV file in chunks rather than
-    one row at a time.  The non-server side column defaults are determined
+    The CSVImporter streams the rows of the CSV files and inserts them
+    batch_size at a time, with one executemany of the same compiled
+    statement, so the memory used doesn't depend on the size of the
+    files.  The progress is told by the bytes read.  On PostgreSQL the
+    batches are loaded with COPY, on SQLite the journal and the syncing
+    are relaxed during the import, see :data:`sqlite_import_pragmas`.
+    The indexes of the created tables are created once their rows are
+    loaded.  Except on SQLite, up to workers tables that don't refer to
+    each other are loaded at the same time, each on its own connection
+    and in its own transaction: this is only done when all the tables
+    are created by the import, their rows are deleted if it fails.  An
+    incremental import is loaded in one transaction.
+    The created tables are checked to hold as many rows as their file
+    once loaded.  The non-server side
+    column defaults are determined
     before the INSERT statement is generated instead of getting new defaults
     for each row.  This shouldn't be a problem but it also means that your
     column default should change depending on the value of previously
@@ -158,6 +503,13 @@ class CSVImporter(Importer):
 
     """
 
+    ## the number of rows inserted by each executemany
+    batch_size = 5000
+
+    ## the number of tables loaded at the same time, where the database
+    ## allows it, see can_load_in_parallel
+    workers = 4
+
     def __init__(self):
         super(CSVImporter, self).__init__()
         self.__error = False   # flag to indicate error on import
@@ -165,11 +517,15 @@ class CSVImporter(Importer):
         self.__pause = False   # flag to pause importing
         self.__error_exc = False
 
-    def start(self, filenames=None, metadata=None, force=False):
+    def start(self, filenames=None, metadata=None, force=False,
+              incremental=False):
         '''start the import process. this is a non blocking method: we queue
         the process as a bauble task. there is no callback informing whether
         it is successfully completed or not.
 
+        with incremental the files are those of an incremental export,
+        their rows update the rows with the same id or are added, the
+        rows in the _deleted file are deleted, no table is dropped.
         '''
         if metadata is None:
             metadata = db.metadata  # use the default metadata
@@ -179,7 +535,7 @@ class CSVImporter(Importer):
         if filenames is None:
             return
 
-        bauble.task.queue(self.run(filenames, metadata, force))
+        bauble.task.queue(self.run(filenames, metadata, force, incremental))
 
     @staticmethod
     def _toposort_file(filename, key_pairs):
@@ -192,7 +548,7 @@ class CSVImporter(Importer):
         foreign_key column and child is usually the column that the
         foreign key points to, e.g ('parent_id', 'id')
         """
-        f = open(filename, 'rb')
+        f = open_csv(filename)
         reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
                                quoting=QUOTE_STYLE)
 
@@ -222,8 +578,7 @@ class CSVImporter(Importer):
         # write a temporary file of the sorted lines
         import tempfile
         tmppath = tempfile.mkdtemp()
-        head, tail = os.path.split(filename)
-        filename = os.path.join(tmppath, tail)
+        filename = os.path.join(tmppath, '%s.txt' % table_name_of(filename))
         tmpfile = open(filename, 'wb')
         tmpfile.write('%s\n' % ','.join(fields))
         #writer = UnicodeWriter(tmpfile, fields, quotechar=QUOTE_CHAR,
@@ -235,7 +590,225 @@ class CSVImporter(Importer):
         del writer
         return filename
 
-    def run(self, filenames, metadata, force=False):
+    def _load_table(self, connection, load):
+        """
+        A generator inserting the rows of the file of load into its
+        table on connection, batch_size rows at a time, yielding after
+        each batch.  The caller commits.
+        """
+        table = load.table
+        use_copy = can_copy(connection)
+
+        # precompute the defaults...this assumes that the
+        # default function doesn't depend on state after each
+        # row...it shouldn't anyways since we do an insert
+        # many instead of each row at a time
+        defaults = {}
+        for column in table.c:
+            if isinstance(column.default, ColumnDefault):
+                defaults[column.name] = column.default.execute()
+        # in SA 0.5.5 and only on an SQLite database the 'False' string
+        # would import as True, the boolean columns get bool values
+        booleans = [c.name for c in table.c if isinstance(c.type, Boolean)]
+
+        # check if there are any foreign keys to on the table
+        # that refer to itself, if so create a new file with
+        # the lines sorted in order of dependency so that we
+        # don't get errors about importing values into a
+        # foreign_key that don't reference and existin row
+        self_keys = filter(lambda f: f.column.table == table,
+                           table.foreign_keys)
+        filename = load.filename
+        if self_keys:
+            key_pairs = map(lambda x: (x.parent.name, x.column.name),
+                            self_keys)
+            filename = self._toposort_file(filename, key_pairs)
+
+        f = open_csv(filename)
+        counter = LineCounter(f)
+        reader = UnicodeReader(counter, quotechar=QUOTE_CHAR,
+                               quoting=QUOTE_STYLE)
+
+        # the column keys for the insert are a union of the columns in
+        # the CSV file and the columns with defaults, the statement is
+        # compiled once per table
+        csv_columns = set(reader.reader.fieldnames)
+        column_keys = list(csv_columns.union(defaults.keys()))
+        insert = table.insert(bind=connection).\
+            compile(column_keys=column_keys)
+        defaults = defaults.items()
+        booleans = [c for c in booleans if c in csv_columns]
+        bool_values = {'True': True, 'False': False}
+        if load.upsert and not ('id' in table.c and 'id' in csv_columns):
+            # without the ids the rows would be added again
+            f.close()
+            raise BaubleError(
+                _('%(filename)s has no id column, it can not be imported '
+                  'incrementally into the %(table)s table')
+                % {'filename': load.filename, 'table': table.name})
+
+        values = []
+
+        def do_insert():
+            if values and load.upsert:
+                upsert_rows(connection, table, insert, column_keys, values)
+                load.ids.update(int(row['id']) for row in values)
+            elif values and use_copy:
+                copy_rows(connection, table, column_keys, values)
+            elif values:
+                connection.execute(insert, *values)
+            load.rows += len(values)
+            del values[:]
+            # a sorted copy has the same size as the file
+            load.offset = counter.offset
+
+        try:
+            # the reader gives None for the empty values
+            for line in reader:
+                while self.__pause:
+                    yield
+                if self.__cancel or self.__error:
+                    return
+
+                for column, default in defaults:
+                    if line.get(column) is None:
+                        line[column] = default
+                for column in booleans:
+                    line[column] = bool_values.get(line[column],
+                                                   line[column])
+                values.append(line)
+                if len(values) >= self.batch_size:
+                    do_insert()
+                    yield
+        finally:
+            f.close()
+
+        # insert the remainder that were less than batch_size
+        do_insert()
+        for index in load.deferred:
+            index.create(bind=connection)
+
+    def _load_in_thread(self, engine, load):
+        """
+        Load the table of load in its own transaction, on a new
+        connection of engine, meant as the target of a thread.
+        """
+        import time
+        connection = engine.connect()
+        transaction = connection.begin()
+        try:
+            for step in self._load_table(connection, load):
+                if self.__pause:
+                    time.sleep(0.1)
+            transaction.commit()
+        except Exception, e:
+            logger.error(traceback.format_exc())
+            transaction.rollback()
+            load.error = e
+        finally:
+            connection.close()
+            load.done = True
+
+    def _load_parallel(self, engine, loads):
+        """
+        A generator loading the tables of loads on up to workers
+        threads, yielding while they run.  A table is started once the
+        tables it refers to are loaded and committed, if the references
+        make a loop the first table is started anyway.
+
+        Each table is committed on its own, the caller empties them
+        with _empty_tables if the import fails.
+        """
+        import threading
+        import time
+        names = set(load.table.name for load in loads)
+        refers = {}
+        for load in loads:
+            refers[load] = set(fk.column.table.name
+                               for fk in load.table.foreign_keys
+                               if fk.column.table.name in names and
+                               fk.column.table is not load.table)
+        pending = list(loads)
+        running = []
+        loaded = set()
+        error = None
+        while pending or running:
+            for load in [l for l in running if l.done]:
+                running.remove(load)
+                loaded.add(load.table.name)
+                if load.error is not None and error is None:
+                    # stop the others
+                    error = load.error
+                    self.__error = True
+            if error is None and not self.__cancel:
+                ready = [l for l in pending if refers[l] <= loaded]
+                if not ready and not running and pending:
+                    ready = pending[:1]
+                for load in ready[:self.workers - len(running)]:
+                    pending.remove(load)
+                    running.append(load)
+                    thread = threading.Thread(target=self._load_in_thread,
+                                              args=(engine, load))
+                    thread.start()
+            elif not running:
+                break
+            yield
+            time.sleep(0.05)
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _empty_tables(metadata, loads):
+        """
+        Delete the rows of the tables of loads, the dependent tables
+        first, in one transaction: the rows of a failed parallel load,
+        committed table by table.
+        """
+        names = set(load.table.name for load in loads)
+        connection = metadata.bind.connect()
+        transaction = connection.begin()
+        try:
+            for table in reversed(metadata.sorted_tables):
+                if table.name in names:
+                    connection.execute(table.delete())
+            transaction.commit()
+        except Exception:
+            logger.error(traceback.format_exc())
+            transaction.rollback()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _read_deleted(filename):
+        """
+        Return the ids of the rows listed in the _deleted file filename,
+        in a set by table name.
+        """
+        deleted = {}
+        f = open_csv(filename)
+        try:
+            reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
+                                   quoting=QUOTE_STYLE)
+            for row in reader:
+                deleted.setdefault(row['table_name'], set()).add(
+                    int(row['table_id']))
+        finally:
+            f.close()
+        return deleted
+
+    def _delete_rows(self, connection, metadata, deleted, kept):
+        """
+        Delete the rows of the deleted ids by table name, but those in
+        kept, the dependent tables first.
+        """
+        for table in reversed(metadata.sorted_tables):
+            ids = sorted(deleted.get(table.name, set()) -
+                         kept.get(table.name, set()))
+            for start in range(0, len(ids), 500):
+                connection.execute(table.delete().where(
+                    table.c.id.in_(ids[start:start+500])))
+
+    def run(self, filenames, metadata, force=False, incremental=False):
         '''
         A generator method for importing filenames into the database.
         This method periodically yields control so that the GUI can
@@ -244,6 +817,7 @@ class CSVImporter(Importer):
         :param filenames:
         :param metadata:
         :param force: default=False
+        :param incremental: default=False, see start()
         '''
         transaction = None
         connection = None
@@ -264,8 +838,7 @@ class CSVImporter(Importer):
         # create a mapping of table names to filenames
         filename_dict = {}
         for f in filenames:
-            path, base = os.path.split(f)
-            table_name, ext = os.path.splitext(base)
+            table_name = table_name_of(f)
             if table_name in filename_dict:
                 safe = utils.xml_safe
                 values = dict(table_name=safe(table_name),
@@ -278,6 +851,11 @@ class CSVImporter(Importer):
                 return
             filename_dict[table_name] = f
 
+        # the files of an export that are not tables
+        filename_dict.pop(WATERMARK_FILE, None)
+        deleted_filename = filename_dict.pop(DELETED_FILE, None)
+        filenames = filename_dict.values()
+
         # resolve filenames to table names and return them in sorted order
         sorted_tables = []
         for table in metadata.sorted_tables:
@@ -293,13 +871,8 @@ class CSVImporter(Importer):
             utils.message_dialog(msg, gtk.MESSAGE_ERROR)
             return
 
-        total_lines = 0
-        filesizes = {}
-        for filename in filenames:
-            #get the total number of lines for all the files
-            nlines = len(open(filename).readlines())
-            filesizes[filename] = nlines
-            total_lines += nlines
+        # the progress is the fraction of the bytes read
+        total_bytes = float(sum(csv_size(f) for f in filenames)) or 1
 
         created_tables = []
 
@@ -308,13 +881,23 @@ class CSVImporter(Importer):
             if table.name not in created_tables:
                 created_tables.append(table.name)
 
-        steps_so_far = 0
         cleaned = None
         insert = None
+        # the ids written or deleted by table name and the species whose
+        # distribution changed, in an incremental import
+        delta = {}
+        delta_species = set()
+        loads = []
+        parallel = False
         depends = set()  # the type will be changed to a [] later
+        pragmas = None
+        if connection.dialect.name == 'sqlite':
+            pragmas = set_sqlite_pragmas(connection, sqlite_import_pragmas)
         try:
-            ## get all the dependencies
+            ## get all the dependencies, an incremental import keeps them
             for table, filename in sorted_tables:
+                if incremental:
+                    continue
                 logger.debug(table.name)
                 d = utils.find_dependent_tables(table)
                 depends.update(list(d))
@@ -344,25 +927,22 @@ class CSVImporter(Importer):
             transaction.commit()
             transaction = connection.begin()
 
-            # update_every determines how many rows we will insert at
-            # a time and consequently how often we update the gui
-            update_every = 127
-
-            # import the tables one at a time, breaking every so often
-            # so the GUI can update
+            # create the tables, then load them
+            loads = []
             for table, filename in reversed(sorted_tables):
                 if self.__cancel or self.__error:
                     break
-                msg = _('importing %(table)s table from %(filename)s') \
-                    % {'table': table.name, 'filename': filename}
-                #log.info(msg)
-                bauble.task.set_message(msg)
                 yield  # allow progress bar update
 
                 # don't do anything if the file is empty:
-                if filesizes[filename] <= 1:
+                if not has_rows(filename):
+                    if not table.exists():
+                        create_table(table)
+                    continue
+                if incremental:
                     if not table.exists():
                         create_table(table)
+                    loads.append(TableLoad(table, filename, upsert=True))
                     continue
                 # check if the table was in the depends because they
                 # could have been dropped whereas table.exists() can
@@ -395,115 +975,98 @@ class CSVImporter(Importer):
                 if self.__cancel or self.__error:
                     break
 
-                # commit the drop of the table we're importing
-                transaction.commit()
-                transaction = connection.begin()
-
-                # open a temporary reader to get the column keys so we
-                # can later precompile our insert statement
-                f = open(filename, "rb")
-                tmp = UnicodeReader(f, quotechar=QUOTE_CHAR,
-                                    quoting=QUOTE_STYLE)
-                tmp.next()
-                csv_columns = set(tmp.reader.fieldnames)
-                del tmp
-                f.close()
-
-                # precompute the defaults...this assumes that the
-                # default function doesn't depend on state after each
-                # row...it shouldn't anyways since we do an insert
-                # many instead of each row at a time
-                defaults = {}
-                for column in table.c:
-                    if isinstance(column.default, ColumnDefault):
-                        defaults[column.name] = column.default.execute()
-                column_names = table.c.keys()
-
-                # check if there are any foreign keys to on the table
-                # that refer to itself, if so create a new file with
-                # the lines sorted in order of dependency so that we
-                # don't get errors about importing values into a
-                # foreign_key that don't reference and existin row
-                self_keys = filter(lambda f: f.column.table == table,
-                                   table.foreign_keys)
-                if self_keys:
-                    key_pairs = map(lambda x: (x.parent.name, x.column.name),
-                                    self_keys)
-                    filename = self._toposort_file(filename, key_pairs)
-
-                # the column keys for the insert are a union of the
-                # columns in the CSV file and the columns with
-                # defaults
-                column_keys = list(csv_columns.union(defaults.keys()))
-                insert = table.insert(bind=connection).\
-                    compile(column_keys=column_keys)
-
-                values = []
-
-                def do_insert():
-                    if values:
-                        connection.execute(insert, *values)
-                    del values[:]
-                    percent = float(steps_so_far)/float(total_lines)
-                    if 0 < percent < 1.0:
-                        pb_set_fraction(percent)
-
-                isempty = lambda v: v in ('', None)
-
-                f = open(filename, "rb")
-                reader = UnicodeReader(f, quotechar=QUOTE_CHAR,
-                                       quoting=QUOTE_STYLE)
-                # NOTE: we shouldn't get this far if the file doesn't
-                # have any rows to import but if so there is a chance
-                # that this loop could cause problems
-                for line in reader:
-                    while self.__pause:
-                        yield
-                    if self.__cancel or self.__error:
-                        break
-
-                    # fill in default values and None for "empty"
-                    # columns in line
-                    for column in table.c.keys():
-                        if column in defaults \
-                                and (column not in line
-                                     or isempty(line[column])):
-                            line[column] = defaults[column]
-                        elif column in line and isempty(line[column]):
-                            line[column] = None
-                        elif column in line and line[column] == 'False' and \
-                                isinstance(table.c[column].type, Boolean):
-                            # need bool value, not 'False' string
-                            line[column] = False
-                        elif column in line and line[column] == 'True' and \
-                                isinstance(table.c[column].type, Boolean):
-                            # need bool value, not 'True' string
-                            line[column] = True
-                            # in SA 0.5.5 and only on an SQLite
-                            # database the 'False' will import as True
-                            # for some reason whereas True will import
-                            # as True automatically...probably because
-                            # bool('False') == True
-                    values.append(line)
-                    steps_so_far += 1
-                    if steps_so_far % update_every == 0:
-                        do_insert()
-                        yield
+                # the indexes of a new table are faster created after
+                # its rows are loaded
+                deferred = []
+                if table.name in created_tables:
+                    deferred = list(table.indexes)
+                for index in deferred:
+                    index.drop(bind=connection)
+                loads.append(TableLoad(table, filename, deferred))
 
-                if self.__error or self.__cancel:
-                    break
+            # commit the drop of the tables we're importing
+            transaction.commit()
+            transaction = connection.begin()
 
-                # insert the remainder that were less than update every
-                do_insert()
+            def set_fraction():
+                done = sum(load.offset for load in loads)
+                percent = (empty_bytes + done) / total_bytes
+                if 0 < percent < 1.0:
+                    pb_set_fraction(percent)
+            empty_bytes = total_bytes - sum(csv_size(load.filename)
+                                            for load in loads)
+
+            # the tables loaded in parallel are committed one by one,
+            # only tables created by this import are, so that they can
+            # be emptied if the import fails, see _empty_tables
+            bind = metadata.bind
+            parallel = self.workers > 1 and can_load_in_parallel(bind) and \
+                not incremental and \
+                not [l for l in loads if l.table.name not in created_tables]
+            if parallel:
+                # each table on its own connection, once the tables it
+                # refers to are committed
+                msg = _('importing %(tables)s') % {
+                    'tables': ', '.join(load.table.name for load in loads)}
+                bauble.task.set_message(msg)
+                for step in self._load_parallel(bind, loads):
+                    set_fraction()
+                    yield
+            else:
+                for load in loads:
+                    msg = _('importing %(table)s table from %(filename)s') \
+                        % {'table': load.table.name,
+                           'filename': load.filename}
+                    bauble.task.set_message(msg)
+                    for step in self._load_table(connection, load):
+                        set_fraction()
+                        yield
+                    if self.__error or self.__cancel:
+                        break
+                    if incremental:
+                        # the delta is written in one transaction
+                        continue
+                    # we have commit after create after each table is
+                    # imported or Postgres will complain if two tables
+                    # that are being imported have a foreign key
+                    # relationship
+                    transaction.commit()
+                    transaction = connection.begin()
+
+            # the rows deleted since the previous incremental export,
+            # unless they are in this one
+            if incremental and not (self.__error or self.__cancel):
+                kept = dict((load.table.name, load.ids) for load in loads)
+                deleted = {}
+                if deleted_filename is not None:
+                    deleted = self._read_deleted(deleted_filename)
+                for name in set(kept).union(deleted):
+                    delta[name] = kept.get(name, set()).union(
+                        deleted.get(name, set()))
+                # the deleted distributions tell their species until
+                # they are gone
+                delta_species.update(_distribution_species(
+                    connection, metadata,
+                    delta.get('species_distribution', ())))
+                delta_species.update(delta.get('species', ()))
+                self._delete_rows(connection, metadata, deleted, kept)
+                yield
 
-                # we have commit after create after each table is imported
-                # or Postgres will complain if two tables that are
-                # being imported have a foreign key relationship
-                transaction.commit()
-                logger.debug('%s: %s' % (
-                    table.name,
-                    table.select().alias().count().execute().fetchone()[0]))
-                transaction = connection.begin()
+            # the tables created by the import hold the rows of their
+            # file and only those
+            if not (self.__error or self.__cancel):
+                for load in loads:
+                    if load.table.name not in created_tables:
+                        continue
+                    count = load.table.select().alias().count()
+                    nrows = connection.execute(count).scalar()
+                    logger.debug('%s: %s' % (load.table.name, nrows))
+                    if nrows != load.rows:
+                        raise BaubleError(
+                            _('%(table)s holds %(nrows)s rows after the '
+                              'import of %(rows)s rows from %(filename)s') %
+                            {'table': load.table.name, 'nrows': nrows,
+                             'rows': load.rows, 'filename': load.filename})
 
             logger.debug('creating: %s' % ', '.join([d.name for d in depends]))
             # TODO: need to get those tables from depends that need to
@@ -511,24 +1074,34 @@ class CSVImporter(Importer):
             metadata.create_all(connection, depends, checkfirst=True)
         except GeneratorExit, e:
             transaction.rollback()
+            if parallel:
+                self._empty_tables(metadata, loads)
             raise
         except Exception, e:
             logger.error(e)
             logger.error(traceback.format_exc())
             transaction.rollback()
+            if parallel:
+                self._empty_tables(metadata, loads)
             self.__error = True
             self.__error_exc = e
             raise
         else:
+            if parallel and (self.__error or self.__cancel):
+                self._empty_tables(metadata, loads)
             transaction.commit()
+        finally:
+            if pragmas is not None:
+                set_sqlite_pragmas(connection, pragmas)
 
         # unfortunately inserting an explicit value into a column that
         # has a sequence doesn't update the sequence, we shortcut this
-        # by setting the sequence manually to the max(column)+1
+        # by setting the sequence manually to the max(column)+1, only
+        # primary keys have a sequence
         col = None
         try:
             for table, filename in sorted_tables:
-                for col in table.c:
+                for col in table.primary_key.columns:
                     utils.reset_sequence(col)
         except Exception, e:
             col_name = None
@@ -542,6 +1115,56 @@ class CSVImporter(Importer):
                                          traceback.format_exc(),
                                          type=gtk.MESSAGE_ERROR)
 
+        # the tables whose derived values need an update, only those of
+        # the delta in an incremental import
+        if incremental:
+            imported = set(name for name, ids in delta.iteritems() if ids)
+        else:
+            imported = set(table.name for table, filename in sorted_tables)
+
+        # files exported by previous versions have no sort keys, or
+        # keys in an older format, and the rows are inserted bypassing
+        # the mappers
+        db.update_sort_keys(set(table for table, filename in sorted_tables
+                                if table.name in imported),
+                            only_missing=incremental)
+        db.statistics.invalidate()
+
+        # the geography closure and the distribution strings are
+        # derived from the imported rows
+        if 'PlantsPlugin' in pluginmgr.plugins and imported.intersection(
+                ['geography', 'species', 'species_distribution']):
+            from bauble.plugins.plants import update_distributions
+            from bauble.plugins.plants.species_model import \
+                update_distribution_strs
+            session = db.Session()
+            try:
+                if incremental and 'geography' not in imported:
+                    update_distribution_strs(session, delta_species)
+                else:
+                    update_distributions(session, force=True)
+                session.commit()
+            finally:
+                session.close()
+
+        # tagged objects exported by previous versions refer to their
+        # class by name
+        if 'TagPlugin' in pluginmgr.plugins and 'tagged_obj' in imported:
+            from bauble.plugins.tag import migrate_tagged_objects
+            session = db.Session()
+            try:
+                migrate_tagged_objects(session)
+                session.commit()
+            finally:
+                session.close()
+
+        # dropping and recreating the tables also dropped the triggers
+        # and indexes of the full text index, bring it back up to date,
+        # an incremental import drops no table and the triggers kept it
+        import bauble.fulltext as fulltext
+        if not incremental and fulltext.exists(metadata.bind):
+            fulltext.create(metadata.bind)
+
 # TODO: we don't use the progress dialog any more but we'll leave this
 # around to remind us when we support cancelling via the progress statusbar
 #
@@ -589,8 +1212,36 @@ class CSVImporter(Importer):
 # TODO: add support for exporting only specific tables
 
 class CSVExporter(object):
+    """
+    exports the tables of the database to comma separated value files,
+    one per table, named after the table, optionally compressed with
+    gzip.
+
+    The rows are fetched batch_size at a time, with a server side
+    cursor where the database has them, and written as they come, so
+    the memory used doesn't depend on the size of the tables.  Except
+    on SQLite, up to workers tables are exported at the same time, each
+    on its own connection.
+
+    Each export writes its :class:`Watermark`.  Given the watermark of
+    a previous export, an incremental export only writes the rows
+    changed since and lists the deleted rows in the _deleted file, for
+    CSVImporter with incremental=True.
+    """
+
+    ## the number of rows fetched at a time
+    batch_size = 5000
+
+    ## the number of tables exported at the same time, where the
+    ## database allows it, see can_load_in_parallel
+    workers = 4
 
-    def start(self, path=None):
+    def start(self, path=None, compress=False, since=None):
+        """
+        Export the database to the directory path, asking for it if
+        None, gzip compressed if compress, only the changes since the
+        :class:`Watermark` since if given.
+        """
         if path is None:
             d = gtk.FileChooserDialog(_("Select a directory"), None,
                                       gtk.FILE_CHOOSER_ACTION_SELECT_FOLDER,
@@ -608,16 +1259,88 @@ class CSVExporter(object):
         try:
             # TODO: should we support exporting other metadata
             # besides db.metadata
-            bauble.task.queue(self.__export_task(path))
+            bauble.task.queue(self.__export_task(path, compress, since))
         except Exception, e:
             logger.debug(e)
 
-    def __export_task(self, path):
+    def _export_table(self, connection, table, filename, since=None):
+        """
+        A generator writing the rows of table to filename, only those
+        changed since the Watermark since if given, yielding after each
+        batch_size rows.
+        """
+        stmt = table.select()
+        if since is not None and since.changed(table) is not None:
+            stmt = stmt.where(since.changed(table))
+        stmt = stmt.execution_options(stream_results=True)
+        f = open_csv(filename, 'wb')
+        try:
+            writer = UnicodeWriter(f, quotechar=QUOTE_CHAR,
+                                   quoting=QUOTE_STYLE)
+            writer.writerow(table.c.keys())  # the column names
+            result = connection.execute(stmt)
+            try:
+                rows = result.fetchmany(self.batch_size)
+                while rows:
+                    writer.writerows(rows)
+                    yield
+                    rows = result.fetchmany(self.batch_size)
+            finally:
+                result.close()
+        finally:
+            f.close()
+
+    def _export_parallel(self, engine, jobs, exported, since=None):
+        """
+        A generator exporting the (table, filename) jobs on up to
+        workers threads, yielding while they run.  The exported tables
+        are appended to exported.
+        """
+        import Queue
+        import threading
+        import time
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+        errors = []
+
+        def work():
+            connection = engine.connect()
+            try:
+                while not errors:
+                    try:
+                        table, filename = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    for step in self._export_table(connection, table,
+                                                   filename, since):
+                        pass
+                    exported.append(table)
+            except Exception, e:
+                logger.error(traceback.format_exc())
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work)
+                   for i in range(min(self.workers, len(jobs)))]
+        for thread in threads:
+            thread.start()
+        while [t for t in threads if t.isAlive()]:
+            yield
+            time.sleep(0.05)
+        if errors:
+            raise errors[0]
+
+    def __export_task(self, path, compress=False, since=None):
 #        if not os.path.exists(path):
 #            raise ValueError("CSVExporter: path does not exist.\n" + path)
-        filename_template = os.path.join(path, "%s.txt")
+        import time
+        if compress:
+            filename_template = os.path.join(path, "%s.txt.gz")
+        else:
+            filename_template = os.path.join(path, "%s.txt")
 #        timeout = tasklet.WaitForTimeout(12)
-        steps_so_far = 0
         ntables = 0
         for table in db.metadata.sorted_tables:
             ntables += 1
@@ -630,67 +1353,130 @@ class CSVExporter(object):
                 if utils.yes_no_dialog(msg):
                     return
 
-        def replace(s):
-            if isinstance(s, (str, unicode)):
-                s.replace('\n', '\\n')
-            return s
+        jobs = [(table, filename_template % table.name)
+                for table in db.metadata.sorted_tables]
+        exported = []
+        connection = db.engine.connect()
+        try:
+            # before any row is read, the changes made during the
+            # export are in the next one
+            watermark = Watermark.current(connection)
+            if not watermark.settled(connection):
+                bauble.task.set_message(
+                    _('waiting for the transactions in progress to end'))
+                while not watermark.settled(connection):
+                    yield
+                    time.sleep(0.1)
+            if since is not None:
+                self._export_deleted(connection, since,
+                                     filename_template % DELETED_FILE)
+            if self.workers > 1 and can_load_in_parallel(db.engine):
+                msg = _('exporting the tables to %s') % path
+                bauble.task.set_message(msg)
+                for step in self._export_parallel(db.engine, jobs, exported,
+                                                  since):
+                    pb_set_fraction(float(len(exported))/float(ntables))
+                    yield
+            else:
+                for table, filename in jobs:
+                    msg = _('exporting %(table)s table to %(filename)s')\
+                        % {'table': table.name, 'filename': filename}
+                    bauble.task.set_message(msg)
+                    logger.info("exporting %s" % table.name)
+                    for step in self._export_table(connection, table,
+                                                   filename, since):
+                        yield
+                    exported.append(table)
+                    pb_set_fraction(float(len(exported))/float(ntables))
+                    yield
+            watermark.write(path)
+        finally:
+            connection.close()
 
-        def write_csv(filename, rows):
-            f = open(filename, 'wb')
+    def _export_deleted(self, connection, since, filename):
+        """
+        Write the table name and the id of the rows deleted since the
+        Watermark since to filename.
+        """
+        f = open_csv(filename, 'wb')
+        try:
             writer = UnicodeWriter(f, quotechar=QUOTE_CHAR,
                                    quoting=QUOTE_STYLE)
-            writer.writerows(rows)
+            writer.writerow(['table_name', 'table_id'])
+            writer.writerows(connection.execute(since.deleted()))
+        finally:
             f.close()
 
-        update_every = 30
-        for table in db.metadata.sorted_tables:
-            filename = filename_template % table.name
-            steps_so_far += 1
-            fraction = float(steps_so_far)/float(ntables)
-            pb_set_fraction(fraction)
-            msg = _('exporting %(table)s table to %(filename)s')\
-                % {'table': table.name, 'filename': filename}
-            bauble.task.set_message(msg)
-            logger.info("exporting %s" % table.name)
-
-            # get the data
-            results = table.select().execute().fetchall()
-
-            # create empty files with only the column names
-            if len(results) == 0:
-                write_csv(filename, [table.c.keys()])
-                yield
-                continue
-
-            rows = []
-            rows.append(table.c.keys())  # append col names
-            ctr = 0
-            for row in results:
-                values = map(replace, row.values())
-                rows.append(values)
-                if ctr == update_every:
-                    yield
-                    ctr = 0
-                ctr += 1
-            write_csv(filename, rows)
+
+def _split_command_arg(arg, flags=(), options=()):
+    """
+    Split the argument of a command in its words, quoted as in a
+    shell, and return the set of the flags, the dictionary of the
+    option=value words and the list of the other words.
+    """
+    import shlex
+    found_flags = set()
+    found_options = {}
+    words = []
+    for word in shlex.split(utils.utf8(arg or '')):
+        name, sep, value = word.partition('=')
+        if word in flags:
+            found_flags.add(word)
+        elif sep and name in options:
+            found_options[name] = value
+        else:
+            words.append(word)
+    return found_flags, found_options, words
 
 
 class CSVImportCommandHandler(pluginmgr.CommandHandler):
+    """
+    :imcsv=[incremental] [FILE|DIRECTORY ...]
+
+    import the files, those in the directories, asking for them if
+    none, over the current data if incremental, see CSVImporter.start
+    """
 
     command = 'imcsv'
 
     def __call__(self, cmd, arg):
+        flags, options, words = _split_command_arg(arg, ['incremental'])
+        filenames = []
+        for word in words:
+            if os.path.isdir(word):
+                filenames.extend(os.path.join(word, name)
+                                 for name in sorted(os.listdir(word)))
+            else:
+                filenames.append(word)
         importer = CSVImporter()
-        importer.start(arg)
+        importer.start(filenames or None,
+                       incremental='incremental' in flags)
 
 
 class CSVExportCommandHandler(pluginmgr.CommandHandler):
+    """
+    :excsv=[compress] [since=PREVIOUS] [DIRECTORY]
+
+    export to the directory, asking for it if none, gzip compressed if
+    compress, only the changes since the export in the PREVIOUS
+    directory if given, see CSVExporter.start
+    """
 
     command = 'excsv'
 
     def __call__(self, cmd, arg):
+        flags, options, words = _split_command_arg(arg, ['compress'],
+                                                   ['since'])
+        if len(words) > 1:
+            utils.message_dialog(
+                _('usage: :excsv=[compress] [since=PREVIOUS] [DIRECTORY]'))
+            return
+        since = None
+        if 'since' in options:
+            since = Watermark.read(options['since'])
         exporter = CSVExporter()
-        exporter.start(arg)
+        exporter.start(words and words[0] or None,
+                       compress='compress' in flags, since=since)
 
 
 #
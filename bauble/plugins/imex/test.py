@@ -29,13 +29,16 @@ import tempfile
 from sqlalchemy import Column, Integer, Boolean
 
 import bauble.db as db
+from bauble.error import BaubleError
 from bauble.plugins.plants import (
     Familia, Family, Genus, Species, VernacularName)
 from bauble.plugins.garden import Accession, Location, Plant
 import bauble.plugins.garden.test as garden_test
 import bauble.plugins.plants.test as plants_test
+import bauble.plugins.imex.csv_ as csv_
 from bauble.plugins.imex.csv_ import CSVImporter, CSVExporter, QUOTE_CHAR, \
-    QUOTE_STYLE
+    QUOTE_STYLE, LineCounter, TableLoad, Watermark, csv_size, has_rows, \
+    sqlite_import_pragmas
 from bauble.plugins.imex.iojson import JSONImporter, JSONExporter
 from bauble.test import BaubleTestCase
 import json
@@ -199,6 +202,109 @@ class CSVTests(ImexTestCase):
         importer.start([filename], force=True)
         list(self.session.query(Family))
 
+    def test_import_in_batches(self):
+        """
+        Test that the rows are all imported when they are more than
+        batch_size, and that the lines are counted in bytes.
+        """
+        data = [{'id': i, 'family': u'Family%03d' % i}
+                for i in range(1, 26)]
+        filename = os.path.join(self.path, 'family.txt')
+        f = open(filename, 'wb')
+        format = {'delimiter': ',', 'quoting': QUOTE_STYLE,
+                  'quotechar': QUOTE_CHAR}
+        fields = data[0].keys()
+        f.write('%s\n' % ','.join(fields))
+        writer = csv.DictWriter(f, fields, **format)
+        writer.writerows(data)
+        f.close()
+        self.assertTrue(has_rows(filename))
+
+        f = open(filename, 'rb')
+        counter = LineCounter(f)
+        self.assertEquals(len(list(counter)), 26)
+        self.assertEquals(counter.offset, os.path.getsize(filename))
+        f.close()
+
+        importer = TestImporter()
+        importer.batch_size = 10
+        importer.start([filename], force=True)
+        ids = [r.id for r in self.session.query(Family).order_by(Family.id)]
+        self.assertEquals(ids, range(1, 26))
+
+        # only the header
+        f = open(filename, 'wb')
+        f.write('%s\n' % ','.join(fields))
+        f.close()
+        self.assertFalse(has_rows(filename))
+
+    def test_import_indexes_and_pragmas(self):
+        """
+        Test that the deferred indexes of the imported tables are
+        created and that the SQLite pragmas are restored.
+        """
+        pragmas = {}
+        if db.engine.name == 'sqlite':
+            for name in sqlite_import_pragmas:
+                pragmas[name] = db.engine.execute(
+                    'PRAGMA %s' % name).scalar()
+        filename = os.path.join(self.path, 'family.txt')
+        f = open(filename, 'wb')
+        format = {'delimiter': ',', 'quoting': QUOTE_STYLE,
+                  'quotechar': QUOTE_CHAR}
+        fields = family_data[0].keys()
+        f.write('%s\n' % ','.join(fields))
+        writer = csv.DictWriter(f, fields, **format)
+        writer.writerows(family_data)
+        f.close()
+        importer = TestImporter()
+        importer.start([filename], force=True)
+
+        from sqlalchemy.engine import reflection
+        inspector = reflection.Inspector.from_engine(db.engine)
+        names = set(i['name'] for i in inspector.get_indexes('family'))
+        for index in Family.__table__.indexes:
+            self.assertTrue(index.name in names, index.name)
+        for name, value in pragmas.iteritems():
+            self.assertEquals(
+                db.engine.execute('PRAGMA %s' % name).scalar(), value)
+
+    def test_load_parallel_order(self):
+        """
+        Test that the tables are loaded after the tables they refer to.
+        """
+        order = []
+
+        class OrderImporter(CSVImporter):
+            def _load_in_thread(self, engine, load):
+                order.append(load.table.name)
+                load.done = True
+
+        importer = OrderImporter()
+        importer.workers = 2
+        loads = [TableLoad(table, '%s.txt' % table.name)
+                 for table in (Species.__table__, Genus.__table__,
+                               Family.__table__, Location.__table__)]
+        list(importer._load_parallel(db.engine, loads))
+        self.assertEquals(sorted(order), sorted(['species', 'genus',
+                                                 'family', 'location']))
+        self.assertTrue(order.index('family') < order.index('genus') <
+                        order.index('species'))
+
+    def test_empty_tables(self):
+        """
+        Test that the tables of a failed parallel load are emptied, the
+        dependent ones first, and only those.
+        """
+        families = self.session.query(Family).count()
+        self.assertTrue(self.session.query(Genus).count())
+        loads = [TableLoad(table, '%s.txt' % table.name)
+                 for table in (Genus.__table__, Species.__table__)]
+        CSVImporter._empty_tables(db.metadata, loads)
+        self.assertEquals(self.session.query(Species).count(), 0)
+        self.assertEquals(self.session.query(Genus).count(), 0)
+        self.assertEquals(self.session.query(Family).count(), families)
+
     def test_import_use_defaultxxx(self):
         """
         Test that if we import from a csv file that doesn't include a
@@ -398,6 +504,129 @@ class CSVTests2(ImexTestCase):
                     if r.name.startswith("Gal")][0]
         self.assertEquals(row_name, data['name'])
 
+    def test_export_compressed(self):
+        """
+        Test that the gzip compressed export imports back.
+        """
+        import gzip
+        import tempfile
+        tempdir = tempfile.mkdtemp()
+        families = [(f.id, f.family) for f in self.session.query(Family)]
+        exporter = CSVExporter()
+        exporter.batch_size = 1
+        exporter.start(tempdir, compress=True)
+        filenames = [os.path.join(tempdir, name)
+                     for name in os.listdir(tempdir)]
+        self.assertTrue(filenames)
+        for filename in filenames:
+            if 'watermark' in filename:
+                continue
+            self.assertTrue(filename.endswith('.txt.gz'), filename)
+        filename = os.path.join(tempdir, 'family.txt.gz')
+        f = gzip.open(filename)
+        content = f.read()
+        f.close()
+        self.assertEquals(csv_size(filename), len(content))
+
+        importer = CSVImporter()
+        importer.start(filenames, force=True)
+        self.session.expunge_all()
+        self.assertEquals(
+            sorted((f.id, f.family) for f in self.session.query(Family)),
+            sorted(families))
+        shutil.rmtree(tempdir)
+
+    def test_incremental(self):
+        """
+        Test that an incremental export holds the rows changed and
+        deleted since the watermark, and that importing it over the
+        previous export gives the changed database.
+        """
+        import tempfile
+        full_path = tempfile.mkdtemp()
+        delta_path = tempfile.mkdtemp()
+        deleted = Family(family=u'Myrtaceae')
+        self.session.add(deleted)
+        self.session.commit()
+        deleted_id = deleted.id
+        CSVExporter().start(full_path)
+        watermark = Watermark.read(full_path)
+
+        family = self.session.query(Family).get(1)
+        family.family = u'Orchidaceae2'
+        added = Family(family=u'Rosaceae')
+        self.session.add(added)
+        self.session.delete(deleted)
+        self.session.commit()
+        changed_ids = [family.id, added.id]
+        CSVExporter().start(delta_path, since=watermark)
+
+        f = open(os.path.join(delta_path, 'family.txt'))
+        ids = [int(row['id']) for row in csv.DictReader(f)]
+        f.close()
+        self.assertEquals(sorted(ids), sorted(changed_ids))
+        f = open(os.path.join(delta_path, '_deleted.txt'))
+        rows = [(row['table_name'], int(row['table_id']))
+                for row in csv.DictReader(f)]
+        f.close()
+        self.assertTrue(('family', deleted_id) in rows)
+
+        # back to the previous export, then forward by the delta
+        importer = CSVImporter()
+        importer.start([os.path.join(full_path, name)
+                        for name in os.listdir(full_path)], force=True)
+        self.session.expunge_all()
+        self.assertTrue(self.session.query(Family).get(deleted_id))
+        importer = CSVImporter()
+        importer.start([os.path.join(delta_path, name)
+                        for name in os.listdir(delta_path)],
+                       incremental=True)
+        self.session.expunge_all()
+        self.assertEquals(self.session.query(Family).get(1).family,
+                          u'Orchidaceae2')
+        self.assertTrue(self.session.query(Family).get(changed_ids[1]))
+        self.assertEquals(self.session.query(Family).get(deleted_id), None)
+        self.assertEquals(self.session.query(Genus).count(),
+                          len(plants_test.genus_test_data))
+        shutil.rmtree(full_path)
+        shutil.rmtree(delta_path)
+
+    def test_incremental_needs_ids(self):
+        """
+        Test that a file without ids is refused by an incremental
+        import instead of adding its rows again.
+        """
+        import tempfile
+        path = tempfile.mkdtemp()
+        filename = os.path.join(path, 'family.txt')
+        f = open(filename, 'wb')
+        f.write('family\nRosaceae\n')
+        f.close()
+        count = self.session.query(Family).count()
+        importer = CSVImporter()
+        self.assertRaises(BaubleError, importer.start, [filename],
+                          incremental=True)
+        self.assertEquals(self.session.query(Family).count(), count)
+        shutil.rmtree(path)
+
+    def test_split_command_arg(self):
+        self.assertEquals(
+            csv_._split_command_arg(
+                u'compress since="/tmp/a b" /tmp/c', ['compress'],
+                ['since']),
+            (set(['compress']), {'since': '/tmp/a b'}, ['/tmp/c']))
+        self.assertEquals(csv_._split_command_arg(None),
+                          (set(), {}, []))
+
+    def test_copy_value(self):
+        # only the unquoted \N is NULL for COPY, the strings are quoted
+        self.assertEquals(csv_._copy_value(None), '\\N')
+        self.assertEquals(csv_._copy_value(u'\\N'), '"\\N"')
+        self.assertEquals(csv_._copy_value(u'a "b",\nc'),
+                          '"a ""b"",\nc"')
+        self.assertEquals(csv_._copy_value(True), '"true"')
+        self.assertEquals(csv_._copy_value(12), '"12"')
+
     def test_export(self):
         # 1. export the test data
         # 2. read the exported data into memory and make sure it matches
@@ -35,19 +35,23 @@
 import os
 import sys
 
+import logging
+logger = logging.getLogger(__name__)
+
 import bauble
 import bauble.db as db
+import bauble.fulltext as fulltext
 import bauble.paths as paths
 import bauble.pluginmgr as pluginmgr
 from bauble.plugins.plants.family import (
-    Familia, Family, FamilyInfoBox, FamilyEditor,
+    Familia, Family, FamilyNote, FamilyInfoBox, FamilyEditor,
     family_context_menu, family_markup_func)
 from bauble.plugins.plants.genus import (
-    Genus, GenusEditor, GenusInfoBox,
+    Genus, GenusNote, GenusEditor, GenusInfoBox,
     genus_context_menu, genus_markup_func,
     )
 from bauble.plugins.plants.species import (
-    Species, SpeciesEditorMenuItem, SpeciesInfoBox,
+    Species, SpeciesNote, SpeciesEditorMenuItem, SpeciesInfoBox,
     species_markup_func,
     species_context_menu, add_accession_action,
     SynonymSearch, SpeciesDistribution,
@@ -55,7 +59,9 @@ from bauble.plugins.plants.species import (
     vernname_context_menu, vernname_markup_func,
     )
 from bauble.plugins.plants.geography import (
-    Geography, get_species_in_geography)
+    Geography, get_species_in_geography, has_geography_closure,
+    rebuild_geography_closure)
+from bauble.plugins.plants.species_model import update_distribution_strs
 import bauble.search as search
 from bauble.view import SearchView
 from bauble.i18n import _
@@ -64,7 +70,29 @@ from bauble.i18n import _
 Familia, SpeciesDistribution,
 
 
+def update_distributions(session, force=False):
+    """
+    Fill the geography closure and the cached distribution strings of
+    the species, where they are missing or everywhere if force.  They
+    are missing in a database created by a previous version, see
+    PlantsPlugin.upgrade, and stale after rows were imported bypassing
+    the mappers.  DistributionExtension keeps them up to date
+    otherwise.
+    """
+    if force or not has_geography_closure(session):
+        n = rebuild_geography_closure(session)
+        logger.debug('geography closure: %s rows' % n)
+    strs = update_distribution_strs(session, only_missing=not force)
+    logger.debug('updated %s distribution strings' % len(strs))
+
+
 class PlantsPlugin(pluginmgr.Plugin):
+    commands = [fulltext.FullTextCommandHandler,
+                search.ProfileCommandHandler]
+
+    @classmethod
+    def upgrade(cls, session):
+        update_distributions(session)
 
     @classmethod
     def init(cls):
@@ -76,12 +104,15 @@ class PlantsPlugin(pluginmgr.Plugin):
 
         mapper_search.add_meta(('family', 'fam'), Family, ['family'])
         SearchView.row_meta[Family].set(children="genera",
+                                        children_count='genera',
                                         infobox=FamilyInfoBox,
                                         context_menu=family_context_menu,
                                         markup_func=family_markup_func)
 
-        mapper_search.add_meta(('genus', 'gen'), Genus, ['genus'])
+        mapper_search.add_meta(('genus', 'gen'), Genus, ['genus'],
+                               eager=['family'])
         SearchView.row_meta[Genus].set(children="species",
+                                       children_count='species',
                                        infobox=GenusInfoBox,
                                        context_menu=genus_context_menu,
                                        markup_func=genus_markup_func)
@@ -90,7 +121,8 @@ class PlantsPlugin(pluginmgr.Plugin):
         search.add_strategy(SynonymSearch)
         mapper_search.add_meta(('species', 'sp'), Species,
                                ['sp', 'sp2', 'infrasp1', 'infrasp2',
-                                'infrasp3', 'infrasp4'])
+                                'infrasp3', 'infrasp4'],
+                               eager=['genus.family', 'vernacular_names'])
         SearchView.row_meta[Species].set(
             children=partial(db.natsort, 'accessions'),
             infobox=SpeciesInfoBox,
@@ -98,7 +130,8 @@ class PlantsPlugin(pluginmgr.Plugin):
             markup_func=species_markup_func)
 
         mapper_search.add_meta(('vernacular', 'vern', 'common'),
-                               VernacularName, ['name'])
+                               VernacularName, ['name'],
+                               eager=['species.genus'])
         SearchView.row_meta[VernacularName].set(
             children=partial(db.natsort, 'species.accessions'),
             infobox=VernacularNameInfoBox,
@@ -108,6 +141,10 @@ class PlantsPlugin(pluginmgr.Plugin):
         mapper_search.add_meta(('geography', 'geo'), Geography, ['name'])
         SearchView.row_meta[Geography].set(children=get_species_in_geography)
 
+        mapper_search.add_notes(FamilyNote, 'family')
+        mapper_search.add_notes(GenusNote, 'genus')
+        mapper_search.add_notes(SpeciesNote, 'species')
+
         if bauble.gui is not None:
             bauble.gui.add_to_insert_menu(FamilyEditor, _('Family'))
             bauble.gui.add_to_insert_menu(GenusEditor, _('Genus'))
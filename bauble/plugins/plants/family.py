@@ -30,7 +30,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 from sqlalchemy import Column, Unicode, Integer, ForeignKey, \
-    UnicodeText, func, and_, UniqueConstraint, String
+    UnicodeText, func, and_, UniqueConstraint, String, distinct
 from sqlalchemy.orm import relation, backref, validates
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.exc import DBAPIError
@@ -121,7 +121,7 @@ def family_markup_func(family):
 #
 # Family
 #
-class Family(db.Base, db.Serializable):
+class Family(db.Base, db.Serializable, db.NaturalSortKey):
     """
     :Table name: family
 
@@ -677,6 +677,46 @@ from bauble.plugins.plants.genus import Genus
 from bauble.plugins.plants.species_model import Species
 
 
+def family_statistics(session, family_id):
+    """
+    Return a dict with the number of genera, species, accessions and
+    plants of the family with family_id, and of the genera, species and
+    accessions they belong to.  registered as the 'family' statistic of
+    :data:`bauble.db.statistics`.
+    """
+    stats = {}
+    stats['ngen'] = session.query(func.count(Genus.id)).\
+        filter(Genus.family_id == family_id).scalar()
+    stats['nsp'], stats['ngen_in_sp'] = session.\
+        query(func.count(Species.id),
+              func.count(distinct(Species.genus_id))).\
+        filter(Species.genus_id == Genus.id).\
+        filter(Genus.family_id == family_id).one()
+    if 'GardenPlugin' not in pluginmgr.plugins:
+        return stats
+
+    from bauble.plugins.garden.accession import Accession
+    from bauble.plugins.garden.plant import Plant
+    stats['nacc'], stats['nsp_in_acc'] = session.\
+        query(func.count(Accession.id),
+              func.count(distinct(Accession.species_id))).\
+        filter(Accession.species_id == Species.id).\
+        filter(Species.genus_id == Genus.id).\
+        filter(Genus.family_id == family_id).one()
+    stats['nplants'], stats['nacc_in_plants'] = session.\
+        query(func.count(Plant.id),
+              func.count(distinct(Plant.accession_id))).\
+        filter(Plant.accession_id == Accession.id).\
+        filter(Accession.species_id == Species.id).\
+        filter(Species.genus_id == Genus.id).\
+        filter(Genus.family_id == family_id).one()
+    return stats
+
+
+db.statistics.register('family', family_statistics,
+                       ['genus', 'species', 'accession', 'plant'])
+
+
 class GeneralFamilyExpander(InfoExpander):
     '''
     generic information about an family like number of genus, species,
@@ -737,56 +777,31 @@ class GeneralFamilyExpander(InfoExpander):
         self.current_obj = row
         self.widget_set_value('fam_name_data', '<big>%s</big>' % row,
                               markup=True)
-        session = db.Session()
-        # get the number of genera
-        ngen = session.query(Genus).filter_by(family_id=row.id).count()
-        self.widget_set_value('fam_ngen_data', ngen)
-
-        # get the number of species
-        nsp = (session.query(Species).join('genus').
-               filter_by(family_id=row.id).count())
-        if nsp == 0:
+        stats = db.statistics.get('family', row.id)
+        self.widget_set_value('fam_ngen_data', stats['ngen'])
+
+        if stats['nsp'] == 0:
             self.widget_set_value('fam_nsp_data', 0)
         else:
-            ngen_in_sp = (session.query(Species.genus_id).
-                          join('genus', 'family').
-                          filter_by(id=row.id).distinct().count())
             self.widget_set_value('fam_nsp_data', '%s in %s genera'
-                                  % (nsp, ngen_in_sp))
+                                  % (stats['nsp'], stats['ngen_in_sp']))
 
         # stop here if no GardenPlugin
         if 'GardenPlugin' not in pluginmgr.plugins:
             return
 
-        # get the number of accessions in the family
-        from bauble.plugins.garden.accession import Accession
-        from bauble.plugins.garden.plant import Plant
-
-        nacc = (session.query(Accession).
-                join('species', 'genus', 'family').
-                filter_by(id=row.id).count())
-        if nacc == 0:
-            self.widget_set_value('fam_nacc_data', nacc)
+        if stats['nacc'] == 0:
+            self.widget_set_value('fam_nacc_data', 0)
         else:
-            nsp_in_acc = (session.query(Accession.species_id).
-                          join('species', 'genus', 'family').
-                          filter_by(id=row.id).distinct().count())
             self.widget_set_value('fam_nacc_data', '%s in %s species'
-                                  % (nacc, nsp_in_acc))
-
-        # get the number of plants in the family
-        nplants = (session.query(Plant).
-                   join('accession', 'species', 'genus', 'family').
-                   filter_by(id=row.id).count())
-        if nplants == 0:
-            self.widget_set_value('fam_nplants_data', nplants)
+                                  % (stats['nacc'], stats['nsp_in_acc']))
+
+        if stats['nplants'] == 0:
+            self.widget_set_value('fam_nplants_data', 0)
         else:
-            nacc_in_plants = session.query(Plant.accession_id).\
-                join('accession', 'species', 'genus', 'family').\
-                filter_by(id=row.id).distinct().count()
             self.widget_set_value('fam_nplants_data', '%s in %s accessions'
-                                  % (nplants, nacc_in_plants))
-        session.close()
+                                  % (stats['nplants'],
+                                     stats['nacc_in_plants']))
 
 
 class SynonymsExpander(InfoExpander):
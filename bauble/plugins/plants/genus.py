@@ -33,7 +33,7 @@ logger = logging.getLogger(__name__)
 
 from sqlalchemy import (
     Column, Unicode, Integer, ForeignKey, UnicodeText, String,
-    UniqueConstraint, func, and_)
+    UniqueConstraint, func, and_, distinct)
 from sqlalchemy.orm import relation, backref, validates
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.exc import DBAPIError
@@ -127,7 +127,7 @@ def genus_markup_func(genus):
     return utils.xml_safe(genus), utils.xml_safe(genus.family)
 
 
-class Genus(db.Base, db.Serializable):
+class Genus(db.Base, db.Serializable, db.NaturalSortKey):
     """
     :Table name: genus
 
@@ -170,6 +170,9 @@ class Genus(db.Base, db.Serializable):
     rank = 'genus'
     link_keys = ['accepted']
 
+    # the species strings include the genus name
+    sort_key_dependents = ['species']
+
     @property
     def cites(self):
         '''the cites status of this taxon, or None
@@ -858,6 +861,39 @@ class LinksExpander(view.LinksExpander):
         self.tropicos_button.set_keywords(genus=row.genus, species='')
 
 
+def genus_statistics(session, genus_id):
+    """
+    Return a dict with the number of species, accessions and plants of
+    the genus with genus_id, and of the species and accessions they
+    belong to.  registered as the 'genus' statistic of
+    :data:`bauble.db.statistics`.
+    """
+    stats = {}
+    stats['nsp'] = session.query(func.count(Species.id)).\
+        filter(Species.genus_id == genus_id).scalar()
+    if 'GardenPlugin' not in pluginmgr.plugins:
+        return stats
+
+    from bauble.plugins.garden.accession import Accession
+    from bauble.plugins.garden.plant import Plant
+    stats['nacc'], stats['nsp_in_acc'] = session.\
+        query(func.count(Accession.id),
+              func.count(distinct(Accession.species_id))).\
+        filter(Accession.species_id == Species.id).\
+        filter(Species.genus_id == genus_id).one()
+    stats['nplants'], stats['nacc_in_plants'] = session.\
+        query(func.count(Plant.id),
+              func.count(distinct(Plant.accession_id))).\
+        filter(Plant.accession_id == Accession.id).\
+        filter(Accession.species_id == Species.id).\
+        filter(Species.genus_id == genus_id).one()
+    return stats
+
+
+db.statistics.register('genus', genus_statistics,
+                       ['species', 'accession', 'plant'])
+
+
 class GeneralGenusExpander(InfoExpander):
     '''
     expander to present general information about a genus
@@ -909,7 +945,6 @@ class GeneralGenusExpander(InfoExpander):
 
         :param row: the row to get the values from
         '''
-        session = db.Session()
         self.current_obj = row
         self.widget_set_value('gen_name_data', '<big>%s</big> %s' %
                               (row, utils.xml_safe(unicode(row.author))),
@@ -917,45 +952,25 @@ class GeneralGenusExpander(InfoExpander):
         self.widget_set_value('gen_fam_data',
                               (utils.xml_safe(unicode(row.family))))
 
-        # get the number of species
-        nsp = (session.query(Species).
-               join('genus').
-               filter_by(id=row.id).count())
-        self.widget_set_value('gen_nsp_data', nsp)
+        stats = db.statistics.get('genus', row.id)
+        self.widget_set_value('gen_nsp_data', stats['nsp'])
 
         # stop here if no GardenPlugin
         if 'GardenPlugin' not in pluginmgr.plugins:
             return
 
-        from bauble.plugins.garden.accession import Accession
-        from bauble.plugins.garden.plant import Plant
-
-        # get number of accessions
-        nacc = (session.query(Accession).
-                join('species', 'genus').
-                filter_by(id=row.id).count())
-        if nacc == 0:
-            self.widget_set_value('gen_nacc_data', nacc)
+        if stats['nacc'] == 0:
+            self.widget_set_value('gen_nacc_data', 0)
         else:
-            nsp_in_acc = (session.query(Accession.species_id).
-                          join('species', 'genus').
-                          filter_by(id=row.id).distinct().count())
             self.widget_set_value('gen_nacc_data', '%s in %s species'
-                                  % (nacc, nsp_in_acc))
-
-        # get the number of plants in the genus
-        nplants = (session.query(Plant).
-                   join('accession', 'species', 'genus').
-                   filter_by(id=row.id).count())
-        if nplants == 0:
-            self.widget_set_value('gen_nplants_data', nplants)
+                                  % (stats['nacc'], stats['nsp_in_acc']))
+
+        if stats['nplants'] == 0:
+            self.widget_set_value('gen_nplants_data', 0)
         else:
-            nacc_in_plants = (session.query(Plant.accession_id).
-                              join('accession', 'species', 'genus').
-                              filter_by(id=row.id).distinct().count())
             self.widget_set_value('gen_nplants_data', '%s in %s accessions'
-                                  % (nplants, nacc_in_plants))
-        session.close()
+                                  % (stats['nplants'],
+                                     stats['nacc_in_plants']))
 
 
 class SynonymsExpander(InfoExpander):
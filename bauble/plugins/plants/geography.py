@@ -24,41 +24,134 @@ from operator import itemgetter
 
 import gtk
 
-from sqlalchemy import select, Column, Unicode, String, Integer, ForeignKey
+from sqlalchemy import select, text, and_, Column, Unicode, String, \
+    Integer, ForeignKey, Index
 from sqlalchemy.orm import object_session, relation, backref
 
 import bauble.db as db
+from bauble.plugins.plants.species_model import SpeciesDistribution
+
+
+## the species with a distribution in the geography :geo_id or in any
+## of its descendants, in one statement
+_species_in_geography_sql = """
+WITH RECURSIVE descendant(id) AS (
+    SELECT :geo_id
+    UNION
+    SELECT geography.id FROM geography
+    JOIN descendant ON geography.parent_id = descendant.id
+)
+SELECT species.* FROM species
+WHERE species.id IN (
+    SELECT species_distribution.species_id FROM species_distribution
+    JOIN descendant ON species_distribution.geography_id = descendant.id)
+ORDER BY species._sort_key, species.id
+"""
+
+
+def has_recursive_cte(engine):
+    """
+    Tell whether the database of engine understands WITH RECURSIVE.
+    """
+    if engine.name in ('postgres', 'postgresql'):
+        return True
+    if engine.name == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 8, 3)
+    return False
+
+
+def get_geography_descendants(session, geo_id):
+    """
+    Return the set of the ids of the geography with geo_id and of all
+    its descendants, with one query per level of the hierarchy.
+    """
+    geo_table = Geography.__table__
+    ids = set([geo_id])
+    level = [geo_id]
+    while level:
+        stmt = select([geo_table.c.id], geo_table.c.parent_id.in_(level))
+        level = [r[0] for r in session.execute(stmt) if r[0] not in ids]
+        ids.update(level)
+    return ids
+
+
+def rebuild_geography_closure(session):
+    """
+    Fill the geography_closure table from the parent_id of the
+    geographies, replacing its rows.
+
+    the hierarchy is read in one query and walked in memory, the rows
+    are written with one executemany INSERT.  Return the number of
+    rows.
+    """
+    geo_table = Geography.__table__
+    closure_table = GeographyClosure.__table__
+    parents = dict(session.execute(select([geo_table.c.id,
+                                           geo_table.c.parent_id])))
+    rows = []
+    for geo_id in parents:
+        ancestor_id, depth, seen = geo_id, 0, set()
+        # seen guards against a loop in the data
+        while ancestor_id is not None and ancestor_id not in seen:
+            seen.add(ancestor_id)
+            rows.append({'ancestor_id': ancestor_id,
+                         'descendant_id': geo_id,
+                         'depth': depth})
+            ancestor_id, depth = parents.get(ancestor_id), depth + 1
+    session.execute(closure_table.delete())
+    if rows:
+        session.execute(closure_table.insert(), rows)
+    return len(rows)
+
+
+def has_geography_closure(session):
+    """
+    Tell whether the geography_closure table has been filled.
+    """
+    closure_table = GeographyClosure.__table__
+    stmt = select([closure_table.c.id]).limit(1)
+    return session.execute(stmt).fetchone() is not None
 
 
 def get_species_in_geography(geo):
     """
-    Return all the Species that have distribution in geo
+    Return all the Species that have distribution in geo or in any of
+    its descendants.
+
+    the descendants are looked up in the geography_closure table, so
+    that the species are fetched in one statement by index.  until the
+    table is filled they are walked by a recursive common table
+    expression, where the database doesn't support it the descendants
+    are fetched one level of the hierarchy at a time.
     """
     session = object_session(geo)
     if not session:
-        ValueError('get_species_in_geography(): geography is not in a session')
-
-    # get all the geography children under geo
-    from bauble.plugins.plants.species_model import SpeciesDistribution, \
-        Species
-    # get the children of geo
-    geo_table = geo.__table__
-    master_ids = set([geo.id])
-    # populate master_ids with all the geography ids that represent
-    # the children of particular geography id
-
-    def get_geography_children(parent_id):
-        stmt = select([geo_table.c.id], geo_table.c.parent_id == parent_id)
-        kids = [r[0] for r in db.engine.execute(stmt).fetchall()]
-        for kid in kids:
-            grand_kids = get_geography_children(kid)
-            master_ids.update(grand_kids)
-        return kids
-    geokids = get_geography_children(geo.id)
-    master_ids.update(geokids)
-    q = session.query(Species).join(SpeciesDistribution).\
-        filter(SpeciesDistribution.geography_id.in_(master_ids))
-    return list(q)
+        raise ValueError('get_species_in_geography(): geography is not '
+                         'in a session')
+
+    from bauble.plugins.plants.species_model import Species
+    dist_table = SpeciesDistribution.__table__
+    if has_geography_closure(session):
+        closure_table = GeographyClosure.__table__
+        species_ids = select(
+            [dist_table.c.species_id],
+            and_(dist_table.c.geography_id == closure_table.c.descendant_id,
+                 closure_table.c.ancestor_id == geo.id))
+        q = session.query(Species).filter(Species.id.in_(species_ids)).\
+            order_by(Species._sort_key, Species.id)
+        return q.all()
+    if has_recursive_cte(session.bind or db.engine):
+        query = session.query(Species).\
+            from_statement(text(_species_in_geography_sql)).\
+            params(geo_id=geo.id)
+        return query.all()
+    master_ids = get_geography_descendants(session, geo.id)
+    species_ids = select([dist_table.c.species_id],
+                         dist_table.c.geography_id.in_(master_ids))
+    q = session.query(Species).filter(Species.id.in_(species_ids)).\
+        order_by(Species._sort_key, Species.id)
+    return q.all()
 
 
 class GeographyMenu(gtk.Menu):
@@ -171,7 +264,7 @@ class Geography(db.Base):
     __tablename__ = 'geography'
 
     # columns
-    name = Column(Unicode(255), nullable=False)
+    name = Column(Unicode(255), nullable=False, index=True)
     tdwg_code = Column(String(6))
     iso_code = Column(String(7))
     parent_id = Column(Integer, ForeignKey('geography.id'))
@@ -180,6 +273,43 @@ class Geography(db.Base):
         return self.name
 
 
+class GeographyClosure(db.Base):
+    """
+    The transitive closure of the geography hierarchy, one row for
+    each geography and each of its ancestors, itself included.  It is
+    derived from Geography.parent_id by
+    :func:`rebuild_geography_closure`.
+
+    :Table name: geography_closure
+
+    :Columns:
+        *ancestor_id*:
+
+        *descendant_id*:
+
+        *depth*:
+            the number of levels between the two, 0 for the row of a
+            geography with itself
+
+    :Properties:
+
+    :Constraints:
+    """
+    __tablename__ = 'geography_closure'
+
+    # columns
+    ancestor_id = Column(Integer, ForeignKey('geography.id'), nullable=False)
+    descendant_id = Column(Integer, ForeignKey('geography.id'),
+                           nullable=False, index=True)
+    depth = Column(Integer, nullable=False)
+
+
+# the lookup of the descendants of a geography
+Index('ix_geography_closure_ancestor_id_descendant_id',
+      GeographyClosure.__table__.c.ancestor_id,
+      GeographyClosure.__table__.c.descendant_id)
+
+
 # late bindings
 Geography.children = relation(
     Geography,
@@ -188,3 +318,13 @@ Geography.children = relation(
     backref=backref("parent",
                     remote_side=[Geography.__table__.c.id]),
     order_by=[Geography.name])
+
+## Geography.ancestors lets a search match a geography or any of its
+## descendants, like `species where distribution.geography.ancestors.name
+## = Europe`
+Geography.ancestors = relation(
+    Geography,
+    secondary=GeographyClosure.__table__,
+    primaryjoin=Geography.id == GeographyClosure.__table__.c.descendant_id,
+    secondaryjoin=Geography.id == GeographyClosure.__table__.c.ancestor_id,
+    viewonly=True)
@@ -28,6 +28,8 @@ logger = logging.getLogger(__name__)
 import os
 import traceback
 
+from sqlalchemy import func, distinct, select
+
 import bauble
 import bauble.paths as paths
 import bauble.db as db
@@ -190,6 +192,35 @@ class SynonymSearch(search.SearchStrategy):
                 results.extend([syn.species for syn in q])
         return results
 
+    def get_sources(self, text, session):
+        """
+        Return the QuerySource objects selecting the accepted species and
+        genera of the species and genera found by MapperSearch.
+
+        the synonyms are joined to the ids the MapperSearch query selects,
+        so that no result of MapperSearch is loaded, and objects already
+        found by MapperSearch are left out.
+        """
+        from genus import Genus, GenusSynonym
+        if not prefs[self.return_synonyms_pref]:
+            return []
+        synonyms = {Species: (SpeciesSynonym.species_id,
+                              SpeciesSynonym.synonym_id),
+                    Genus: (GenusSynonym.genus_id, GenusSynonym.synonym_id)}
+        mapper_search = search.get_strategy('MapperSearch')
+        sources = []
+        for cls, ids in mapper_search.get_ids(text, session):
+            if cls not in synonyms:
+                continue
+            accepted_id, synonym_id = synonyms[cls]
+            accepted = select([accepted_id], synonym_id.in_(ids))
+            query = session.query(cls).filter(cls.id.in_(accepted)).\
+                filter(~cls.id.in_(ids))
+            sources.append(search.QuerySource(
+                cls, query, mapper_search.get_order_by(cls),
+                options=mapper_search.get_eager(cls)))
+        return sources
+
 
 #
 # Species infobox for SearchView
@@ -293,6 +324,30 @@ class SynonymsExpander(InfoExpander):
             self.set_expanded(True)
 
 
+def species_statistics(session, species_id):
+    """
+    Return a dict with the number of accessions and plants of the
+    species with species_id, and of the accessions the plants belong
+    to.  registered as the 'species' statistic of
+    :data:`bauble.db.statistics`, only used with the GardenPlugin.
+    """
+    from bauble.plugins.garden.accession import Accession
+    from bauble.plugins.garden.plant import Plant
+    stats = {}
+    stats['nacc'] = session.query(func.count(Accession.id)).\
+        filter(Accession.species_id == species_id).scalar()
+    stats['nplants'], stats['nacc_in_plants'] = session.\
+        query(func.count(Plant.id),
+              func.count(distinct(Plant.accession_id))).\
+        filter(Plant.accession_id == Accession.id).\
+        filter(Accession.species_id == species_id).one()
+    return stats
+
+
+db.statistics.register('species', species_statistics,
+                       ['accession', 'plant'])
+
+
 class GeneralSpeciesExpander(InfoExpander):
     '''
     expander to present general information about a species
@@ -339,7 +394,6 @@ class GeneralSpeciesExpander(InfoExpander):
         # can be clickable but still respect the text wrap to wrap
         # around and indent from the genus name instead of from the
         # species name
-        session = db.Session()
         self.widget_set_value('sp_name_data', '<big>%s</big>' %
                               row.markup(True), markup=True)
 
@@ -378,24 +432,15 @@ class GeneralSpeciesExpander(InfoExpander):
         if 'GardenPlugin' not in pluginmgr.plugins:
             return
 
-        from bauble.plugins.garden.accession import Accession
-        from bauble.plugins.garden.plant import Plant
+        stats = db.statistics.get('species', row.id)
+        self.widget_set_value('sp_nacc_data', stats['nacc'])
 
-        nacc = session.query(Accession).join('species').\
-            filter_by(id=row.id).count()
-        self.widget_set_value('sp_nacc_data', nacc)
-
-        nplants = session.query(Plant).join('accession', 'species').\
-            filter_by(id=row.id).count()
-        if nplants == 0:
-            self.widget_set_value('sp_nplants_data', nplants)
+        if stats['nplants'] == 0:
+            self.widget_set_value('sp_nplants_data', 0)
         else:
-            nacc_in_plants = session.query(Plant.accession_id).\
-                join('accession', 'species').\
-                filter_by(id=row.id).distinct().count()
             self.widget_set_value('sp_nplants_data', '%s in %s accessions'
-                                  % (nplants, nacc_in_plants))
-        session.close()
+                                  % (stats['nplants'],
+                                     stats['nacc_in_plants']))
 
 
 class LinksExpander(view.LinksExpander):
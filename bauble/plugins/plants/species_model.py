@@ -27,8 +27,10 @@ logger = logging.getLogger(__name__)
 from sqlalchemy.ext.associationproxy import association_proxy
 
 from sqlalchemy import Column, Boolean, Unicode, Integer, ForeignKey, \
-    UnicodeText, func, UniqueConstraint
-from sqlalchemy.orm import relation, backref
+    UnicodeText, func, UniqueConstraint, and_, bindparam, select
+from sqlalchemy.orm import relation, backref, class_mapper, object_session, \
+    MapperExtension
+from sqlalchemy.orm.attributes import get_history, set_committed_value
 import bauble.db as db
 import bauble.error as error
 import bauble.utils as utils
@@ -71,7 +73,8 @@ infrasp_rank_values = {u'subsp.': _('subsp.'),
 # make sure that at least one of the specific epithet, cultivar name
 # or cultivar group is specificed
 
-class Species(db.Base, db.Serializable, db.DefiningPictures):
+class Species(db.Base, db.Serializable, db.DefiningPictures,
+              db.NaturalSortKey):
     """
     :Table name: species
 
@@ -117,6 +120,11 @@ class Species(db.Base, db.Serializable, db.DefiningPictures):
             This field is optional and can be used for the label in case
             str(self.distribution) is too long to fit on the label.
 
+        *_distribution_str*:
+            UnicodeText
+            The value of distribution_str(), kept up to date by
+            :class:`DistributionExtension`.
+
     :Properties:
         *accessions*:
 
@@ -224,6 +232,7 @@ class Species(db.Base, db.Serializable, db.DefiningPictures):
 
     label_distribution = Column(UnicodeText)
     bc_distribution = Column(UnicodeText)
+    _distribution_str = Column(UnicodeText)
 
     # relations
     synonyms = association_proxy('_synonyms', 'synonym')
@@ -294,11 +303,17 @@ class Species(db.Base, db.Serializable, db.DefiningPictures):
                                        _del_default_vernacular_name)
 
     def distribution_str(self):
+        '''
+        returns the sorted, comma separated names of the geographies in
+        the distribution of this species, as cached in the database
+        '''
+        if self._distribution_str is not None:
+            return self._distribution_str
         if self.distribution is None:
             return ''
         else:
-            dist = ['%s' % d for d in self.distribution]
-            return unicode(', ').join(sorted(dist))
+            return format_distribution(
+                utils.to_unicode(d) for d in self.distribution)
 
     def markup(self, authors=False):
         '''
@@ -610,6 +625,16 @@ class VernacularName(db.Base, db.Serializable):
         'user wants the species, not just the name'
         return self.species
 
+    @classmethod
+    def replacement_column(cls):
+        '''the class and id column of replacement(), usable in SQL
+
+        lets the value list search select the species straight from the
+        vernacular_name table, instead of calling replacement() on each
+        hydrated result.
+        '''
+        return Species, cls.__table__.c.species_id
+
     def as_dict(self):
         result = db.Serializable.as_dict(self)
         result['species'] = str(self.species)
@@ -685,6 +710,89 @@ class DefaultVernacularName(db.Base):
         return str(self.vernacular_name)
 
 
+def format_distribution(names):
+    """
+    Return the names of the geographies of a distribution, sorted and
+    comma separated.
+    """
+    return u', '.join(sorted(names))
+
+
+def update_distribution_strs(bind, species_ids=None, only_missing=False):
+    """
+    Recompute the cached distribution string of the species with
+    species_ids, of all the species if None, only of those without one
+    if only_missing.
+
+    bind is a session or a connection, the names are fetched 500
+    species at a time and the values are written with one executemany
+    UPDATE, bypassing the mapper extensions, so the history is not
+    involved.
+
+    Return a dictionary of the new strings by species id.
+    """
+    species_table = Species.__table__
+    dist_table = SpeciesDistribution.__table__
+    geo_table = db.metadata.tables['geography']
+    if species_ids is None:
+        stmt = select([species_table.c.id])
+        if only_missing:
+            stmt = stmt.where(species_table.c._distribution_str == None)
+        species_ids = [r[0] for r in bind.execute(stmt)]
+    names = dict((species_id, []) for species_id in species_ids)
+    ids = names.keys()
+    for start in range(0, len(ids), 500):
+        stmt = select([dist_table.c.species_id, geo_table.c.name],
+                      and_(dist_table.c.geography_id == geo_table.c.id,
+                           dist_table.c.species_id.in_(
+                               ids[start:start+500])))
+        for species_id, name in bind.execute(stmt):
+            names[species_id].append(name)
+    strs = dict((species_id, format_distribution(n))
+                for species_id, n in names.iteritems())
+    if strs:
+        bind.execute(species_table.update().
+                     where(species_table.c.id == bindparam('b_id')).
+                     values(_distribution_str=bindparam('b_dist')),
+                     [{'b_id': species_id, 'b_dist': value}
+                      for species_id, value in strs.iteritems()])
+    return strs
+
+
+class DistributionExtension(MapperExtension):
+    """
+    DistributionExtension is the
+    :class:`~sqlalchemy.orm.interfaces.MapperExtension` of
+    :class:`SpeciesDistribution`, it updates the cached distribution
+    string of the species of the inserted, updated or deleted
+    distributions, in the database and in the species in the session.
+    """
+    def _update(self, connection, instance):
+        added, unchanged, deleted = get_history(instance, 'species_id')
+        species_ids = set([instance.species_id])
+        species_ids.update(deleted or [])
+        species_ids.discard(None)
+        strs = update_distribution_strs(connection, species_ids)
+        session = object_session(instance)
+        if session is None:
+            return
+        mapper = class_mapper(Species)
+        for species_id, value in strs.iteritems():
+            key = mapper.identity_key_from_primary_key([species_id])
+            species = session.identity_map.get(key)
+            if species is not None:
+                set_committed_value(species, '_distribution_str', value)
+
+    def after_insert(self, mapper, connection, instance):
+        self._update(connection, instance)
+
+    def after_update(self, mapper, connection, instance):
+        self._update(connection, instance)
+
+    def after_delete(self, mapper, connection, instance):
+        self._update(connection, instance)
+
+
 class SpeciesDistribution(db.Base):
     """
     :Table name: species_distribution
@@ -692,14 +800,20 @@ class SpeciesDistribution(db.Base):
     :Columns:
 
     :Properties:
+        *geography*:
+            the :class:`Geography`, a search joins it explicitly, like
+            `species where distribution.geography.name = Mexico`
 
     :Constraints:
     """
     __tablename__ = 'species_distribution'
+    __mapper_args__ = {'extension': [DistributionExtension()]}
 
     # columns
-    geography_id = Column(Integer, ForeignKey('geography.id'), nullable=False)
-    species_id = Column(Integer, ForeignKey('species.id'), nullable=False)
+    geography_id = Column(Integer, ForeignKey('geography.id'), nullable=False,
+                          index=True)
+    species_id = Column(Integer, ForeignKey('species.id'), nullable=False,
+                        index=True)
 
     def __str__(self):
         return str(self.geography)
@@ -30,6 +30,7 @@ from nose import SkipTest
 
 import bauble.utils as utils
 import bauble.db as db
+import bauble.search as search
 from bauble.plugins.plants.species import (
     Species, VernacularName, SpeciesSynonym, edit_species,
     DefaultVernacularName, SpeciesDistribution, SpeciesNote)
@@ -37,7 +38,8 @@ from bauble.plugins.plants.family import (
     Family, FamilySynonym, FamilyEditor, FamilyNote)
 from bauble.plugins.plants.genus import \
     Genus, GenusSynonym, GenusEditor, GenusNote
-from bauble.plugins.plants.geography import Geography, get_species_in_geography
+from bauble.plugins.plants.geography import Geography, GeographyClosure, \
+    get_species_in_geography, get_geography_descendants
 from bauble.test import BaubleTestCase, check_dupids
 
 from functools import partial
@@ -628,6 +630,29 @@ class GenusTests(PlantTestCase):
         assert utils.gc_objects_by_type('GenusEditorView') == [], \
             'GenusEditorView not deleted'
 
+    def test_sort_key(self):
+        family = Family(family=u'family')
+        genus = Genus(family=family, genus=u'genus10')
+        sp = Species(genus=genus, sp=u'sp')
+        self.session.add_all([family, genus, sp])
+        self.session.commit()
+        self.assertEqual(genus._sort_key, utils.natsort_string(u'genus10'))
+
+        # renaming the genus updates the key of its species
+        genus.genus = u'genus2'
+        self.session.commit()
+        self.assertEqual(sp._sort_key, sp.compute_sort_key())
+        self.assertTrue(u'genus000000000002' in sp._sort_key)
+        self.session.expire_all()
+        self.assertEqual(sp._sort_key, sp.compute_sort_key())
+
+        # the species are not loaded when the key of the genus is the same
+        self.session.expire(genus, ['species'])
+        genus.author = u'L.'
+        self.session.flush()
+        self.assertFalse('species' in genus.__dict__)
+        self.session.commit()
+
 
 class GenusSynonymyTests(PlantTestCase):
 
@@ -1018,6 +1043,57 @@ class GeographyTests(PlantTestCase):
         species = get_species_in_geography(north_america)
         self.assert_([s.id for s in species] == [sp1.id, sp2.id, sp3.id])
 
+        # the level by level walk, where WITH RECURSIVE isn't available
+        ids = get_geography_descendants(self.session, mexico_id)
+        self.assertTrue(set([mexico_id, mexico_central_id,
+                             oaxaca_id]).issubset(ids))
+        self.assertFalse(western_canada_id in ids)
+
+        # the csv import filled the closure
+        q = self.session.query(GeographyClosure.descendant_id).\
+            filter_by(ancestor_id=mexico_id)
+        self.assertEquals(set(r[0] for r in q), ids)
+        q = self.session.query(GeographyClosure.depth).\
+            filter_by(ancestor_id=mexico_id, descendant_id=mexico_id)
+        self.assertEquals(q.one()[0], 0)
+
+        # searching the species by the geographies
+        results = search.search(
+            u'species where distribution.geography.name = Oaxaca', self.session)
+        self.assertEquals([s.id for s in results], [sp2.id])
+        results = search.search(
+            u'species where distribution.geography.ancestors.name = Mexico',
+            self.session)
+        self.assertEquals(sorted(s.id for s in results), [sp1.id, sp2.id])
+
+    def test_distribution_str(self):
+        import bauble.paths as paths
+        filename = os.path.join(paths.lib_dir(), "plugins", "plants",
+                                "default", 'geography.txt')
+        from bauble.plugins.imex.csv_ import CSVImporter
+        importer = CSVImporter()
+        importer.start([filename], force=True)
+
+        mexico_central_id = 267
+        oaxaca_id = 665
+        sp = Species(genus=self.genus, sp=u'sp')
+        sp.distribution.append(
+            SpeciesDistribution(geography_id=mexico_central_id))
+        self.session.add(sp)
+        self.session.commit()
+        self.assertEquals(sp._distribution_str, u'Mexico Central')
+
+        # updated when a distribution is added or deleted
+        oaxaca = SpeciesDistribution(geography_id=oaxaca_id)
+        sp.distribution.append(oaxaca)
+        self.session.commit()
+        self.assertEquals(sp.distribution_str(), u'Mexico Central, Oaxaca')
+        self.session.delete(oaxaca)
+        self.session.commit()
+        self.assertEquals(sp.distribution_str(), u'Mexico Central')
+        self.session.expire_all()
+        self.assertEquals(sp._distribution_str, u'Mexico Central')
+
 
 # TODO: maybe the following could be in a seperate file called
 # profile.py or something that would profile everything in the plants
@@ -32,10 +32,10 @@ logger = logging.getLogger(__name__)
 #logger.setLevel(logging.DEBUG)
 
 from sqlalchemy import (
-    Column, Unicode, UnicodeText, Integer, String, ForeignKey)
+    Column, Unicode, UnicodeText, Integer, String, ForeignKey, Index)
 from sqlalchemy.orm import relation
 from sqlalchemy.orm.exc import DetachedInstanceError
-from sqlalchemy import and_
+from sqlalchemy import and_, distinct, func, select
 from sqlalchemy.exc import DBAPIError, InvalidRequestError
 
 from bauble.i18n import _
@@ -299,13 +299,31 @@ class Tag(db.Base):
         if session is None:
             from sqlalchemy.orm.session import object_session
             session = object_session(obj)
-        modname = type(obj).__module__
-        clsname = type(obj).__name__
-        full_cls_name = '%s.%s' % (modname, clsname)
-        qto = session.query(TaggedObj).filter(
-            TaggedObj.obj_class == full_cls_name,
-            TaggedObj.obj_id == obj.id)
-        return [i.tag for i in qto.all()]
+        query = session.query(Tag).join('_objects').\
+            filter(TaggedObj.obj_id == obj.id).\
+            filter(TaggedObj.class_id == TaggedClass.id).\
+            filter(TaggedClass.name == _classname(obj)).\
+            order_by(TaggedObj.id)
+        return query.all()
+
+
+class TaggedClass(db.Base):
+    """
+    The registry of the classes of the tagged objects, so that the
+    tagged_obj rows refer to them by a small integer.
+
+    :Table name: tagged_class
+    :Columns:
+      name: :class:`sqlalchemy.types.String`
+        The class name, module path included.
+    """
+    __tablename__ = 'tagged_class'
+
+    # columns
+    name = Column(String(128), unique=True, nullable=False)
+
+    def __str__(self):
+        return str(self.name)
 
 
 class TaggedObj(db.Base):
@@ -314,8 +332,12 @@ class TaggedObj(db.Base):
     :Columns:
       obj_id: :class:`sqlalchemy.types.Integer`
         The id of the tagged object.
+      class_id: :class:`sqlalchemy.types.Integer`
+        A ForeignKey to :class:`TaggedClass`, the class of the tagged
+        object.
       obj_class: :class:`sqlalchemy.types.Unicode`
-        The class name of the tagged object.
+        The class name of the objects tagged by a previous version,
+        see :func:`migrate_tagged_objects`.
       tag_id: :class:`sqlalchemy.types.Integer`
         A ForeignKey to :class:`Tag`.
 
@@ -324,12 +346,62 @@ class TaggedObj(db.Base):
 
     # columns
     obj_id = Column(Integer, autoincrement=False)
+    class_id = Column(Integer, ForeignKey('tagged_class.id'))
     obj_class = Column(String(128))
     # # TODO: can class names be unicode, i.e. should obj_class be unicode
-    tag_id = Column(Integer, ForeignKey('tag.id'))
+    tag_id = Column(Integer, ForeignKey('tag.id'), index=True)
+
+    # relations
+    tagged_class = relation('TaggedClass', uselist=False)
 
     def __str__(self):
-        return '%s: %s' % (self.obj_class, self.obj_id)
+        name = self.obj_class
+        if self.tagged_class is not None:
+            name = self.tagged_class.name
+        return '%s: %s' % (name, self.obj_id)
+
+# the lookup of the tags of an object
+Index('ix_tagged_obj_class_id_obj_id', TaggedObj.__table__.c.class_id,
+      TaggedObj.__table__.c.obj_id)
+
+
+def _class_id(session, name, create=False):
+    """
+    Return the id of the class name in the tagged_class registry, None
+    if it isn't there, unless create is True, then it's added.
+    """
+    table = TaggedClass.__table__
+    class_id = session.execute(
+        select([table.c.id], table.c.name == name)).scalar()
+    if class_id is None and create:
+        tagged_class = TaggedClass(name=name)
+        session.add(tagged_class)
+        session.flush()
+        class_id = tagged_class.id
+    return class_id
+
+
+def migrate_tagged_objects(session):
+    """
+    Move the tagged_obj rows that refer to their class by the obj_class
+    name, as written by previous versions, to the class_id of the
+    tagged_class registry.  the caller commits.
+
+    Return the number of classes migrated.
+    """
+    table = TaggedObj.__table__
+    query = select([table.c.obj_class],
+                   and_(table.c.class_id == None,
+                        table.c.obj_class != None),
+                   distinct=True)
+    names = [row[0] for row in session.execute(query)]
+    for name in names:
+        logger.info('migrating the tagged objects of class %s' % name)
+        session.execute(table.update(
+            and_(table.c.class_id == None, table.c.obj_class == name),
+            values={'class_id': _class_id(session, name, create=True),
+                    'obj_class': None}))
+    return len(names)
 
 
 # TODO: maybe we shouldn't remove the obj from the tag if we can't
@@ -339,46 +411,77 @@ class TaggedObj(db.Base):
 # disabled by a user then the tag could still exist for that object to
 # other users who have that plugin enabled.
 
-# TODO: provide another function that returns (table, id) pairs that
-# this function can use so that we can expose that functionality
-def _get_tagged_object_pairs(tag):
+## class name -> mapped class, see _resolve_class
+_class_cache = {}
+
+
+def _resolve_class(name):
     """
-    :param tag: a Tag instance
+    Return the class named by the tagged_class name, importing its
+    module the first time, None if it can't be found.
     """
+    try:
+        return _class_cache[name]
+    except KeyError:
+        pass
+    # __import__ "from_list" parameters has to be a list of strings
+    module_name, part, cls_name = str(name).rpartition('.')
+    try:
+        module = __import__(module_name, globals(), locals(),
+                            module_name.split('.')[1:])
+        cls = getattr(module, cls_name)
+    except (ImportError, AttributeError), e:
+        logger.warning('Could not get the class %s: %s' % (name, e))
+        return None
+    _class_cache[name] = cls
+    return cls
 
-    kids = []
-    for obj in tag._objects:
-        try:
-            # __import__ "from_list" parameters has to be a list of strings
-            module_name, part, cls_name = str(obj.obj_class).rpartition('.')
-            module = __import__(module_name, globals(), locals(),
-                                module_name.split('.')[1:])
-            cls = getattr(module, cls_name)
-            kids.append((cls, obj.obj_id))
-        except KeyError, e:
-            logger.warning('KeyError -- tag.get_tagged_objects(%s): %s'
-                           % (tag, e))
-            continue
-        except DBAPIError, e:
-            logger.warning('DBAPIError -- tag.get_tagged_objects(%s): %s'
-                           % (tag, e))
-            continue
-        except AttributeError, e:
-            logger.warning('AttributeError -- tag.get_tagged_objects(%s): %s'
-                           % (tag, e))
-            logger.warning('Could not get the object for %s.%s(%s)'
-                           % (module_name, cls_name, obj.obj_id))
-            continue
 
+def _get_tagged_object_pairs(tag, session=None):
+    """
+    Return the (class, id) pairs of the objects tagged with tag, the
+    pairs whose class can't be found are left out.
+
+    :param tag: a Tag instance
+    :param session: the session to use, the session of tag by default,
+      a new session closed on return if tag is detached
+    """
+    from sqlalchemy.orm.session import object_session
+    close_session = False
+    if session is None:
+        session = object_session(tag)
+    if session is None:
+        session = db.Session()
+        close_session = True
+    table = TaggedObj.__table__
+    classes = TaggedClass.__table__
+    query = select([classes.c.name, table.c.obj_id],
+                   and_(table.c.tag_id == tag.id,
+                        table.c.class_id == classes.c.id),
+                   order_by=[table.c.id])
+    kids = []
+    try:
+        for obj_class, obj_id in session.execute(query):
+            cls = _resolve_class(obj_class)
+            if cls is not None:
+                kids.append((cls, obj_id))
+    finally:
+        if close_session:
+            session.close()
     return kids
 
 
-def get_tagged_objects(tag, session=None):
+def get_tagged_objects(tag, session=None, purge=False):
     """
     Return all object tagged with tag.
 
+    the objects are loaded with one IN query per class and chunk of
+    ids, see :func:`bauble.search.hydrate`.
+
     :param tag: A string or :class:`Tag`
     :param session:
+    :param purge: if True delete the tagged_obj rows referring to
+      objects that don't exist any more
     """
     close_session = False
     if not isinstance(tag, Tag):
@@ -389,60 +492,107 @@ def get_tagged_objects(tag, session=None):
         from sqlalchemy.orm.session import object_session
         session = object_session(tag)
 
-    # filter out any None values from the query which can happen if
+    # the pairs without an object are left out, which can happen if
     # you tag something and then delete it from the datebase
-
-    # TODO: the missing tagged objects should probably be removed from
-    # the database
-    r = [session.query(mapper).filter_by(id=obj_id).first()
-         for mapper, obj_id in _get_tagged_object_pairs(tag)]
-    r = filter(lambda x: x is not None, r)
+    pairs = _get_tagged_object_pairs(tag, session)
+    r = search.hydrate(session, pairs)
+    if purge:
+        found = set((type(obj), obj.id) for obj in r)
+        dangling = [(_class_name(cls), obj_id) for cls, obj_id in pairs
+                    if (cls, obj_id) not in found]
+        if dangling:
+            logger.info('purging %s dangling objects of tag %s'
+                        % (len(dangling), tag))
+            _delete_tagged(session, tag.id, dangling)
+            session.commit()
     if close_session:
         session.close()
     return r
 
 
+def _delete_tagged(session, tag_id, pairs):
+    """
+    Delete the tagged_obj rows of tag_id for the (classname, id) pairs,
+    with one DELETE statement per class and chunk of ids, bypassing the
+    mappers.  the deleted rows are recorded in the history table, like
+    the mappers would, so that incremental exports carry the deletion.
+    """
+    table = TaggedObj.__table__
+    for classname, ids in _class_chunks(pairs):
+        class_id = _class_id(session, classname)
+        if class_id is None:
+            continue
+        clause = and_(table.c.tag_id == tag_id,
+                      table.c.class_id == class_id,
+                      table.c.obj_id.in_(ids))
+        rows = [dict(row) for row in session.execute(select([table],
+                                                            clause))]
+        if not rows:
+            continue
+        session.execute(table.delete(clause))
+        db.add_history(session, table, 'delete', rows)
+
+
 def untag_objects(name, objs):
     """
     Remove the tag name from objs.
 
+    the tagged_obj rows are deleted with one DELETE statement per class
+    of objects and chunk of ids, bypassing the mappers but recorded in
+    the history table.
+
     :param name: The name of the tag
     :type name: str
     :param objs: The list of objects to untag.
     :type objs: list
     """
-    # TODO: should we loop through objects in a tag to delete
-    # the TaggedObject or should we delete tags is they match
-    # the tag in TaggedObj.selectBy(obj_class=classname, obj_id=obj.id)
     session = db.Session()
     try:
         tag = session.query(Tag).filter_by(tag=utils.utf8(name)).one()
     except Exception, e:
         logger.info("%s - %s" % (type(e), e))
         logger.debug(traceback.format_exc())
+        session.close()
         return
-    same = lambda x, y: x.obj_class == _classname(y) and x.obj_id == y.id
-    for obj in objs:
-        for kid in tag._objects:
-            # x = kid
-            # y = obj
-            if same(kid, obj):
-                #o = session.load(type(kid), kid.id)
-                o = session.query(type(kid)).filter_by(id=kid.id).one()
-                session.delete(o)
+    _delete_tagged(session, tag.id, [(_classname(obj), obj.id)
+                                     for obj in objs])
     session.commit()
     session.close()
 
 
 # create the classname stored in the tagged_obj table
-_classname = lambda x: unicode('%s.%s', 'utf-8') % (
-    type(x).__module__, type(x).__name__)
+_class_name = lambda cls: unicode('%s.%s', 'utf-8') % (
+    cls.__module__, cls.__name__)
+_classname = lambda x: _class_name(type(x))
+
+## the number of object ids per statement of the set based operations
+chunk_size = 500
+
+
+def _class_chunks(pairs):
+    """
+    Return the list of (classname, ids) pairs of the (classname, id)
+    pairs, grouped by class, with at most chunk_size ids each.
+    """
+    by_class = {}
+    for classname, obj_id in pairs:
+        by_class.setdefault(classname, set()).add(obj_id)
+    chunks = []
+    for classname, ids in sorted(by_class.iteritems()):
+        ids = sorted(ids)
+        for start in range(0, len(ids), chunk_size):
+            chunks.append((classname, ids[start:start + chunk_size]))
+    return chunks
 
 
 def tag_objects(name, objs):
     """
     Tag a list of objects.
 
+    the objects already tagged are looked up and the others inserted
+    with one statement each per class of objects and chunk of ids,
+    bypassing the mappers but recorded in the history table.
+
     :param name: The tag name, if it's a str object then it will be
       converted to unicode() using the default encoding. If a tag with
       this name doesn't exist it will be created
@@ -458,15 +608,25 @@ def tag_objects(name, objs):
         logger.debug("%s - %s" % (type(e), e))
         tag = Tag(tag=name)
         session.add(tag)
-    for obj in objs:
-        cls = and_(TaggedObj.obj_class == _classname(obj),
-                   TaggedObj.obj_id == obj.id,
-                   TaggedObj.tag_id == tag.id)
-        ntagged = session.query(TaggedObj).filter(cls).count()
-        if ntagged == 0:
-            tagged_obj = TaggedObj(obj_class=_classname(obj), obj_id=obj.id,
-                                   tag=tag)
-            session.add(tagged_obj)
+        session.flush()
+    table = TaggedObj.__table__
+    for classname, ids in _class_chunks((_classname(obj), obj.id)
+                                        for obj in objs):
+        class_id = _class_id(session, classname, create=True)
+        tagged = select([table.c.obj_id], and_(table.c.tag_id == tag.id,
+                                               table.c.class_id == class_id,
+                                               table.c.obj_id.in_(ids)))
+        tagged = set(row[0] for row in session.execute(tagged))
+        rows = [{'class_id': class_id, 'obj_id': obj_id, 'tag_id': tag.id}
+                for obj_id in ids if obj_id not in tagged]
+        if rows:
+            session.execute(table.insert(), rows)
+            new_ids = [row['obj_id'] for row in rows]
+            inserted = select([table], and_(table.c.tag_id == tag.id,
+                                            table.c.class_id == class_id,
+                                            table.c.obj_id.in_(new_ids)))
+            db.add_history(session, table, 'insert',
+                           [dict(row) for row in session.execute(inserted)])
     # if a new tag is created with the name parameter it is always saved
     # regardless of whether the objects are tagged
     session.commit()
@@ -479,25 +639,33 @@ def get_tag_ids(objs):
 
     Return a list of tag id's for tags associated with obj, only returns those
     tag ids that are common between all the objs
+
+    the tagged objects are counted per tag with one GROUP BY query per
+    class of objects and chunk of ids, a tag is common if it tags as
+    many objects as there are in objs.
     """
-    # TODO: this function does intersection in the most
-    # straightforward way and could probably do with some optimization
-    #clause = lambda x: and_(TaggedObj.obj_class==_classname(x),
-    #                        TaggedObj.obj_id==x.id)
-    #ors = or_(*map(clause, objs))
+    chunks = _class_chunks((_classname(obj), obj.id) for obj in objs)
+    nobjs = sum(len(ids) for classname, ids in chunks)
+    table = TaggedObj.__table__
+    ntagged = func.count(distinct(table.c.obj_id))
     session = db.Session()
-    s = set()
-    tag_id_query = session.query(Tag.id).join('_objects')
-    for obj in objs:
-        clause = and_(TaggedObj.obj_class == _classname(obj),
-                      TaggedObj.obj_id == obj.id)
-        tags = [r[0] for r in tag_id_query.filter(clause)]
-        if len(s) == 0:
-            s.update(tags)
-        else:
-            s.intersection_update(tags)
+    counts = {}
+    for classname, ids in chunks:
+        class_id = _class_id(session, classname)
+        if class_id is None:
+            # no object of this class is tagged
+            session.close()
+            return []
+        query = select([table.c.tag_id, ntagged],
+                       and_(table.c.class_id == class_id,
+                            table.c.obj_id.in_(ids)),
+                       group_by=[table.c.tag_id])
+        if len(chunks) == 1:
+            query = query.having(ntagged == nobjs)
+        for tag_id, n in session.execute(query):
+            counts[tag_id] = counts.get(tag_id, 0) + n
     session.close()
-    return list(s)
+    return [tag_id for tag_id, n in counts.iteritems() if n == nobjs]
 
 
 def _on_add_tag_activated(*args):
@@ -576,6 +744,10 @@ def _reset_tags_menu():
 
 class TagPlugin(pluginmgr.Plugin):
 
+    @classmethod
+    def upgrade(cls, session):
+        migrate_tagged_objects(session)
+
     @classmethod
     def init(cls):
         from bauble.view import SearchView
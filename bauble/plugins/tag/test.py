@@ -138,6 +138,96 @@ class TagTests(BaubleTestCase):
         ids = sorted(tag_plugin.get_tag_ids([self.family, family2]))
         self.assert_(ids == test_id, '%s == %s' % (ids, test_id))
 
+    def test_bulk_operations_in_chunks(self):
+        families = [Family(family=u'fam%s' % i) for i in range(5)]
+        self.session.add_all(families)
+        self.session.commit()
+        chunk_size = tag_plugin.chunk_size
+        tag_plugin.chunk_size = 2
+        try:
+            tag_plugin.tag_objects('test', families + [self.family])
+            tag_plugin.tag_objects('test', families[:3])
+            tag_plugin.tag_objects('test2', families[1:])
+            tag = self.session.query(Tag).filter_by(tag=u'test').one()
+            self.assertEquals(len(tag._objects), 6)
+            test2 = self.session.query(Tag).filter_by(tag=u'test2').one()
+            self.assertEquals(
+                sorted(tag_plugin.get_tag_ids(families[1:])),
+                sorted([tag.id, test2.id]))
+            self.assertEquals(tag_plugin.get_tag_ids(families), [tag.id])
+
+            tag_plugin.untag_objects('test', families[:4])
+            self.session.expire_all()
+            self.assertEquals(sorted(o.obj_id for o in tag._objects),
+                              sorted([families[4].id, self.family.id]))
+
+            # the bulk statements are recorded in the history
+            history = self.session.query(db.History).\
+                filter_by(table_name=u'tagged_obj')
+            self.assertEquals(history.filter_by(operation=u'insert').count(),
+                              10)
+            self.assertEquals(history.filter_by(operation=u'delete').count(),
+                              4)
+        finally:
+            tag_plugin.chunk_size = chunk_size
+
+    def test_tagged_object_pairs_of_detached_tag(self):
+        tag_plugin.tag_objects('test', [self.family])
+        tag = self.session.query(Tag).filter_by(tag=u'test').one()
+        self.session.expunge(tag)
+        closed = []
+        Session = db.Session
+
+        def session_factory(*args, **kwargs):
+            session = Session(*args, **kwargs)
+            close = session.close
+            session.close = lambda: closed.append(session) or close()
+            return session
+        db.Session = session_factory
+        try:
+            pairs = tag_plugin._get_tagged_object_pairs(tag)
+        finally:
+            db.Session = Session
+        self.assertEquals(pairs, [(Family, self.family.id)])
+        # the session opened for the detached tag was closed
+        self.assertEquals(len(closed), 1)
+
+    def test_get_tagged_objects_purge(self):
+        family2 = Family(family=u'family2')
+        self.session.add(family2)
+        self.session.commit()
+        tag_plugin.tag_objects('test', [self.family, family2])
+        self.session.delete(family2)
+        self.session.commit()
+        tag = self.session.query(Tag).filter_by(tag=u'test').one()
+        self.assertEquals(tag_plugin.get_tagged_objects(tag), [self.family])
+        self.assertEquals(len(tag._objects), 2)
+        self.assertEquals(tag_plugin.get_tagged_objects(tag, purge=True),
+                          [self.family])
+        self.session.expire_all()
+        self.assertEquals(len(tag._objects), 1)
+
+    def test_migrate_tagged_objects(self):
+        tag = Tag(tag=u'old')
+        self.session.add(tag)
+        self.session.commit()
+        # a row as written by a previous version
+        table = tag_plugin.TaggedObj.__table__
+        self.session.execute(table.insert(), {
+            'obj_class': tag_plugin._classname(self.family),
+            'obj_id': self.family.id, 'tag_id': tag.id})
+        self.session.commit()
+        self.assertEquals(Tag.attached_to(self.family), [])
+        self.assertEquals(tag_plugin.migrate_tagged_objects(self.session), 1)
+        self.session.commit()
+        self.assertEquals(Tag.attached_to(self.family), [tag])
+        self.assertEquals(tag_plugin.migrate_tagged_objects(self.session), 0)
+        # the class was registered once
+        tag_plugin.tag_objects(u'new', [self.family])
+        self.assertEquals(
+            self.session.query(tag_plugin.TaggedClass).count(), 1)
+
+
 import bauble.db as db
 
 
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+#
+# query.py
+#
+"""
+Run searches without the GUI, with the same semantics as the
+SearchView, and write their results as JSON lines or CSV.
+
+This is what the bauble-query script uses, it can be used from any
+other script like::
+
+    import bauble.query as query
+    session = query.open('sqlite:////path/to/bauble.db')
+    for obj in query.iter_results('plant where quantity > 0', session):
+        print obj
+"""
+
+import csv
+import datetime
+import decimal
+import json
+
+import logging
+logger = logging.getLogger(__name__)
+#logger.setLevel(logging.DEBUG)
+
+from sqlalchemy.orm import object_mapper
+
+import bauble.db as db
+import bauble.error as error
+from bauble.i18n import _
+import bauble.pluginmgr as pluginmgr
+from bauble.prefs import prefs
+import bauble.search as search
+import bauble.utils as utils
+
+
+def open(uri, verify=True):
+    """
+    Connect to the database at uri, initialize the plugins and return
+    a new session.
+
+    This never writes to the database, it raises a
+    :class:`bauble.error.DatabaseError` instead if uri is not a bauble
+    database, if its schema needs an upgrade or if some plugins were
+    never installed in it.
+    """
+    search.enable_packrat()
+    db.open(uri, verify, show_error_dialogs=False)
+    if db.needs_upgrade():
+        raise error.SchemaError(
+            _('the database was created with schema version %s, run '
+              'bauble-upgrade-schema to upgrade it to version %s')
+            % (db.schema_version(), db.SCHEMA_VERSION))
+    prefs.init()
+    pluginmgr.load()
+    registered = pluginmgr.PluginRegistry.names()
+    not_installed = sorted(name for name in pluginmgr.plugins
+                           if name not in registered)
+    if not_installed:
+        raise error.RegistryError(
+            _('the plugins %s are not installed in the database, open it '
+              'with bauble to install them') % ', '.join(not_installed))
+    pluginmgr.init()
+    return db.Session()
+
+
+def iter_results(text, session, page_size=200):
+    """
+    Yield the results of the search for text, in the order the
+    SearchView shows them.
+
+    the results are fetched one page of page_size objects at a time,
+    and each page is removed from the session before the next one is
+    fetched, so the memory used does not grow with the number of
+    results.
+    """
+    cursor = search.search_cursor(text, session, page_size)
+    for page in cursor.pages():
+        for obj in page:
+            yield obj
+        session.expunge_all()
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, str):
+        return utils.to_unicode(value)
+    return value
+
+
+def as_dict(obj):
+    """
+    Return a dictionary with the type, the string and the column
+    values of obj.
+    """
+    result = {'type': type(obj).__name__,
+              'str': utils.to_unicode(str(obj))}
+    for prop in object_mapper(obj).column_attrs:
+        result[prop.key] = _json_value(getattr(obj, prop.key))
+    return result
+
+
+def write_json(objects, out):
+    """
+    Write objects to the file object out, one JSON object per line as
+    returned by :func:`as_dict`.  Return the number of objects.
+    """
+    count = 0
+    for obj in objects:
+        out.write(json.dumps(as_dict(obj), sort_keys=True))
+        out.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(objects, out):
+    """
+    Write objects to the file object out as CSV, with the type, the id
+    and the string of each object.  Return the number of objects.
+    """
+    writer = csv.writer(out)
+    writer.writerow(['type', 'id', 'str'])
+    count = 0
+    for obj in objects:
+        writer.writerow([type(obj).__name__, obj.id, utils.utf8(obj)])
+        count += 1
+    return count
+
+
+writers = {'json': write_json,
+           'csv': write_csv}
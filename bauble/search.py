@@ -19,28 +19,283 @@
 # along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
 
 
+import re
+import threading
+import time
+import traceback
 import weakref
 
+import gobject
 import gtk
 
 import logging
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.DEBUG)
 
+from sqlalchemy import event
 from sqlalchemy import or_, and_
+from sqlalchemy import literal, select, union_all, func, distinct
 from sqlalchemy import Unicode
 from sqlalchemy import UnicodeText
-from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import class_mapper, joinedload_all, subqueryload_all
 from sqlalchemy.orm.properties import (
     ColumnProperty, RelationshipProperty)
 RelationProperty = RelationshipProperty
 
 import bauble
+import bauble.db as db
 from bauble.error import check
 import bauble.utils as utils
+import bauble.fulltext as fulltext
+from bauble import pluginmgr
 from bauble.i18n import _
 
 
+def eager_options(cls, paths):
+    """
+    Return the query options loading the relations in paths together
+    with the objects of class cls.
+
+    :param paths: a list of dotted relation names, starting at cls,
+        like 'accession.species.genus'
+
+    chains of many-to-one relations are loaded in the same query,
+    joined, paths through a collection with one more query per path.
+    """
+    options = []
+    for path in paths:
+        mapper = class_mapper(cls)
+        uselist = False
+        for name in path.split('.'):
+            prop = mapper.get_property(name)
+            uselist = uselist or prop.uselist
+            mapper = prop.mapper
+        if uselist:
+            options.append(subqueryload_all(path))
+        else:
+            options.append(joinedload_all(path))
+    return options
+
+
+def hydrate(session, pairs, chunk_size=500):
+    """
+    Return the objects identified by the (class, id) pairs.
+
+    the ids are grouped by class and each group is loaded by one IN
+    query per chunk of chunk_size ids, with the relations in the eager
+    loading profile of the class.  objects are returned in the order of
+    their first occurrence in pairs, duplicate pairs and pairs without
+    a matching row are dropped.
+    """
+    by_class = {}
+    order = []
+    for cls, obj_id in pairs:
+        ids = by_class.setdefault(cls, set())
+        if obj_id not in ids:
+            ids.add(obj_id)
+            order.append((cls, obj_id))
+
+    loaded = {}
+    for cls, ids in by_class.iteritems():
+        ids = list(ids)
+        query = session.query(cls).options(*MapperSearch.get_eager(cls))
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            for obj in query.filter(cls.id.in_(chunk)):
+                loaded[(cls, obj.id)] = obj
+    return [loaded[key] for key in order if key in loaded]
+
+
+class MappedPairsQuery(object):
+    """
+    Wrap a query on the `hits` selectable, returning (class index, id)
+    rows, so that it returns (class, id) pairs, the indexes referring
+    to the classes list.
+    """
+
+    def __init__(self, session, hits, classes):
+        self.session = session
+        self.hits = hits
+        self.classes = classes
+        self.query = session.query(hits.c.cls, hits.c.id)
+
+    def __iter__(self):
+        for index, obj_id in self.query:
+            yield self.classes[int(index)], obj_id
+
+    def all(self):
+        return list(self)
+
+    def counts(self):
+        """
+        Return a dictionary with the number of distinct ids per class,
+        computed by one grouped query.
+        """
+        query = self.session.query(
+            self.hits.c.cls, func.count(distinct(self.hits.c.id))).\
+            group_by(self.hits.c.cls)
+        return dict((self.classes[int(index)], count)
+                    for index, count in query)
+
+    def id_selects(self):
+        """
+        Return a list of (class, select) pairs, each select choosing the
+        ids of the objects of its class.
+        """
+        return [(cls, select([self.hits.c.id], self.hits.c.cls == index))
+                for index, cls in enumerate(self.classes)]
+
+    def groups(self):
+        """
+        Return a list of (class, query) pairs, each query selecting the
+        objects of its class.
+        """
+        return [(cls, self.session.query(cls).filter(cls.id.in_(ids)))
+                for cls, ids in self.id_selects()]
+
+    def __getattr__(self, name):
+        return getattr(self.query, name)
+
+
+class QuerySource(object):
+    """
+    The search results of one class, fetched in windows from a query
+    in a stable order.
+    """
+
+    def __init__(self, cls, query, order_by=None, count=None, options=None):
+        self.cls = cls
+        if order_by is None:
+            order_by = [cls.id]
+        self.query = query.reset_joinpoint().order_by(*order_by)
+        self._count = count
+        # the loader options only matter when fetching, keep them out
+        # of the count query
+        self.options = options or []
+
+    def count(self):
+        if self._count is None:
+            self._count = self.query.count()
+        return self._count
+
+    def fetch(self, start, stop):
+        query = self.query.options(*self.options)
+        return query.offset(start).limit(stop - start).all()
+
+
+class ListSource(object):
+    """
+    Search results already in memory, as returned by the search method
+    of a SearchStrategy.
+
+    only the class and the id of the objects are kept, the objects are
+    loaded again in session when fetched, so that they stay usable when
+    the session is emptied between pages.
+    """
+
+    def __init__(self, objects, session):
+        self.session = session
+        self.pairs = []
+        seen = set()
+        for obj in objects or []:
+            key = type(obj), obj.id
+            if key not in seen:
+                seen.add(key)
+                self.pairs.append(key)
+
+    def count(self):
+        return len(self.pairs)
+
+    def fetch(self, start, stop):
+        return hydrate(self.session, self.pairs[start:stop])
+
+    def exclude(self, sources):
+        """
+        Drop the objects also selected by one of the QuerySource objects
+        in sources.
+        """
+        for source in sources:
+            ids = [obj_id for cls, obj_id in self.pairs if cls is source.cls]
+            if not ids:
+                continue
+            query = source.query.filter(source.cls.id.in_(ids))
+            found = set(obj_id for obj_id, in query.values(source.cls.id))
+            self.pairs = [(cls, obj_id) for cls, obj_id in self.pairs
+                          if cls is not source.cls or obj_id not in found]
+
+
+class ResultCursor(object):
+    """
+    A lazy, ordered view on the results of a search.
+
+    the results are the concatenation of the sources, each source being
+    a QuerySource or a ListSource.  the total count is computed on
+    first use of len(), objects are fetched on demand, one window of
+    rows at a time, so only the requested rows are loaded.
+    """
+
+    def __init__(self, sources, page_size=200):
+        self.sources = sources
+        self.page_size = page_size
+        self._count = None
+
+    def __len__(self):
+        if self._count is None:
+            self._count = sum(source.count() for source in self.sources)
+        return self._count
+
+    def fetch(self, start, stop):
+        """
+        Return the list of the objects from position start up to, not
+        including, position stop.
+        """
+        result = []
+        offset = 0
+        for source in self.sources:
+            if start >= stop:
+                break
+            count = source.count()
+            if start < offset + count:
+                result.extend(source.fetch(start - offset,
+                                           min(stop, offset + count) - offset))
+                start = offset + count
+            offset += count
+        return result
+
+    def class_at(self, index):
+        """
+        Return the class of the object at position index, without
+        fetching it, or None if only fetching it tells.
+        """
+        offset = 0
+        for source in self.sources:
+            offset += source.count()
+            if index < offset:
+                return getattr(source, 'cls', None)
+        return None
+
+    def page(self, number):
+        """
+        Return the list of objects in the page with the given number,
+        counting from 0.
+        """
+        start = number * self.page_size
+        return self.fetch(start, start + self.page_size)
+
+    def pages(self):
+        """
+        Iterate over the pages of results.
+        """
+        for number in range((len(self) + self.page_size - 1) //
+                            self.page_size):
+            yield self.page(number)
+
+    def __iter__(self):
+        for page in self.pages():
+            for obj in page:
+                yield obj
+
+
 def search(text, session=None):
     results = set()
     for strategy in _search_strategies.values():
@@ -49,6 +304,130 @@ def search(text, session=None):
     return list(results)
 
 
+def search_cursor(text, session, page_size=200):
+    """
+    Return a ResultCursor on the results of all search strategies.
+
+    unlike search(), nothing but the matching ids is read from the
+    database until the pages of the cursor are fetched.  like search(),
+    an object found by more than one strategy is listed once.
+    """
+    sources = []
+    for strategy in _search_strategies.values():
+        logger.debug("collecting sources from strategy %s" % strategy)
+        sources.extend(strategy.get_sources(text, session))
+    queried = [s for s in sources if isinstance(s, QuerySource)]
+    for source in sources:
+        if isinstance(source, ListSource):
+            source.exclude(queried)
+    return ResultCursor(sources, page_size)
+
+
+def can_search_in_thread(engine):
+    """
+    Return True if a search can run on another thread than the one
+    showing its results.  an in memory SQLite database is only visible
+    to the thread that created it.
+    """
+    return not (engine.name == 'sqlite' and
+                engine.url.database in (None, '', ':memory:'))
+
+
+class SearchJob(threading.Thread):
+    """
+    Run search_cursor() on a worker thread, with a session of its own.
+
+    the search strategies are shared by all threads, they get the
+    session of the job as an argument and keep no state of the search.
+
+    when the search is over, and unless it was cancelled, callback(job)
+    is called on the GTK main loop.  the job then holds either the
+    result cursor and the number of results in cursor and count, or
+    the exception raised by the search in error.  the session passes to
+    the callback, which should close it.
+
+    use start() to run the search in the background, run_now() to run
+    it on the current thread and get the callback called right away.
+    """
+
+    def __init__(self, text, callback, page_size=200):
+        super(SearchJob, self).__init__(name='search')
+        self.daemon = True
+        self.text = text
+        self.callback = callback
+        self.page_size = page_size
+        # a session like any other, the worker only counts the results
+        # and the objects are loaded when the pages are fetched
+        self.session = db.Session()
+        self.cursor = None
+        self.count = 0
+        self.error = None
+        self.traceback = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._dbapi_connection = None
+
+    def _search(self):
+        try:
+            connection = self.session.connection()
+            with self._lock:
+                self._dbapi_connection = connection.connection.connection
+            self.cursor = search_cursor(self.text, self.session,
+                                        self.page_size)
+            self.count = len(self.cursor)
+        except Exception, e:
+            self.error = e
+            self.traceback = traceback.format_exc()
+        finally:
+            with self._lock:
+                self._dbapi_connection = None
+        # end the transaction, the session will go on with a connection
+        # of the thread using it
+        if self.error is None:
+            self.session.commit()
+        else:
+            self.session.rollback()
+        if self.cancelled:
+            self.session.close()
+
+    def run(self):
+        self._search()
+        if not self.cancelled:
+            gobject.idle_add(self._done)
+
+    def _done(self):
+        if not self.cancelled:
+            self.callback(self)
+        else:
+            self.session.close()
+        return False
+
+    def run_now(self):
+        self._search()
+        if not self.cancelled:
+            self.callback(self)
+
+    def cancel(self):
+        """
+        Cancel the search, interrupting the statement being executed.
+
+        a PostgreSQL database gets a cancel request for the running
+        query from psycopg2, an SQLite database gets interrupted.
+        """
+        self.cancelled = True
+        with self._lock:
+            conn = self._dbapi_connection
+            if conn is None:
+                return
+            try:
+                if hasattr(conn, 'cancel'):
+                    conn.cancel()
+                elif hasattr(conn, 'interrupt'):
+                    conn.interrupt()
+            except Exception, e:
+                logger.debug('SearchJob.cancel(): %s' % utils.utf8(e))
+
+
 class NoneToken(object):
     def __init__(self, t):
         pass
@@ -115,14 +494,18 @@ class TypedValueToken(ValueABC):
 
     def __init__(self, t):
         try:
-            constructor, converter = self.constructor[t[1]]
+            self.function, converter = self.constructor[t[1]]
         except KeyError:
             return
-        params = tuple(converter(i) for i in t[3].express())
-        self.value = constructor(*params)
+        self.params = tuple(converter(i) for i in t[3].express())
 
     def __repr__(self):
-        return "%s" % (self.value)
+        return "%s" % (self.express())
+
+    def express(self):
+        # the parse results are cached, so a value like |now|| is
+        # computed again every time it is used
+        return self.function(*self.params)
 
 
 class IdentifierToken(object):
@@ -293,6 +676,22 @@ class ParenthesisedQuery(object):
         return self.query.needs_join(env)
 
 
+class QueryEnv(object):
+    """
+    The state of one evaluation of a query, passed as `env` to the
+    evaluate and needs_join methods of the filter tokens.
+
+    the parsed statements are cached and may be evaluated by several
+    searches at once, so this state is kept out of them.
+    """
+
+    def __init__(self, domain, session, search_strategy):
+        self.domain = domain
+        self.session = session
+        self.search_strategy = search_strategy
+        self.domains = []
+
+
 class QueryAction(object):
     def __init__(self, t):
         self.domain = t[0]
@@ -301,9 +700,9 @@ class QueryAction(object):
     def __repr__(self):
         return "SELECT * FROM %s WHERE %s" % (self.domain, self.filter)
 
-    def invoke(self, search_strategy):
+    def invoke(self, search_strategy, session):
         """
-        update search_strategy object with statement results
+        return the set of objects selected by the statement in session
 
         Queries can use more database specific features.  This also
         means that the same query might not work the same on different
@@ -311,28 +710,31 @@ class QueryAction(object):
         use ilike but this would raise an error on SQLite.
         """
 
+        result = set()
+        if session is not None:
+            result.update(self.build_query(search_strategy, session).all())
+
+        return result
+
+    def build_query(self, search_strategy, session):
         domain = self.domain
         check(domain in search_strategy._domains or
               domain in search_strategy._shorthand,
               'Unknown search domain: %s' % domain)
-        self.domain = search_strategy._shorthand.get(domain, domain)
-        self.domain = search_strategy._domains[domain][0]
-        self.search_strategy = search_strategy
-
-        result = set()
-        if search_strategy._session is not None:
-            self.domains = self.filter.needs_join(self)
-            self.session = search_strategy._session
-            records = self.filter.evaluate(self).all()
-            result.update(records)
-
-        return result
+        domain = search_strategy._shorthand.get(domain, domain)
+        env = QueryEnv(search_strategy._domains[domain][0], session,
+                       search_strategy)
+        env.domains = self.filter.needs_join(env)
+        # joins to many related rows would repeat the matching objects
+        return self.filter.evaluate(env).distinct()
 
 
 class StatementAction(object):
     def __init__(self, t):
         self.content = t[0]
-        self.invoke = lambda x: self.content.invoke(x)
+        self.invoke = lambda x, session: self.content.invoke(x, session)
+        self.build_query = \
+            lambda x, session: self.content.build_query(x, session)
 
     def __repr__(self):
         return repr(self.content)
@@ -351,13 +753,15 @@ class BinomialNameAction(object):
     def __repr__(self):
         return "%s %s" % (self.genus_epithet, self.species_epithet)
 
-    def invoke(self, search_strategy):
+    def invoke(self, search_strategy, session):
+        return set(self.build_query(search_strategy, session).all())
+
+    def build_query(self, search_strategy, session):
         from bauble.plugins.plants.genus import Genus
         from bauble.plugins.plants.species import Species
-        result = search_strategy._session.query(Species).filter(
+        return session.query(Species).filter(
             Species.sp.startswith(self.species_epithet)).join(Genus).filter(
-            Genus.genus.startswith(self.genus_epithet)).all()
-        return set(result)
+            Genus.genus.startswith(self.genus_epithet))
 
 
 class DomainExpressionAction(object):
@@ -378,35 +782,41 @@ class DomainExpressionAction(object):
     def __repr__(self):
         return "%s %s %s" % (self.domain, self.cond, self.values)
 
-    def invoke(self, search_strategy):
+    def invoke(self, search_strategy, session):
+        return set(self.build_query(search_strategy, session).all())
+
+    def build_query(self, search_strategy, session):
+        """return the query selecting the objects matching the expression
+
+        all properties registered for the domain are folded into one
+        OR'ed filter, so the whole domain expression is resolved by a
+        single SELECT statement.  since the filter does not join any
+        other table, every matching row is returned exactly once.
+        """
+        domain = search_strategy._shorthand.get(self.domain, self.domain)
         try:
-            if self.domain in search_strategy._shorthand:
-                self.domain = search_strategy._shorthand[self.domain]
-            cls, properties = search_strategy._domains[self.domain]
+            cls, properties = search_strategy._domains[domain]
         except KeyError:
-            raise KeyError(_('Unknown search domain: %s') % self.domain)
+            raise KeyError(_('Unknown search domain: %s') % domain)
 
-        query = search_strategy._session.query(cls)
+        query = session.query(cls)
 
         ## here is the place where to optionally filter out unrepresented
         ## domain values. each domain class should define its own 'I have
         ## accessions' filter. see issue #42
 
-        result = set()
-
         # select all objects from the domain
         if self.values == '*':
-            result.update(query.all())
-            return result
+            return query
 
         mapper = class_mapper(cls)
 
         if self.cond in ('like', 'ilike'):
             condition = lambda col: \
-                lambda val: utils.ilike(mapper.c[col], '%s' % val)
+                lambda val: fulltext.ilike(mapper, col, '%s' % val)
         elif self.cond in ('contains', 'icontains', 'has', 'ihas'):
             condition = lambda col: \
-                lambda val: utils.ilike(mapper.c[col], '%%%s%%' % val)
+                lambda val: fulltext.ilike(mapper, col, '%%%s%%' % val)
         elif self.cond == '=':
             condition = lambda col: \
                 lambda val: mapper.c[col] == utils.utf8(val)
@@ -414,11 +824,10 @@ class DomainExpressionAction(object):
             condition = lambda col: \
                 lambda val: mapper.c[col].op(self.cond)(val)
 
-        for col in properties:
-            ors = or_(*map(condition(col), self.values.express()))
-            result.update(query.filter(ors).all())
-
-        return result
+        values = self.values.express()
+        return query.filter(or_(*[condition(col)(val)
+                                  for col in properties
+                                  for val in values]))
 
 
 class ValueListAction(object):
@@ -433,7 +842,7 @@ class ValueListAction(object):
     def express(self):
         return [i.express() for i in self.values]
 
-    def invoke(self, search_strategy):
+    def invoke(self, search_strategy, session):
         """
         Called when the whole search string is a value list.
 
@@ -442,42 +851,63 @@ class ValueListAction(object):
         add_meta()
         """
 
-        # make searches case-insensitive, in postgres use ilike,
-        # in other use upper()
-        like = lambda table, col, val: \
-            utils.ilike(table.c[col], ('%%%s%%' % val))
+        pairs = self.build_query(search_strategy, session).all()
+        logger.debug("value list search matched %s rows" % len(pairs))
+        result = set(hydrate(session, pairs))
+        logger.debug("result is now %s" % result)
+        return result
 
-        result = set()
-        for cls, columns in search_strategy._properties.iteritems():
-            column_cross_value = [(c, v) for c in columns
-                                  for v in self.express()]
-            # as of SQLAlchemy>=0.4.2 we convert the value to a unicode
-            # object if the col is a Unicode or UnicodeText column in order
-            # to avoid the "Unicode type received non-unicode bind param"
-
-            def unicol(col, v):
-                table = class_mapper(cls)
-                if isinstance(table.c[col].type, (Unicode, UnicodeText)):
-                    return unicode(v)
-                else:
-                    return v
+    def build_query(self, search_strategy, session):
+        """
+        Return the query selecting the (class, id) pairs of all objects
+        matching any of the values in any of the registered properties.
+
+        all domains are searched by one UNION ALL statement.  classes
+        defining replacement_column() select the id of their replacement
+        instead of their own, so no object needs to be loaded to resolve
+        replacement(), notes registered with add_notes() select the id of
+        the object they belong to.  the query may return the same pair
+        more than once.
+        """
 
+        # make searches case-insensitive, in postgres use ilike,
+        # in other use upper(), or the full text index if there is one
+        like = lambda table, col, val: \
+            fulltext.ilike(table, col, ('%%%s%%' % val))
+
+        # as of SQLAlchemy>=0.4.2 we convert the value to a unicode
+        # object if the col is a Unicode or UnicodeText column in order
+        # to avoid the "Unicode type received non-unicode bind param"
+        def unicol(table, col, v):
+            if isinstance(table.c[col].type, (Unicode, UnicodeText)):
+                return unicode(v)
+            else:
+                return v
+
+        values = self.express()
+        classes = []
+        selects = []
+        searched = sorted(search_strategy._properties.items() +
+                          search_strategy._notes.items(),
+                          key=lambda x: x[0].__name__)
+        for cls, columns in searched:
             table = class_mapper(cls)
-            q = search_strategy._session.query(cls)  # prepares SELECT
-            q = q.filter(or_(*[like(table, c, unicol(c, v))
-                               for c, v in column_cross_value]))
-            result.update(q.all())
-
-        logger.debug("result is now %s" % result)
+            if cls in search_strategy._notes:
+                target, id_column = search_strategy.get_note_owner(cls)
+            elif hasattr(cls, 'replacement_column'):
+                target, id_column = cls.replacement_column()
+            else:
+                target, id_column = cls, table.c['id']
+            if target not in classes:
+                classes.append(target)
+            clause = or_(*[like(table, c, unicol(table, c, v))
+                           for c in columns for v in values])
+            selects.append(
+                select([literal(classes.index(target)).label('cls'),
+                        id_column.label('id')], clause))
 
-        def replace(i):
-            try:
-                return i.replacement()
-            except:
-                return i
-        result = set([replace(i) for i in result])
-        logger.debug("result is now %s" % result)
-        return result
+        hits = union_all(*selects).alias('hits')
+        return MappedPairsQuery(session, hits, classes)
 
 
 from pyparsing import (
@@ -485,13 +915,104 @@ from pyparsing import (
     OneOrMore, oneOf, alphas, alphanums, Group, Literal,
     CaselessLiteral, WordStart, WordEnd, srange,
     stringEnd, Keyword, quotedString,
-    infixNotation, opAssoc, Forward)
+    infixNotation, opAssoc, Forward, ParserElement)
+
+
+def enable_packrat():
+    """
+    Enable the packrat parsing of pyparsing, which memoizes the partial
+    parses of the SearchParser grammar.  It is a switch of pyparsing
+    itself, for all its users in the process, so the applications
+    enable it once, see bauble.main() and bauble.query.open(), it is not
+    enabled by importing this module.
+    """
+    ParserElement.enablePackrat()
+
+
+_quoted_re = re.compile(r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')''')
+
+
+def normalize_query(text):
+    """
+    Return text with leading and trailing blanks removed and runs of
+    blanks outside quoted strings collapsed into one space.
+
+    two strings with the same normal form parse to the same statement.
+    """
+    parts = _quoted_re.split(text.strip())
+    # the even parts are outside quotes
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', parts[i])
+    return ''.join(parts)
+
+
+class ParseCache(object):
+    """
+    A least recently used cache of parsed search strings.
+
+    behaves like a dictionary limited to `size` entries and keeps count
+    of the lookups that found an entry (hits) and those that did not
+    (misses).  the searches run on worker threads, so all access goes
+    through a lock.
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        self._order = []  # least recently used first
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self._order.remove(key)
+            self._order.append(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._order.remove(key)
+            elif len(self._order) >= self.size:
+                del self._data[self._order.pop(0)]
+            self._data[key] = value
+            self._order.append(key)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            del self._order[:]
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._data), 'max_size': self.size}
 
 
 class SearchParser(object):
     """The parser for bauble.search.MapperSearch
     """
 
+    cache = ParseCache()
+    # the packrat memo of pyparsing is shared by all parsers
+    _parse_lock = threading.Lock()
+
     numeric_value = Regex(
         r'[-]?\d+(\.\d*)?([eE]\d+)?'
         ).setParseAction(NumericToken)('number')
@@ -563,15 +1084,34 @@ class SearchParser(object):
                  | value_list('value_list')
                  ).setParseAction(StatementAction)('statement')
 
+    def __init__(self, cache=None):
+        if cache is None:
+            cache = SearchParser.cache
+        self.cache = cache
+
     def parse_string(self, text):
         '''request pyparsing object to parse text
 
         `text` can be either a query, or a domain expression, or a list of
         values. the `self.statement` pyparsing object parses the input text
         and return a pyparsing.ParseResults object that represents the input
+
+        the results are kept in self.cache, keyed by the normalized text,
+        so that parsing a string again costs a dictionary lookup.  the
+        parse actions keep no state of the searches using them, and
+        values like |now|| are computed when the statement is evaluated,
+        so the same results can serve any number of searches.
         '''
 
-        return self.statement.parseString(text)
+        key = normalize_query(text)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        with self._parse_lock:
+            results = self.statement.parseString(text)
+        self.cache[key] = results
+        return results
 
 
 class SearchStrategy(object):
@@ -590,6 +1130,20 @@ class SearchStrategy(object):
         logger.debug('SearchStrategy "%s" %s)' % (text, session))
         pass
 
+    def get_sources(self, text, session):
+        '''
+        Return a list of result sources for ResultCursor.
+
+        strategies that can build their results as queries should
+        override this, by default the results of search() are used.
+        strategies returning QuerySource objects should make sure they
+        select no object already selected by the other strategies.
+        '''
+        results = self.search(text, session)
+        if not results:
+            return []
+        return [ListSource(results, session)]
+
 
 class MapperSearch(SearchStrategy):
 
@@ -606,13 +1160,15 @@ class MapperSearch(SearchStrategy):
     _domains = {}
     _shorthand = {}
     _properties = {}
+    _notes = {}
+    _note_owners = {}
+    _eager = {}
 
     def __init__(self):
         super(MapperSearch, self).__init__()
-        self._results = set()
         self.parser = SearchParser()
 
-    def add_meta(self, domain, cls, properties):
+    def add_meta(self, domain, cls, properties, eager=None):
         """Add a domain to the search space
 
         an example of domain is a database table, where the properties would
@@ -626,6 +1182,10 @@ class MapperSearch(SearchStrategy):
         :param cls: the class the domain will resolve to
         :param properties: a list of string names of the properties to
                            search by default
+        :param eager: the eager loading profile of cls, a list of dotted
+                      relation names loaded together with the results,
+                      like those used by the markup and children
+                      functions of the SearchView.
         """
 
         logger.debug('%s.add_meta(%s, %s, %s)' %
@@ -637,6 +1197,9 @@ class MapperSearch(SearchStrategy):
         check(len(properties) > 0,
               _('MapperSearch.add_meta(): '
                 'default_columns argument cannot be empty'))
+        check(eager is None or isinstance(eager, list),
+              _('MapperSearch.add_meta(): '
+                'eager argument must be list'))
         if isinstance(domain, (list, tuple)):
             self._domains[domain[0]] = cls, properties
             for d in domain[1:]:
@@ -644,6 +1207,41 @@ class MapperSearch(SearchStrategy):
         else:
             self._domains[domain] = cls, properties
         self._properties[cls] = properties
+        self._eager[cls] = eager or []
+
+    def add_notes(self, cls, owner, properties=None):
+        """Search the notes in cls as part of the objects they belong to
+
+        a value search matching a note returns the object the note is
+        attached to, notes are not a search domain of their own.
+
+        :param cls: the mapped note class
+        :param owner: the name of the many-to-one relation from cls to
+                      the object the note belongs to
+        :param properties: a list of string names of the properties to
+                           search, ['note'] by default
+        """
+        check(owner in [p.key for p in class_mapper(cls).iterate_properties],
+              _('MapperSearch.add_notes(): unknown relation %s') % owner)
+        self._notes[cls] = properties or ['note']
+        self._note_owners[cls] = owner
+
+    @classmethod
+    def get_note_owner(cls, note_cls):
+        """
+        Return the class and the id column of the objects the notes in
+        note_cls belong to.
+        """
+        prop = class_mapper(note_cls).get_property(cls._note_owners[note_cls])
+        return prop.mapper.class_, list(prop.local_columns)[0]
+
+    @classmethod
+    def get_eager(cls, mapped):
+        """
+        Return the query options of the eager loading profile of the
+        mapped class.
+        """
+        return eager_options(mapped, cls._eager.get(mapped, []))
 
     @classmethod
     def get_domain_classes(cls):
@@ -659,15 +1257,270 @@ class MapperSearch(SearchStrategy):
         If session=None then the session should be closed after the results
         have been processed or it is possible that some database backends
         could cause deadlocks.
+
+        the session is passed down to the parse actions, nothing about
+        the search is kept in the strategy, which searches on several
+        threads share.
         """
-        self._session = session
+        results = self.parser.parse_string(text.decode())
+        return results.statement.invoke(self, session)
 
-        self._results.clear()
+    def get_sources(self, text, session):
+        """
+        Return the QuerySource objects selecting the results of the
+        search for text, one per class, ordered by class name.
+        """
+        query = self.get_query(text, session)
+        if isinstance(query, MappedPairsQuery):
+            counts = query.counts()
+            groups = [(cls, q) for cls, q in query.groups() if cls in counts]
+        else:
+            counts = {}
+            groups = [(query.column_descriptions[0]['type'], query)]
+        return [QuerySource(cls, q, self.get_order_by(cls), counts.get(cls),
+                            self.get_eager(cls))
+                for cls, q in sorted(groups, key=lambda x: x[0].__name__)]
+
+    def get_ids(self, text, session):
+        """
+        Return a list of (class, select) pairs, each select choosing the
+        ids of the objects of its class found by the search for text.
+        """
+        query = self.get_query(text, session)
+        if isinstance(query, MappedPairsQuery):
+            return query.id_selects()
+        cls = query.column_descriptions[0]['type']
+        return [(cls, query.from_self(cls.id).statement)]
+
+    def get_order_by(self, cls):
+        """
+        Return the list of columns ordering the results of class cls,
+        naturally on the string of the objects when cls stores its sort
+        key, on its first searched property otherwise.
+        """
+        if issubclass(cls, db.NaturalSortKey):
+            return [cls._sort_key, cls.id]
+        properties = self._properties.get(cls, [])
+        return [getattr(cls, p) for p in properties[:1]] + [cls.id]
+
+    def get_query(self, text, session):
+        """
+        Return the query that the search for text would execute.
+
+        the returned object is a sqlalchemy Query, use `get_sql` to
+        obtain the SQL it stands for.
+        """
         results = self.parser.parse_string(text.decode())
-        self._results.update(results.statement.invoke(self))
+        return results.statement.build_query(self, session)
+
 
-        # these _results get filled in when the parse actions are called
-        return self._results
+def get_sql(query):
+    """
+    Return the SQL text of a sqlalchemy Query, as compiled for the
+    dialect of the query's session.
+
+    this is meant for inspection and debugging only, bound parameters
+    are rendered as placeholders.
+    """
+    dialect = query.session.bind.dialect
+    return unicode(query.statement.compile(dialect=dialect))
+
+
+class SearchProfile(object):
+    """
+    The timings of one search, as collected by :func:`profile`.
+
+    :ivar text: the search string
+    :ivar stages: list of (stage name, seconds) pairs, the stages being
+        'parse', 'query' (building and counting the result sources) and
+        'hydrate' (fetching and mapping the first page)
+    :ivar statements: list of dictionaries, one per SQL statement
+        executed, with the keys 'stage', 'statement', 'parameters',
+        'duration' (seconds), 'rows' (None if unknown) and 'explain'
+        (list of rows of the query plan, None if not asked for)
+    :ivar cached: whether the parse results came from the cache
+    :ivar count: the number of results
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.stages = []
+        self.statements = []
+        self.cached = False
+        self.count = 0
+        self._stage = None
+
+    @property
+    def total(self):
+        return sum(seconds for name, seconds in self.stages)
+
+    def stage(self, name, func, *args):
+        """
+        Call func(*args), recording its duration as the stage name,
+        and return its result.
+        """
+        self._stage = name
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.stages.append((name, time.time() - start))
+            self._stage = None
+
+    def listen(self, engine):
+        """
+        Start recording the statements executed on engine.
+        """
+        event.listen(engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute',
+                     self._after_cursor_execute)
+        event.listen(engine, 'after_execute', self._after_execute)
+
+    def stop(self, engine):
+        event.remove(engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        event.remove(engine, 'after_cursor_execute',
+                     self._after_cursor_execute)
+        event.remove(engine, 'after_execute', self._after_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        self.statements.append({'stage': self._stage,
+                                'statement': statement,
+                                'parameters': parameters,
+                                'duration': None,
+                                'rows': None,
+                                'explain': None,
+                                'start': time.time()})
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        entry = self.statements[-1]
+        entry['duration'] = time.time() - entry.pop('start')
+        if cursor.rowcount >= 0:
+            entry['rows'] = cursor.rowcount
+
+    def _after_execute(self, conn, clauseelement, multiparams, params,
+                       result):
+        """
+        Count the rows as they are fetched from result, the DBAPI does
+        not always know the number of rows selected.
+        """
+        if not self.statements or not result.returns_rows:
+            return
+        entry = self.statements[-1]
+
+        def counting(fetch):
+            def wrapper(*args):
+                rows = fetch(*args)
+                if isinstance(rows, list):
+                    entry['rows'] = (entry['rows'] or 0) + len(rows)
+                elif rows is not None:
+                    entry['rows'] = (entry['rows'] or 0) + 1
+                return rows
+            return wrapper
+
+        entry['rows'] = 0
+        for name in ('_fetchone_impl', '_fetchmany_impl', '_fetchall_impl'):
+            fetch = getattr(result, name, None)
+            if fetch is not None:
+                setattr(result, name, counting(fetch))
+
+    def explain(self, engine):
+        """
+        Add the query plan of the recorded SELECT statements.
+        """
+        if engine.name == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        elif engine.name == 'postgresql':
+            prefix = 'EXPLAIN '
+        else:
+            return
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            for entry in self.statements:
+                statement = entry['statement']
+                if not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+                cursor.execute(prefix + statement, entry['parameters'])
+                entry['explain'] = [tuple(row) for row in cursor.fetchall()]
+            cursor.close()
+        finally:
+            conn.close()
+
+    def report(self):
+        """
+        Return the profile as text.
+        """
+        lines = [u'search: %s' % utils.to_unicode(self.text),
+                 u'results: %s' % self.count,
+                 u'parse cached: %s' % self.cached]
+        for name, seconds in self.stages:
+            lines.append(u'%-8s %8.1f ms' % (name, seconds * 1000))
+        lines.append(u'%-8s %8.1f ms' % ('total', self.total * 1000))
+        for n, entry in enumerate(self.statements):
+            lines.append(u'')
+            lines.append(u'#%d %s: %.1f ms, %s rows' % (
+                n + 1, entry['stage'], (entry['duration'] or 0) * 1000,
+                entry['rows'] if entry['rows'] is not None else '?'))
+            lines.append(utils.to_unicode(entry['statement']))
+            if entry['parameters']:
+                lines.append(u'-- %s' % utils.to_unicode(
+                    repr(entry['parameters'])))
+            for row in entry['explain'] or []:
+                lines.append(u'   %s' % u' | '.join(
+                    utils.to_unicode(str(v)) for v in row))
+        return u'\n'.join(lines)
+
+
+def profile(text, session, explain=False, page_size=200):
+    """
+    Run the search for text like the SearchView does, and return a
+    :class:`SearchProfile` with the time spent in each stage and the
+    SQL statements executed.
+
+    :param explain: also add the query plan of the SELECT statements
+    """
+    engine = session.bind or db.engine
+    result = SearchProfile(text)
+    mapper_search = get_strategy('MapperSearch')
+    result.cached = normalize_query(text) in mapper_search.parser.cache
+    result.listen(engine)
+    try:
+        result.stage('parse', mapper_search.parser.parse_string, text)
+
+        def query():
+            cursor = search_cursor(text, session, page_size)
+            return cursor, len(cursor)
+        cursor, result.count = result.stage('query', query)
+        if result.count:
+            result.stage('hydrate', cursor.page, 0)
+    finally:
+        result.stop(engine)
+    if explain:
+        result.explain(engine)
+    return result
+
+
+class ProfileCommandHandler(pluginmgr.CommandHandler):
+
+    command = 'profile'
+
+    def __call__(self, cmd, arg):
+        if not arg:
+            utils.message_dialog(_('usage: :profile=<search string>'))
+            return
+        session = db.Session()
+        try:
+            result = profile(arg, session, explain=True)
+        finally:
+            session.close()
+        msg = _('%(count)s results in %(total).1f ms') % \
+            dict(count=result.count, total=result.total * 1000)
+        utils.message_details_dialog(utils.xml_safe(msg),
+                                     utils.xml_safe(result.report()))
 
 
 ## list of search strategies to be tried on each search string
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+#
+# benchmark.py
+#
+"""
+Search benchmark on synthetic collections.
+
+generate a collection of about 10k plants in a new SQLite database and
+run the search corpus on it, five times per search::
+
+    python -m bauble.test.benchmark -c sqlite:////tmp/bench.db \\
+        --generate 10k --repeat 5
+
+the report lists the latency percentiles and the number of SQL
+statements of each search.  with --save the results are written to a
+JSON file, which a later run can be compared to with --baseline, the
+script exits with status 1 if a search got slower than the baseline
+by more than --tolerance.
+
+a PostgreSQL database works the same, given a postgresql:// URI to an
+existing empty database.
+"""
+
+import json
+import random
+import sys
+from optparse import OptionParser
+
+import logging
+logger = logging.getLogger(__name__)
+#logger.setLevel(logging.DEBUG)
+
+import bauble.db as db
+import bauble.query as query
+import bauble.search as search
+import bauble.utils as utils
+from bauble.test import init_bauble
+
+## number of plants of the predefined scales
+scales = {'10k': 10000,
+          '100k': 100000,
+          '1M': 1000000}
+
+## the searches run by the benchmark, by kind, the names refer to the
+## generated collection
+corpus = [
+    ('value', u'Gen00012'),
+    ('value', u'Fam0003aceae Gen00007 2010.00005'),
+    ('value', u'2011.00100'),
+    ('domain', u'gen like Gen0001%'),
+    ('domain', u'acc contains 2012.0001'),
+    ('domain', u'loc=L001'),
+    ('domain', u'fam=Fam0002aceae'),
+    ('domain', u'tag=tag01'),
+    ('query', u'plant where accession.species.genus.genus = Gen00003'),
+    ('query', u'species where genus.family.family = Fam0001aceae'),
+    ('query', u'plant where quantity > 3 and location.code = L002'),
+    ('query', u'acc where plants.notes.note like %note 1000%'),
+    ]
+
+## rows inserted per statement while generating
+chunk_size = 10000
+
+
+class Generator(object):
+    """
+    Fill the database with a synthetic collection of nplants plants.
+
+    the fan-out is fixed, each family has about eight genera, each
+    genus six species, each species four accessions and each accession
+    two plants.  one plant in ten has a note, one in fifty is tagged.
+    the collection only depends on nplants and seed.
+    """
+
+    genera_per_family = 8
+    species_per_genus = 6
+    accessions_per_species = 4
+    plants_per_accession = 2
+
+    def __init__(self, nplants, seed=0):
+        self.nplants = nplants
+        self.random = random.Random(seed)
+
+    def _insert(self, table, rows):
+        """
+        Insert the rows from the iterator, chunk_size at a time,
+        bypassing the mappers.
+        """
+        conn = db.engine.connect()
+        trans = conn.begin()
+        try:
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    conn.execute(table.insert(), chunk)
+                    chunk = []
+            if chunk:
+                conn.execute(table.insert(), chunk)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+        for col in table.c:
+            utils.reset_sequence(col)
+
+    def run(self):
+        from bauble.plugins.plants import Family, Genus, Species
+        from bauble.plugins.garden import Accession, Plant, Location
+        from bauble.plugins.garden.plant import PlantNote
+        from bauble.plugins.tag import Tag, TaggedClass, TaggedObj
+        key = lambda s: utils.natsort_string(s)[:256]
+        rand = self.random
+
+        naccessions = self.nplants / self.plants_per_accession + 1
+        nspecies = naccessions / self.accessions_per_species + 1
+        ngenera = nspecies / self.species_per_genus + 1
+        nfamilies = ngenera / self.genera_per_family + 1
+        nlocations = self.nplants / 500 + 5
+        ntags = 20
+
+        families = [(i, u'Fam%04daceae' % i) for i in range(1, nfamilies + 1)]
+        self._insert(Family.__table__, (
+            dict(id=i, family=name, _sort_key=key(name))
+            for i, name in families))
+
+        genera = [(i, u'Gen%05d' % i) for i in range(1, ngenera + 1)]
+        self._insert(Genus.__table__, (
+            dict(id=i, genus=name, family_id=rand.randint(1, nfamilies),
+                 _sort_key=key(name))
+            for i, name in genera))
+
+        def species():
+            for i in range(1, nspecies + 1):
+                genus_id = rand.randint(1, ngenera)
+                sp = u'sp%d' % i
+                yield dict(id=i, sp=sp, genus_id=genus_id,
+                           _sort_key=key(u'Gen%05d %s' % (genus_id, sp)))
+        self._insert(Species.__table__, species())
+
+        locations = [(i, u'L%03d' % i, u'bed %d' % i)
+                     for i in range(1, nlocations + 1)]
+        self._insert(Location.__table__, (
+            dict(id=i, code=code, name=name,
+                 _sort_key=key(u'(%s) %s' % (code, name)))
+            for i, code, name in locations))
+
+        def code(acc_id):
+            return u'%d.%05d' % (2010 + acc_id % 5, acc_id)
+
+        self._insert(Accession.__table__, (
+            dict(id=i, code=code(i), species_id=rand.randint(1, nspecies),
+                 _sort_key=key(code(i)))
+            for i in range(1, naccessions + 1)))
+
+        delimiter = Plant.get_delimiter()
+
+        def plants():
+            acc_id, plant_code = 1, 0
+            for i in range(1, self.nplants + 1):
+                plant_code += 1
+                if plant_code > self.plants_per_accession:
+                    acc_id, plant_code = acc_id + 1, 1
+                yield dict(id=i, code=unicode(plant_code),
+                           accession_id=acc_id,
+                           location_id=rand.randint(1, nlocations),
+                           quantity=rand.randint(0, 5),
+                           _sort_key=key(u'%s%s%s' % (
+                               code(acc_id), delimiter, plant_code)))
+        self._insert(Plant.__table__, plants())
+
+        self._insert(PlantNote.__table__, (
+            dict(plant_id=i, note=u'note %d' % i, category=u'benchmark')
+            for i in range(1, self.nplants + 1, 10)))
+
+        self._insert(Tag.__table__, (
+            dict(id=i, tag=u'tag%02d' % i) for i in range(1, ntags + 1)))
+        plant_class = u'%s.%s' % (Plant.__module__, Plant.__name__)
+        self._insert(TaggedClass.__table__, [dict(id=1, name=plant_class)])
+        self._insert(TaggedObj.__table__, (
+            dict(obj_id=i, class_id=1, tag_id=rand.randint(1, ntags))
+            for i in range(1, self.nplants + 1, 50)))
+
+
+def percentile(values, p):
+    """
+    Return the p-th percentile of values, by the nearest rank.
+    """
+    values = sorted(values)
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def run(repeat=5, page_size=200):
+    """
+    Run each search of the corpus repeat times, after one warm up run,
+    and return a list of dictionaries with the kind, text, number of
+    results, number of SQL statements and the latency percentiles in
+    milliseconds of each search.
+    """
+    results = []
+    for kind, text in corpus:
+        times = []
+        session = db.Session()
+        try:
+            search.profile(text, session, page_size=page_size)
+            for i in range(repeat):
+                session.expunge_all()
+                profile = search.profile(text, session, page_size=page_size)
+                times.append(profile.total * 1000)
+        finally:
+            session.close()
+        results.append({'kind': kind,
+                        'text': text,
+                        'results': profile.count,
+                        'statements': len(profile.statements),
+                        'p50': percentile(times, 50),
+                        'p90': percentile(times, 90),
+                        'p99': percentile(times, 99),
+                        'max': max(times)})
+    return results
+
+
+def report(results, out=sys.stdout):
+    out.write('%-7s %8s %5s %9s %9s %9s  %s\n' % (
+        'kind', 'results', 'stmts', 'p50 ms', 'p90 ms', 'p99 ms', 'search'))
+    for r in results:
+        out.write('%-7s %8d %5d %9.1f %9.1f %9.1f  %s\n' % (
+            r['kind'], r['results'], r['statements'], r['p50'], r['p90'],
+            r['p99'], utils.utf8(r['text'])))
+
+
+def compare(results, baseline, tolerance=1.5):
+    """
+    Return the list of messages about the searches in results slower
+    than in baseline by more than the tolerance factor, or issuing more
+    SQL statements.
+    """
+    previous = dict((r['text'], r) for r in baseline)
+    regressions = []
+    for r in results:
+        old = previous.get(r['text'])
+        if old is None:
+            continue
+        if r['p50'] > old['p50'] * tolerance:
+            regressions.append('%s: p50 %.1f ms, was %.1f ms' % (
+                utils.utf8(r['text']), r['p50'], old['p50']))
+        if r['statements'] > old['statements']:
+            regressions.append('%s: %d statements, were %d' % (
+                utils.utf8(r['text']), r['statements'], old['statements']))
+    return regressions
+
+
+def main(argv=None):
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage)
+    parser.add_option('-c', '--connection', dest='uri', metavar='URI',
+                      help='the SQLAlchemy URI of the database')
+    parser.add_option('-g', '--generate', dest='scale', metavar='SCALE',
+                      help='create the database and generate a collection '
+                      'of SCALE plants, %s or a number'
+                      % ', '.join(sorted(scales)))
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=0,
+                      help='the seed of the generated collection')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+                      help='the number of timed runs of each search')
+    parser.add_option('--save', dest='save', metavar='FILE',
+                      help='save the results as JSON to FILE')
+    parser.add_option('--baseline', dest='baseline', metavar='FILE',
+                      help='compare the results to those saved in FILE')
+    parser.add_option('--tolerance', dest='tolerance', type='float',
+                      default=1.5, help='the slow down factor considered '
+                      'a regression, default 1.5')
+    options, args = parser.parse_args(argv)
+
+    if not options.uri:
+        parser.error('You must specify the database with -c')
+
+    if options.scale is not None:
+        # an empty database, the default data would clash with the
+        # generated ids
+        init_bauble(options.uri, create=False)
+        nplants = scales.get(options.scale) or int(options.scale)
+        Generator(nplants, options.seed).run()
+    else:
+        query.open(options.uri).close()
+
+    results = run(options.repeat)
+    report(results)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for msg in regressions:
+            print >>sys.stderr, msg
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
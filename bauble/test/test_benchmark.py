@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_benchmark.py
+#
+import bauble.test.benchmark as benchmark
+from bauble.test import BaubleTestCase
+
+
+class BenchmarkTests(BaubleTestCase):
+
+    def test_generate_and_run(self):
+        from bauble.plugins.plants import Family, Species
+        from bauble.plugins.garden import Accession, Plant
+        benchmark.Generator(200).run()
+        self.assertEqual(self.session.query(Plant).count(), 200)
+        self.assertEqual(self.session.query(Accession).count(), 101)
+        self.assertTrue(self.session.query(Family).count() > 1)
+
+        # the generated sort keys are those the mapper would compute
+        for cls in (Species, Accession, Plant):
+            obj = self.session.query(cls).first()
+            self.assertEqual(obj._sort_key, obj.compute_sort_key())
+
+        results = benchmark.run(repeat=1)
+        self.assertEqual(len(results), len(benchmark.corpus))
+        byname = dict((r['text'], r) for r in results)
+        self.assertEqual(byname[u'Gen00012']['results'], 1)
+        self.assertTrue(byname[u'gen like Gen0001%']['statements'] > 0)
+
+    def test_compare(self):
+        baseline = [{'text': u'a', 'p50': 10.0, 'statements': 3}]
+        self.assertEqual(benchmark.compare(
+            [{'text': u'a', 'p50': 14.0, 'statements': 3}], baseline), [])
+        self.assertEqual(len(benchmark.compare(
+            [{'text': u'a', 'p50': 16.0, 'statements': 4}], baseline)), 2)
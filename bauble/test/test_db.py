@@ -22,6 +22,7 @@ from bauble.test import BaubleTestCase
 import bauble.plugins.plants.genus
 import bauble.plugins.garden.accession
 
+import bauble.db as db
 from bauble.db import class_of_object
 
 
@@ -32,3 +33,98 @@ class GlobalFunctionsTests(BaubleTestCase):
         self.assertEquals(class_of_object("accession_note"),
                           bauble.plugins.garden.accession.AccessionNote)
         self.assertEquals(class_of_object("not_existing"), None)
+
+
+class StatisticsTests(BaubleTestCase):
+
+    def test_statistics_invalidated_by_mappers(self):
+        from bauble.plugins.plants import Family, Genus
+        family = Family(family=u'family')
+        self.session.add(family)
+        self.session.commit()
+        stats = db.statistics.get('family', family.id)
+        self.assertEquals(stats['ngen'], 0)
+        self.assertEquals(stats['nplants'], 0)
+
+        calls = []
+
+        def ngenera(session, family_id):
+            calls.append(family_id)
+            return session.query(Genus).filter_by(family_id=family_id).\
+                count()
+        db.statistics.register('test', ngenera, ['genus'])
+        self.assertEquals(db.statistics.get('test', family.id), 0)
+        self.assertEquals(db.statistics.get('test', family.id), 0)
+        self.assertEquals(len(calls), 1)
+
+        # changing an unrelated table keeps the value
+        family.family = u'family2'
+        self.session.commit()
+        db.statistics.get('test', family.id)
+        self.assertEquals(len(calls), 1)
+
+        self.session.add(Genus(family=family, genus=u'genus'))
+        self.session.commit()
+        self.assertEquals(db.statistics.get('test', family.id), 1)
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(db.statistics.get('family', family.id)['ngen'], 1)
+
+
+class UpgradeTests(BaubleTestCase):
+
+    def test_upgrade_creates_missing_indexes(self):
+        from sqlalchemy.engine import reflection
+        from bauble.plugins.tag import TaggedObj
+        index = [i for i in TaggedObj.__table__.indexes
+                 if i.name == 'ix_tagged_obj_class_id_obj_id'][0]
+        index.drop(bind=db.engine)
+        names = lambda: [i['name'] for i in reflection.Inspector.
+                         from_engine(db.engine).get_indexes('tagged_obj')]
+        self.assertFalse(index.name in names())
+        db.upgrade(db.engine)
+        self.assertTrue(index.name in names())
+
+    def test_upgrade_gated_on_schema_version(self):
+        import bauble.meta as meta
+        import bauble.pluginmgr as pluginmgr
+        from bauble.plugins.tag import Tag, TaggedObj
+        # a new database is current
+        self.assertEquals(db.schema_version(), db.SCHEMA_VERSION)
+        self.assertFalse(pluginmgr.upgrade())
+
+        # a database and a tagged object from a previous version
+        self.session.query(meta.BaubleMeta).\
+            filter_by(name=meta.SCHEMA_KEY).delete()
+        tag = Tag(tag=u'old')
+        self.session.add(tag)
+        self.session.commit()
+        self.session.execute(TaggedObj.__table__.insert(), {
+            'obj_class': u'bauble.plugins.tag.Tag', 'obj_id': tag.id,
+            'tag_id': tag.id})
+        self.session.commit()
+        self.assertTrue(db.needs_upgrade())
+
+        self.assertTrue(pluginmgr.upgrade())
+        self.assertFalse(db.needs_upgrade())
+        self.assertEquals(Tag.attached_to(tag), [tag])
+
+    def test_upgrade_recomputes_sort_keys(self):
+        import bauble.meta as meta
+        import bauble.pluginmgr as pluginmgr
+        from bauble.plugins.plants import Family
+        family = Family(family=u'Family2')
+        self.session.add(family)
+        self.session.commit()
+        # a key in the format of schema version 1
+        table = Family.__table__
+        self.session.execute(table.update().
+                             where(table.c.id == family.id).
+                             values(_sort_key=u'Family000000000002'))
+        self.session.query(meta.BaubleMeta).\
+            filter_by(name=meta.SCHEMA_KEY).update({'value': u'1'})
+        self.session.commit()
+        self.assertTrue(pluginmgr.upgrade())
+        self.session.expire_all()
+        self.assertEquals(family._sort_key, u'Family\x01000000000002\x01')
+        if db.engine.name == 'postgresql':
+            self.assertEquals(db.collate_sort_keys(db.engine), [])
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_fulltext.py
+#
+from nose import SkipTest
+
+import bauble.db as db
+import bauble.fulltext as fulltext
+import bauble.search as search
+from bauble.test import BaubleTestCase
+
+
+class FullTextIndexTests(BaubleTestCase):
+
+    def setUp(self):
+        super(FullTextIndexTests, self).setUp()
+        if not fulltext.is_supported():
+            raise SkipTest('no full text index on this database')
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Family = Family
+        self.family = Family(family=u'Orchidaceae')
+        self.genus = Genus(family=self.family, genus=u'Laelia')
+        self.session.add_all([self.family, self.genus])
+        self.session.commit()
+        fulltext.create()
+
+    def tearDown(self):
+        fulltext.drop()
+        super(FullTextIndexTests, self).tearDown()
+
+    def test_index_created(self):
+        self.assertTrue(fulltext.exists())
+        table = self.Family.__table__
+        self.assertEqual(fulltext.indexed_columns(table), set(['family']))
+
+    def test_search_uses_index(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        query = mapper_search.get_query('family contains CHID', self.session)
+        self.assertTrue('family_fts' in search.get_sql(query))
+        self.assertEqual(query.all(), [self.family])
+
+        results = mapper_search.search('aeli', self.session)
+        self.assertEqual(results, set([self.genus]))
+
+    def test_index_follows_changes(self):
+        mapper_search = search.get_strategy('MapperSearch')
+        self.family.family = u'Bromeliaceae'
+        self.session.add(self.Family(family=u'Orchidales'))
+        self.session.commit()
+        results = mapper_search.search('fam contains orchid', self.session)
+        self.assertEqual([f.family for f in results], [u'Orchidales'])
+
+        self.session.delete(self.genus)
+        self.session.commit()
+        results = mapper_search.search('aeli', self.session)
+        self.assertEqual(results, set())
+
+    def test_notes_indexed(self):
+        from bauble.plugins.plants.family import FamilyNote
+        table = FamilyNote.__table__
+        self.assertEqual(fulltext.indexed_columns(table), set(['note']))
+        self.session.add(FamilyNote(family=self.family, note=u'epiphytes'))
+        self.session.commit()
+        mapper_search = search.get_strategy('MapperSearch')
+        query = mapper_search.get_query('PHYT', self.session)
+        self.assertTrue('family_note_fts' in search.get_sql(query))
+        results = mapper_search.search('PHYT', self.session)
+        self.assertEqual(results, set([self.family]))
+
+    def test_create_again(self):
+        # recreating the content tables drops their triggers, create()
+        # must restore them and keep the index
+        if db.engine.name == 'sqlite':
+            db.engine.execute('DROP TRIGGER family_fts_ai')
+        fulltext.create()
+        self.assertTrue(fulltext.exists())
+        self.session.add(self.Family(family=u'Bromeliaceae'))
+        self.session.commit()
+        mapper_search = search.get_strategy('MapperSearch')
+        results = mapper_search.search('fam contains romelia',
+                                       self.session)
+        self.assertEqual([f.family for f in results], [u'Bromeliaceae'])
+
+    def test_drop(self):
+        fulltext.drop()
+        self.assertFalse(fulltext.exists())
+        table = db.metadata.tables['family']
+        self.assertEqual(fulltext.indexed_columns(table), set())
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_query.py
+#
+import json
+from StringIO import StringIO
+
+import bauble.error as error
+import bauble.query as query
+from bauble.test import BaubleTestCase
+
+
+class QueryTests(BaubleTestCase):
+
+    def setUp(self):
+        super(QueryTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.family = Family(family=u'Orchidaceae')
+        self.genera = [Genus(family=self.family, genus=u'Laelia%s' % i)
+                       for i in (10, 9, 1)]
+        self.session.add_all([self.family] + self.genera)
+        self.session.commit()
+        # iter_results empties the session, keep what the tests need
+        self.family_id = self.family.id
+
+    def test_iter_results(self):
+        results = query.iter_results('gen like laelia%', self.session,
+                                     page_size=2)
+        self.assertEqual([str(g) for g in results],
+                         ['Laelia1', 'Laelia9', 'Laelia10'])
+
+    def test_write_json(self):
+        out = StringIO()
+        results = query.iter_results('fam=orchidaceae', self.session)
+        self.assertEqual(query.write_json(results, out), 1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        row = json.loads(lines[0])
+        self.assertEqual(row['type'], 'Family')
+        self.assertEqual(row['family'], u'Orchidaceae')
+        self.assertEqual(row['id'], self.family_id)
+
+    def test_write_csv(self):
+        out = StringIO()
+        results = query.iter_results('fam=orchidaceae', self.session)
+        self.assertEqual(query.write_csv(results, out), 1)
+        self.assertEqual(out.getvalue().splitlines(),
+                         ['type,id,str', 'Family,%s,Orchidaceae'
+                          % self.family_id])
+
+    def test_open_refuses_empty_database(self):
+        # a new in memory database is empty, it is not created
+        self.assertRaises(error.EmptyDatabaseError, query.open,
+                          'sqlite:///:memory:')
@@ -286,6 +286,20 @@ class SearchTests(BaubleTestCase):
         g = list(results)[0]
         self.assertEqual(g.id, self.genus.id)
 
+    def test_search_by_values_in_notes(self):
+        "search by values finds the objects owning matching notes"
+        from bauble.plugins.plants.family import FamilyNote
+        mapper_search = search.get_strategy('MapperSearch')
+        self.session.add(FamilyNote(family=self.family,
+                                    note=u'flowers in spring'))
+        self.session.commit()
+        results = mapper_search.search('spring', self.session)
+        self.assertEquals(results, set([self.family]))
+
+        # notes are no search domain
+        self.assertRaises(KeyError, mapper_search.search,
+                          'family_note=spring', self.session)
+
     def test_search_by_expression_family_eq(self):
         mapper_search = search.get_strategy('MapperSearch')
         self.assertTrue(isinstance(mapper_search, search.MapperSearch))
@@ -713,6 +727,18 @@ class SearchTests(BaubleTestCase):
         results = mapper_search.search(s, self.session)
         self.assertEqual(results, [g3])
 
+        synonym_search = search.get_strategy('SynonymSearch')
+        sources = synonym_search.get_sources('Schetti', self.session)
+        self.assertTrue(all(isinstance(s, search.QuerySource)
+                            for s in sources))
+        cursor = search.search_cursor('Schetti', self.session)
+        self.assertEqual(sorted(cursor, key=str), [g3, g4])
+
+        # the accepted genus is also a MapperSearch result, listed once
+        cursor = search.search_cursor('Ixora Schetti', self.session)
+        self.assertEqual(len(cursor), 2)
+        self.assertEqual(sorted(cursor, key=str), [g3, g4])
+
     def test_search_by_query_vernacural(self):
         """can find species by vernacular name"""
 
@@ -736,6 +762,162 @@ class SearchTests(BaubleTestCase):
         results = mapper_search.search(s, self.session)
         self.assertEqual(results, set([sp]))
 
+    def test_search_by_expression_single_statement(self):
+        "all properties of a domain are searched in one statement"
+
+        from bauble.plugins.plants.species_model import Species
+        sp1 = Species(sp=u"abies", genus=self.genus)
+        sp2 = Species(sp=u"alba", infrasp1=u"abies", genus=self.genus)
+        sp3 = Species(sp=u"rubra", genus=self.genus)
+        self.session.add_all([sp1, sp2, sp3])
+        self.session.commit()
+
+        mapper_search = search.get_strategy('MapperSearch')
+        query = mapper_search.get_query('sp=abies', self.session)
+        sql = search.get_sql(query)
+        self.assertEqual(sql.count('SELECT'), 1)
+        self.assertTrue(' OR ' in sql)
+        self.assertTrue('infrasp4' in sql)
+        self.assertEqual(set(query.all()), set([sp1, sp2]))
+
+        results = mapper_search.search('sp=abies', self.session)
+        self.assertEqual(results, set([sp1, sp2]))
+
+    def test_search_by_values_single_statement(self):
+        "value lists search all domains in one statement"
+
+        from bauble.plugins.plants.species_model import Species
+        from bauble.plugins.plants.species_model import VernacularName
+        sp = Species(sp=u"coccinea", genus=self.genus)
+        vn = VernacularName(name=u"genus1 red", language=u"en", species=sp)
+        self.session.add_all([sp, vn])
+        self.session.commit()
+
+        mapper_search = search.get_strategy('MapperSearch')
+        query = mapper_search.get_query('genus1', self.session)
+        self.assertTrue('UNION ALL' in search.get_sql(query))
+        self.assertEqual(sorted(query.all()),
+                         sorted([(self.Genus, self.genus.id),
+                                 (Species, sp.id)]))
+
+        results = mapper_search.search('genus1', self.session)
+        self.assertEqual(results, set([self.genus, sp]))
+
+    def test_search_cursor_pages(self):
+        "the result cursor counts first and fetches ordered windows"
+
+        genera = [self.Genus(family=self.family, genus=u'genus%02d' % i)
+                  for i in range(2, 7)]
+        self.session.add_all(genera)
+        self.session.commit()
+
+        cursor = search.search_cursor('genus0', self.session, page_size=2)
+        self.assertEqual(len(cursor), 5)
+        self.assertEqual(cursor.page(0), genera[:2])
+        self.assertEqual(cursor.page(2), genera[4:])
+        self.assertEqual(cursor.fetch(1, 3), genera[1:3])
+        self.assertEqual([len(p) for p in cursor.pages()], [2, 2, 1])
+
+        # sources are ordered by class name
+        cursor = search.search_cursor('family1 genus0', self.session,
+                                      page_size=4)
+        self.assertEqual(len(cursor), 6)
+        self.assertEqual(cursor.page(0), [self.family] + genera[:3])
+        self.assertEqual(list(cursor), [self.family] + genera)
+
+        cursor = search.search_cursor('gen like genus0%', self.session)
+        self.assertEqual(list(cursor), genera)
+
+    def test_list_source(self):
+        "list sources load their objects again and drop duplicates"
+
+        source = search.ListSource([self.genus, self.family, self.genus],
+                                   self.session)
+        self.assertEqual(source.count(), 2)
+        self.session.expunge_all()
+        genus, family = source.fetch(0, 2)
+        self.assertEqual(genus.family.family, u'family1')
+
+        query = self.session.query(self.Genus)
+        source.exclude([search.QuerySource(self.Genus, query)])
+        self.assertEqual(source.fetch(0, 2), [family])
+
+    def test_hydrate_groups_by_class(self):
+        "hydrate loads objects in order and drops duplicates"
+
+        pairs = [(self.Genus, self.genus.id), (self.Family, self.family.id),
+                 (self.Genus, self.genus.id), (self.Genus, -1)]
+        self.assertEqual(search.hydrate(self.session, pairs),
+                         [self.genus, self.family])
+
+    def test_eager_loading_profile(self):
+        "the results are fetched with the relations of their profile"
+
+        from bauble.plugins.plants.species_model import Species
+        options = search.eager_options(Species,
+                                       ['genus.family', 'vernacular_names'])
+        self.assertEqual(len(options), 2)
+
+        self.session.expunge_all()
+        cursor = search.search_cursor('genus1', self.session)
+        genus = list(cursor)[0]
+        self.assertTrue('family' in genus.__dict__)
+
+        self.session.expunge_all()
+        genus, = search.hydrate(self.session, [(self.Genus, self.genus.id)])
+        self.assertTrue('family' in genus.__dict__)
+
+    def test_profile(self):
+        "profiling a search records its stages and statements"
+
+        result = search.profile('genus1', self.session, explain=True)
+        self.assertEqual(result.count, 1)
+        self.assertEqual([name for name, seconds in result.stages],
+                         ['parse', 'query', 'hydrate'])
+        hydrate = [s for s in result.statements if s['stage'] == 'hydrate']
+        self.assertEqual(len(hydrate), 1)
+        self.assertEqual(hydrate[0]['rows'], 1)
+        self.assertTrue(hydrate[0]['explain'])
+        self.assertTrue(u'genus1' in result.report())
+
+        result = search.profile('genus1', self.session)
+        self.assertTrue(result.cached)
+        self.assertEqual(result.statements[0]['explain'], None)
+
+    def test_search_keeps_no_state(self):
+        "the shared strategy keeps nothing of the searches"
+
+        mapper_search = search.get_strategy('MapperSearch')
+        first = mapper_search.search('genus1', self.session)
+        second = mapper_search.search('family1', self.session)
+        self.assertEqual(first, set([self.genus]))
+        self.assertEqual(second, set([self.family]))
+        self.assertFalse(hasattr(mapper_search, '_session'))
+
+    def test_search_job(self):
+        "a search job hands its results and session to the callback"
+
+        done = []
+        job = search.SearchJob('genus1', done.append)
+        job.run_now()
+        self.assertEqual(done, [job])
+        self.assertEqual(job.error, None)
+        self.assertEqual(job.count, 1)
+        self.assertEqual(list(job.cursor), [job.session.merge(self.genus)])
+        job.session.close()
+
+        job = search.SearchJob('genus where', done.append)
+        job.run_now()
+        self.assertTrue(job.error is not None)
+        job.session.close()
+
+        # a cancelled job never calls back
+        del done[:]
+        job = search.SearchJob('genus1', done.append)
+        job.cancel()
+        job.run_now()
+        self.assertEqual(done, [])
+
 
 class BinomialSearchTests(BaubleTestCase):
     def __init__(self, *args):
@@ -814,6 +996,71 @@ class BinomialSearchTests(BaubleTestCase):
         self.assertEqual(results, set([self.ic, sp5]))
 
 
+class ParseCacheTests(unittest.TestCase):
+
+    def test_normalize_query(self):
+        self.assertEqual(
+            search.normalize_query('  genus   where genus = "a  b" '),
+            'genus where genus = "a  b"')
+        self.assertEqual(search.normalize_query("\tfam=\t'x  y'"),
+                         "fam= 'x  y'")
+
+    def test_cached_parse(self):
+        sp = search.SearchParser(cache=search.ParseCache(size=2))
+        first = sp.parse_string('genus where genus=Laelia')
+        self.assertEqual(sp.cache.stats()['misses'], 1)
+        again = sp.parse_string(' genus  where genus=Laelia')
+        self.assertTrue(again is first)
+        self.assertEqual(sp.cache.stats()['hits'], 1)
+
+    def test_least_recently_used_dropped(self):
+        cache = search.ParseCache(size=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a']
+        cache['c'] = 3
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats(),
+                         {'hits': 1, 'misses': 0, 'size': 2, 'max_size': 2})
+
+    def test_concurrent_access(self):
+        import threading
+        cache = search.ParseCache(size=2)
+        errors = []
+
+        def use_cache(n):
+            try:
+                for i in range(500):
+                    cache['%s' % (i % 5)] = i
+                    try:
+                        cache['%s' % ((i + n) % 5)]
+                    except KeyError:
+                        pass
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=use_cache, args=(n, ))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache), 2)
+
+    def test_now_not_frozen(self):
+        import time
+        sp = search.SearchParser(cache=search.ParseCache())
+        results = sp.parse_string('plant where _last_updated < |now||')
+        token = results.statement.content.filter.operands[1]
+        first = token.express()
+        time.sleep(0.01)
+        again = sp.parse_string('plant where _last_updated < |now||')
+        self.assertTrue(again is results)
+        self.assertTrue(token.express() > first)
+
+
 class QueryBuilderTests(BaubleTestCase):
 
     def test_cancreatequerybuilder(self):
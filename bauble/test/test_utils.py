@@ -31,3 +31,21 @@ class Utils(BaubleTestCase):
 
     def test_topological_sort_loop(self):
         self.assertEqual(utils.topological_sort([1,2], [(2,1), (1,2)]), None)
+
+    def test_natsort_string(self):
+        values = [u'2.10', u'10.1', u'2.9', u'2.1a', u'1']
+        self.assertEqual(
+            sorted(values, key=utils.natsort_string),
+            sorted(values, key=utils.natsort_key))
+        self.assertEqual(utils.natsort_string(u'a2.50b', width=3),
+                         u'a\x01002.5\x01b')
+
+    def test_natsort_string_punctuation(self):
+        # the punctuation sorts by code point in both keys, it must not
+        # be compared against the digits of the padded numbers
+        values = [u'1 ) ', u'1.0(.2', u'1B(/-', u'9-', u'.B.', u'a',
+                  u'A-2', u'A 10', u'A-10', u'A2', u'A2.5', u'A2b', u'A',
+                  u'(A) 3', u'A/3', u'007', u'2008.1', u'2008.10.3', u'']
+        self.assertEqual(
+            sorted(values, key=utils.natsort_string),
+            sorted(values, key=utils.natsort_key))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Mario Frasca <mario@anche.no>.
+#
+# This file is part of bauble.classic.
+#
+# bauble.classic is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# bauble.classic is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bauble.classic. If not, see <http://www.gnu.org/licenses/>.
+#
+# test_view.py
+#
+import bauble.db as db
+import bauble.search as search
+from bauble.test import BaubleTestCase
+from bauble.view import ResultsModel, SearchView, PanelJob, Note
+
+
+class ResultsModelTests(BaubleTestCase):
+
+    def setUp(self):
+        super(ResultsModelTests, self).setUp()
+        from bauble.plugins.plants.family import Family
+        from bauble.plugins.plants.genus import Genus
+        self.Genus = Genus
+        self.family = Family(family=u'family1')
+        self.genera = [Genus(family=self.family, genus=u'genus%02d' % i)
+                       for i in range(10)]
+        self.session.add_all([self.family] + self.genera)
+        self.session.commit()
+        cursor = search.search_cursor('genus0', self.session, page_size=3)
+        self.model = ResultsModel(cursor, self.session,
+                                  lambda cls: cls is Family)
+        self.model.max_windows = 2
+
+    def test_rows_fetched_in_windows(self):
+        model = self.model
+        self.assertEqual(model.iter_n_children(None), 10)
+        self.assertEqual(model._objects, {})
+        # the class is known without fetching
+        self.assertFalse(model.iter_has_child(model.get_iter((9, ))))
+        self.assertEqual(model._objects, {})
+
+        self.assertEqual(model[(4, )][0], self.genera[4])
+        self.assertEqual(len(model._objects), 3)
+        model[(0, )][0]
+        model[(9, )][0]
+        # the first window was released
+        self.assertEqual(len(model._objects), 4)
+        self.assertFalse((self.Genus, self.genera[4].id) in model._objects)
+        self.assertEqual(model[(4, )][0], self.genera[4])
+        self.assertEqual([row[0] for row in model], self.genera)
+
+    def test_children(self):
+        model = self.model
+        model.append(None, [self.family])
+        family_iter = model.get_iter((10, ))
+        self.assertTrue(model.iter_has_child(family_iter))
+        model.set_children(family_iter, self.genera[:2])
+        self.assertEqual(model.iter_n_children(family_iter), 2)
+        self.assertEqual(model[(10, 1)][0], self.genera[1])
+        # find only looks at the fetched rows
+        self.assertEqual(len(model.find(self.genera[1])), 1)
+        model[(1, )][0]
+        self.assertEqual(len(model.find(self.genera[1])), 2)
+
+        model.remove(model.get_iter((0, )))
+        self.assertEqual(model.iter_n_children(None), 10)
+        self.assertEqual(model[(9, 0)][0], self.genera[0])
+        self.assertEqual(len(model.find(self.genera[0])), 1)
+
+    def test_remove_before_fetching(self):
+        model = self.model
+        model[(0, )][0]
+        model.remove(model.get_iter((1, )))
+        model.remove(model.get_iter((4, )))
+        model.append(None, [self.family])
+        self.assertEqual(model.get_class((4, )), self.Genus)
+        # the rows not fetched yet are read at their offset in the cursor
+        expected = self.genera[:1] + self.genera[2:5] + self.genera[6:]
+        self.assertEqual([row[0] for row in model], expected + [self.family])
+
+    def test_changes_release_objects(self):
+        model = self.model
+        model[(0, )][0]
+        model[(9, )][0]
+        model.remove(model.get_iter((5, )))
+        self.assertEqual(model._objects, {})
+        self.assertEqual(model._counts, {})
+        self.assertEqual(len(model._windows), 0)
+
+    def test_children_counted(self):
+        from bauble.plugins.plants.family import Family
+        empty = Family(family=u'family2')
+        self.session.add(empty)
+        self.session.commit()
+        meta = SearchView.ViewMeta.Meta()
+        meta.set(children='genera', children_count='genera')
+        counts = meta.count_children(Family, self.session,
+                                     [self.family.id, empty.id])
+        self.assertEqual(counts, {self.family.id: 10})
+
+        cursor = search.search_cursor(u'fam like family%', self.session)
+        model = ResultsModel(cursor, self.session, lambda cls: True,
+                             lambda cls, session, ids:
+                             meta.count_children(cls, session, ids))
+        # until fetched the class decides
+        self.assertTrue(model.iter_has_child(model.get_iter((1, ))))
+        self.assertEqual([row[0] for row in model], [self.family, empty])
+        self.assertTrue(model.iter_has_child(model.get_iter((0, ))))
+        self.assertFalse(model.iter_has_child(model.get_iter((1, ))))
+
+
+class PanelJobTests(BaubleTestCase):
+
+    def test_panel_job(self):
+        from bauble.plugins.plants.family import Family, FamilyNote
+        family = Family(family=u'family1')
+        family.notes.append(FamilyNote(note=u'a note', category=u'test'))
+        self.session.add(family)
+        self.session.commit()
+        key = (Family, family.id)
+        done = []
+        job = PanelJob([key], {Note: {'fields_used': ['category', 'note']}},
+                       done.append)
+        job.run_now()
+        self.assertEqual(done, [job])
+        self.assertEqual(job.pages, {key: {Note: [[u'test', u'a note']]}})
+        # the statistics of the infobox are cached
+        self.assertTrue(family.id in db.statistics._values['family'])
@@ -772,6 +772,34 @@ def natsort_key(obj):
     return (chunks, item)
 
 
+def natsort_string(text, width=12):
+    """
+    Return a string that sorts like natsort_key(text) when compared as
+    a plain string, by code point.
+
+    natsort_key splits text in alternating text and number chunks and
+    compares them in turn.  here the numbers lose their leading zeros
+    and the trailing zeros of their fraction, their integer part gets
+    padded with zeros to width digits, and the chunks are joined by
+    u'\\x01', which sorts before any printable character so that a
+    shorter chunk sorts first, as it does in a list.  the result is
+    meant to be stored in the database, which can then order by it.
+
+    the order differs from natsort_key only for integers longer than
+    width digits and for text containing u'\\x00' or u'\\x01'.  the
+    database must compare the strings by code point: on PostgreSQL the
+    `_sort_key` columns use the "C" collation, see
+    :func:`bauble.db.collate_sort_keys`.
+    """
+    chunks = __natsort_rx.split(text)
+    for ii in range(1, len(chunks), 2):
+        integer, dot, fraction = chunks[ii].partition('.')
+        fraction = fraction.rstrip('0')
+        chunks[ii] = (integer.lstrip('0') or '0').zfill(width) + \
+            (fraction and '.' + fraction)
+    return u'\x01'.join(chunks)
+
+
 def delete_or_expunge(obj):
     """
     If the object is in object_session(obj).new then expunge it from the
@@ -792,12 +820,13 @@ def delete_or_expunge(obj):
 
 def reset_sequence(column):
     """
-    If column.sequence is not None or the column is an Integer and
-    column.autoincrement is true then reset the sequence for the next
-    available value for the column...if the column doesn't have a
-    sequence then do nothing and return
+    If column.sequence is not None or the column is an Integer primary
+    key and column.autoincrement is true then reset the sequence for
+    the next available value for the column...if the column doesn't
+    have a sequence then do nothing and return
 
-    The SQL statements are executed directly from db.engine
+    The SQL statements are executed directly from db.engine, the table
+    is locked while its maximum is read and the sequence set.
 
     This function only works for PostgreSQL database.  It does nothing
     for other database engines.
@@ -812,7 +841,8 @@ def reset_sequence(column):
     if hasattr(column, 'default') and \
             isinstance(column.default, schema.Sequence):
         sequence_name = column.default.name
-    elif (isinstance(column.type, Integer) and column.autoincrement) and \
+    elif (isinstance(column.type, Integer) and column.autoincrement and
+          column.primary_key) and \
             (column.default is None or
              (isinstance(column.default, schema.Sequence) and
               column.default.optional)) and \
@@ -823,21 +853,15 @@ def reset_sequence(column):
     conn = db.engine.connect()
     trans = conn.begin()
     try:
-        # the FOR UPDATE locks the table for the transaction
-        stmt = "SELECT %s from %s FOR UPDATE;" % (
-            column.name, column.table.name)
-        result = conn.execute(stmt)
-        maxid = None
-        vals = list(result)
-        if vals:
-            maxid = max(vals, key=lambda x: x[0])[0]
-        result.close()
+        # the lock keeps the maximum valid until the sequence is set
+        conn.execute("LOCK TABLE %s IN EXCLUSIVE MODE;" % column.table.name)
+        stmt = "SELECT max(%s) FROM %s;" % (column.name, column.table.name)
+        maxid = conn.execute(stmt).scalar()
         if maxid is None:
             # set the sequence to nextval()
             stmt = "SELECT nextval('%s');" % (sequence_name)
         else:
-            stmt = "SELECT setval('%s', max(%s)+1) from %s;" \
-                % (sequence_name, column.name, column.table.name)
+            stmt = "SELECT setval('%s', %d);" % (sequence_name, maxid + 1)
         conn.execute(stmt)
     except Exception, e:
         logger.warning('bauble.utils.reset_sequence(): %s' % utf8(e))
@@ -20,9 +20,11 @@
 #
 # Description: the default view
 #
+import collections
 import itertools
 import os
 import sys
+import threading
 import traceback
 import cgi
 
@@ -36,7 +38,8 @@ import pango
 
 from bauble.i18n import _
 from pyparsing import ParseException
-from sqlalchemy.orm import object_session
+from sqlalchemy import func
+from sqlalchemy.orm import class_mapper, object_session
 import sqlalchemy.exc as saexc
 
 import bauble
@@ -357,6 +360,438 @@ class LinksExpander(InfoExpander):
             self.dynamic_box.show_all()
 
 
+class ResultsModel(gtk.GenericTreeModel):
+    """
+    The tree model of the SearchView results, on a
+    :class:`bauble.search.ResultCursor`.
+
+    The model holds the (class, id) keys of its rows, not the objects.
+    The objects are fetched in windows of window_size rows when the
+    view asks for the value of a row, and only the objects of the last
+    max_windows windows are referenced by the model, the others are
+    released and, not being referenced, they drop off the session.
+
+    The rows are identified by their paths, the children of a row are
+    set with :meth:`set_children` when the row gets expanded.
+
+    :param cursor: the ResultCursor on the results
+    :param session: the session of the results
+    :param has_children: a function of a class returning whether its
+        objects can have children
+    :param count_children: a function of the form
+        C{count_children(cls, session, ids)} returning a dict from the
+        ids of objects of class cls to their number of children, or None
+        if it can't count the children of cls.  the children are counted
+        for a whole window at once, the rows without children don't get
+        an expander.
+    """
+
+    max_windows = 8
+    max_refs = 10000
+
+    def __init__(self, cursor, session, has_children, count_children=None):
+        super(ResultsModel, self).__init__()
+        self.props.leak_references = False
+        self.cursor = cursor
+        self.session = session
+        self.has_children = has_children
+        self.count_children = count_children
+        self.window_size = cursor.page_size
+        # the keys of the top level rows, None until fetched
+        self._keys = [None] * len(cursor)
+        # the offsets in the cursor of the top level rows, they differ
+        # from the row indexes once rows are removed, None for the
+        # appended rows
+        self._offsets = range(len(cursor))
+        # path of a parent row -> keys of its children
+        self._children = {}
+        self._objects = {}
+        self._pinned = {}
+        # key -> number of children, for the rows of the loaded windows
+        self._counts = {}
+        # (parent path, window number) -> keys, oldest first
+        self._windows = collections.OrderedDict()
+        # the path tuples handed out as row references, these must
+        # outlive the gtk.TreeIters, see leak_references
+        self._refs = collections.OrderedDict()
+        # bumped when the paths change, see _toggle
+        self._stamp = 0
+
+    def _ref(self, path):
+        path = tuple(path)
+        ref = self._refs.pop(path, path)
+        self._refs[ref] = ref
+        if len(self._refs) > self.max_refs:
+            self._refs.popitem(last=False)
+        return ref
+
+    def _keys_of(self, parent):
+        if not parent:
+            return self._keys
+        return self._children.get(parent, [])
+
+    def _valid(self, path):
+        return path and 0 <= path[-1] < len(self._keys_of(path[:-1]))
+
+    def _load_window(self, parent, number):
+        keys = self._keys_of(parent)
+        start = number * self.window_size
+        stop = min(start + self.window_size, len(keys))
+        # only top level rows are ever missing, the children are set
+        # with their keys
+        missing = [index for index in range(start, stop)
+                   if keys[index] is None]
+        objects = []
+        if missing:
+            first = self._offsets[missing[0]]
+            fetched = self.cursor.fetch(first,
+                                        self._offsets[missing[-1]] + 1)
+            for index in missing:
+                at = self._offsets[index] - first
+                if at < len(fetched):
+                    keys[index] = (type(fetched[at]), fetched[at].id)
+                    objects.append(fetched[at])
+        known = [key for index, key in enumerate(keys[start:stop], start)
+                 if key is not None and index not in missing]
+        objects.extend(search.hydrate(self.session, known))
+        for obj in objects:
+            self._objects[(type(obj), obj.id)] = obj
+        self._windows.pop((parent, number), None)
+        self._windows[(parent, number)] = keys[start:stop]
+        while len(self._windows) > self.max_windows:
+            window, old_keys = self._windows.popitem(last=False)
+            for key in old_keys:
+                self._objects.pop(key, None)
+                self._counts.pop(key, None)
+        self._count(parent, start, keys[start:stop])
+
+    def _count(self, parent, start, keys, notify=True):
+        """
+        Count the children of the rows with keys, from index start under
+        parent, with one count_children call per class.
+
+        if notify is True the view is told about the rows whose
+        expander has to change, in an idle callback since the view is
+        usually drawing when the rows get fetched.
+        """
+        if self.count_children is None:
+            return
+        paths = [parent + (start + index, ) for index in range(len(keys))]
+        before = notify and [self.on_iter_has_child(p) for p in paths]
+        ids = {}
+        for key in keys:
+            if key is not None and key not in self._counts:
+                ids.setdefault(key[0], []).append(key[1])
+        for cls, cls_ids in ids.iteritems():
+            counts = self.count_children(cls, self.session, cls_ids)
+            if counts is None:
+                continue
+            for obj_id in cls_ids:
+                self._counts[(cls, obj_id)] = counts.get(obj_id, 0)
+        if not notify:
+            return
+        toggled = [p for p, had in zip(paths, before)
+                   if self.on_iter_has_child(p) != had]
+        if toggled:
+            gobject.idle_add(self._toggle, self._stamp, toggled)
+
+    def _toggle(self, stamp, paths):
+        if stamp != self._stamp:
+            # rows were inserted or removed since, the paths are stale
+            return False
+        for path in paths:
+            if self._valid(path):
+                self.row_has_child_toggled(path, self.get_iter(path))
+        return False
+
+    def get_object(self, path):
+        """
+        Return the object at path, fetching its window if needed, None
+        if the object does not exist any more.
+        """
+        parent, index = tuple(path[:-1]), path[-1]
+        key = self._keys_of(parent)[index]
+        if key in self._pinned:
+            return self._pinned[key]
+        if key is None or key not in self._objects:
+            self._load_window(parent, index // self.window_size)
+            key = self._keys_of(parent)[index]
+        return self._objects.get(key)
+
+    def get_key(self, path):
+        """
+        Return the (class, id) key of the row at path, None if the row
+        wasn't fetched yet.
+        """
+        parent, index = tuple(path[:-1]), path[-1]
+        keys = self._keys_of(parent)
+        if not 0 <= index < len(keys):
+            return None
+        return keys[index]
+
+    def get_class(self, path):
+        """
+        Return the class of the object at path, without fetching it
+        when the cursor knows.
+        """
+        parent, index = tuple(path[:-1]), path[-1]
+        key = self._keys_of(parent)[index]
+        if key is None:
+            cls = self.cursor.class_at(self._offsets[index])
+            if cls is not None:
+                return cls
+            return type(self.get_object(path))
+        return key[0]
+
+    def loaded_objects(self):
+        """
+        Return the objects currently referenced by the model.
+        """
+        return self._objects.values() + self._pinned.values()
+
+    def find(self, obj):
+        """
+        Return the gtk.TreeIters of the rows, among those fetched or
+        appended, holding obj.
+        """
+        key = (type(obj), obj.id)
+        paths = [(index, ) for index, k in enumerate(self._keys)
+                 if k == key]
+        for parent, keys in self._children.iteritems():
+            paths.extend(parent + (index, )
+                         for index, k in enumerate(keys) if k == key)
+        return [self.get_iter(path) for path in sorted(paths)]
+
+    def _shift(self, parent, index, delta):
+        """
+        Move the children of the rows after index under parent by delta
+        rows, when a row is inserted or removed.
+        """
+        depth = len(parent)
+        moved = {}
+        for path in self._children.keys():
+            if path[:depth] == parent and path[depth] >= index:
+                keys = self._children.pop(path)
+                if path[depth] == index and delta < 0:
+                    continue
+                moved[path[:depth] + (path[depth] + delta, ) +
+                      path[depth + 1:]] = keys
+        self._children.update(moved)
+
+    def _changed(self):
+        self._stamp += 1
+        self.invalidate_iters()
+        self._refs.clear()
+        # the windows are numbered by row index, which just changed
+        self.invalidate()
+
+    def append(self, parent, row):
+        """
+        Append row, a list holding one object, to the children of the
+        parent gtk.TreeIter, at the top level if parent is None.
+
+        this is the gtk.TreeStore API used by select_in_search_results,
+        the placeholder strings of gtk.TreeStore models are ignored.
+        """
+        obj = row[0]
+        if isinstance(obj, basestring):
+            return None
+        parent_path = parent and self.get_path(parent) or ()
+        key = (type(obj), obj.id)
+        self._pinned[key] = obj
+        if parent_path:
+            keys = self._children.setdefault(parent_path, [])
+        else:
+            keys = self._keys
+            self._offsets.append(None)
+        keys.append(key)
+        self._changed()
+        path = parent_path + (len(keys) - 1, )
+        treeiter = self.get_iter(path)
+        self.row_inserted(path, treeiter)
+        return treeiter
+
+    def remove(self, treeiter):
+        """
+        Remove the row at treeiter and its children.
+        """
+        path = self.get_path(treeiter)
+        parent, index = path[:-1], path[-1]
+        self._keys_of(parent).pop(index)
+        if not parent:
+            self._offsets.pop(index)
+        self._shift(parent, index, -1)
+        self._changed()
+        self.row_deleted(path)
+
+    def set_children(self, treeiter, objects):
+        """
+        Replace the children of the row at treeiter with objects.
+        """
+        path = self.get_path(treeiter)
+        old = self._children.pop(path, [])
+        for descendant in self._children.keys():
+            if descendant[:len(path)] == path:
+                del self._children[descendant]
+        self._changed()
+        for index in reversed(range(len(old))):
+            self.row_deleted(path + (index, ))
+        keys = [(type(obj), obj.id) for obj in objects]
+        for obj in objects:
+            self._objects[(type(obj), obj.id)] = obj
+        self._children[path] = keys
+        for number in range((len(keys) + self.window_size - 1) //
+                            self.window_size):
+            start = number * self.window_size
+            self._windows[(path, number)] = keys[start:start +
+                                                 self.window_size]
+        # the rows are not in the view yet, it asks when inserting them
+        self._count(path, 0, keys, notify=False)
+        for index in range(len(keys)):
+            child = path + (index, )
+            self.row_inserted(child, self.get_iter(child))
+
+    def invalidate(self):
+        """
+        Release all the fetched objects, they get fetched again when
+        the view asks for them.
+        """
+        self._objects.clear()
+        self._windows.clear()
+        self._counts.clear()
+
+    # gtk.GenericTreeModel interface
+
+    def on_get_flags(self):
+        return 0
+
+    def on_get_n_columns(self):
+        return 1
+
+    def on_get_column_type(self, index):
+        return gobject.TYPE_PYOBJECT
+
+    def on_get_iter(self, path):
+        path = tuple(path)
+        if not self._valid(path):
+            return None
+        return self._ref(path)
+
+    def on_get_path(self, rowref):
+        return rowref
+
+    def on_get_value(self, rowref, column):
+        return self.get_object(rowref)
+
+    def on_iter_next(self, rowref):
+        path = rowref[:-1] + (rowref[-1] + 1, )
+        if not self._valid(path):
+            return None
+        return self._ref(path)
+
+    def on_iter_children(self, rowref):
+        return self.on_iter_nth_child(rowref, 0)
+
+    def on_iter_has_child(self, rowref):
+        if self._children.get(rowref):
+            return True
+        key = self._keys_of(rowref[:-1])[rowref[-1]]
+        if key in self._counts:
+            return self._counts[key] > 0
+        return self.has_children(self.get_class(rowref))
+
+    def on_iter_n_children(self, rowref):
+        return len(self._keys_of(rowref or ()))
+
+    def on_iter_nth_child(self, rowref, n):
+        path = (rowref or ()) + (n, )
+        if not self._valid(path):
+            return None
+        return self._ref(path)
+
+    def on_iter_parent(self, rowref):
+        if len(rowref) < 2:
+            return None
+        return self._ref(rowref[:-1])
+
+
+def attached_rows(obj, bottom_info):
+    """
+    Return a dict from the classes in bottom_info to the rows of their
+    bottom notebook page for obj, the values of the fields_used of the
+    objects attached to obj.
+    """
+    pages = {}
+    for klass, info in bottom_info.items():
+        if not hasattr(klass, 'attached_to'):
+            logger.warn('class %s does not implement attached_to' % klass)
+            continue
+        pages[klass] = [[getattr(attached, k) for k in info['fields_used']]
+                        for attached in klass.attached_to(obj)]
+    return pages
+
+
+class PanelJob(threading.Thread):
+    """
+    Fetch what the infobox and the bottom notebook show for the objects
+    with the (class, id) keys, in a session of its own.
+
+    the statistics of the objects end up in :data:`bauble.db.statistics`,
+    the rows of the bottom notebook pages in the pages dict, by key.
+    the callback is called with the job on the main loop when done.
+    """
+
+    def __init__(self, keys, bottom_info, callback):
+        super(PanelJob, self).__init__()
+        self.daemon = True
+        self.keys = keys
+        self.bottom_info = dict(bottom_info)
+        self.callback = callback
+        self.pages = {}
+        self.cancelled = False
+
+    def _fetch(self):
+        session = db.Session()
+        try:
+            for cls, obj_id in self.keys:
+                if self.cancelled:
+                    return
+                name = getattr(cls, '__tablename__', None)
+                if name in db.statistics:
+                    db.statistics.get(name, obj_id)
+                obj = session.query(cls).get(obj_id)
+                if obj is not None:
+                    self.pages[(cls, obj_id)] = attached_rows(
+                        obj, self.bottom_info)
+        finally:
+            session.close()
+
+    def run_now(self):
+        """
+        Fetch in the calling thread and call the callback.
+        """
+        try:
+            self._fetch()
+        except Exception, e:
+            logger.debug('PanelJob: %s' % utils.utf8(e))
+            logger.debug(traceback.format_exc())
+        self.callback(self)
+
+    def run(self):
+        try:
+            self._fetch()
+        except Exception, e:
+            logger.debug('PanelJob: %s' % utils.utf8(e))
+            logger.debug(traceback.format_exc())
+        gobject.idle_add(self.callback, self)
+
+    def cancel(self):
+        """
+        Stop before the next key, the callback is still called.
+        """
+        self.cancelled = True
+
+
 class SearchView(pluginmgr.View):
     """
     The SearchView is the main view for Bauble.  It manages the search
@@ -371,18 +806,28 @@ class SearchView(pluginmgr.View):
         :class:`bauble.view.SearchView`'s row_meta property.
         """
         class Meta(object):
+            # ids per grouped query in count_children
+            chunk_size = 500
+
             def __init__(self):
                 self.children = None
+                self.children_count = None
                 self.infobox = None
                 self.markup_func = None
                 self.actions = []
 
             def set(self, children=None, infobox=None, context_menu=None,
-                    markup_func=None):
+                    markup_func=None, children_count=None):
                 '''
                 :param children: where to find the children for this type,
                     can be a callable of the form C{children(row)}
 
+                :param children_count: how to count the children of many
+                    rows of this type at once, the name of the one to many
+                    relation holding the children or a callable of the
+                    form C{children_count(session, ids)} returning a dict
+                    from id to number of children
+
                 :param infobox: the infobox for this type
 
                 :param context_menu: a dict describing the context menu used
@@ -395,6 +840,7 @@ class SearchView(pluginmgr.View):
                 non markup characters
                 '''
                 self.children = children
+                self.children_count = children_count
                 self.infobox = infobox
                 self.markup_func = markup_func
                 self.context_menu = context_menu
@@ -416,6 +862,31 @@ class SearchView(pluginmgr.View):
                     return self.children(obj)
                 return getattr(obj, self.children)
 
+            def count_children(self, cls, session, ids):
+                '''
+                Return a dict from the ids of the objects of class cls to
+                their number of children, with one grouped query per
+                chunk of ids, the ids without children are missing.
+
+                Returns None if self.children_count is not set.
+                '''
+                if self.children_count is None:
+                    return None
+                counts = {}
+                ids = list(ids)
+                for start in range(0, len(ids), self.chunk_size):
+                    chunk = ids[start:start + self.chunk_size]
+                    if callable(self.children_count):
+                        counts.update(self.children_count(session, chunk))
+                        continue
+                    prop = class_mapper(cls).get_property(
+                        self.children_count)
+                    (local, remote), = prop.local_remote_pairs
+                    query = session.query(remote, func.count(remote)).\
+                        filter(remote.in_(chunk)).group_by(remote)
+                    counts.update(query)
+                return counts
+
         def __getitem__(self, item):
             if item not in self:  # create on demand
                 self[item] = self.Meta()
@@ -453,6 +924,15 @@ class SearchView(pluginmgr.View):
         # keep all the search results in the same session, this should
         # be cleared when we do a new search
         self.session = db.Session()
+        # the search running on a worker thread, if any
+        self.search_job = None
+        # the pending debounced update of the panels and the job
+        # fetching their contents, see on_cursor_changed
+        self.panel_timeout = None
+        self.panel_job = None
+        # (class, id) -> rows of the bottom notebook pages, for the
+        # selected row and its neighbours
+        self.panel_cache = collections.OrderedDict()
         self.add_notes_page_to_bottom_notebook()
 
     def add_notes_page_to_bottom_notebook(self):
@@ -493,7 +973,7 @@ class SearchView(pluginmgr.View):
         bottom_info['tree'] = page.get_children()[0]
         bottom_info['label'] = label
 
-    def update_bottom_notebook(self):
+    def update_bottom_notebook(self, pages=None):
         """
         Update the bottom_notebook from the currently selected row.
 
@@ -505,36 +985,40 @@ class SearchView(pluginmgr.View):
         this should have a model, and the ordered names of the fields to
         be stored in the model is in bottom_info['fields_used'].
 
+        :param pages: the rows of the pages for the selected row, as
+            returned by attached_rows, if None they are queried now and
+            the prefetched pages are dropped.
         """
         values = self.get_selected_values()
         ## Only one should be selected
-        if len(values) != 1:
+        if not values or len(values) != 1:
             self.view.widget_set_visible('bottom_notebook', False)
             return
 
         self.view.widget_set_visible('bottom_notebook', True)
         row = values[0]  # the selected row
+        if pages is None:
+            self.panel_cache.clear()
+            pages = attached_rows(row, self.bottom_info)
 
         ## loop over bottom_info plugin classes (eg: Tag)
         for klass, bottom_info in self.bottom_info.items():
             if 'label' not in bottom_info:  # late initialization
                 self.add_page_to_bottom_notebook(bottom_info)
             label = bottom_info['label']
-            if not hasattr(klass, 'attached_to'):
-                logging.warn('class %s does not implement attached_to' % klass)
+            if klass not in pages:
                 continue
-            objs = klass.attached_to(row)
+            rows = pages[klass]
             model = bottom_info['tree'].get_model()
             model.clear()
-            if len(objs) == 0:
+            if len(rows) == 0:
                 label.set_use_markup(False)
                 label.set_label(bottom_info['name'])
             else:
                 label.set_use_markup(True)
                 label.set_label('<b>%s</b>' % bottom_info['name'])
-                for obj in objs:
-                    model.append([getattr(obj, k)
-                                  for k in bottom_info['fields_used']])
+                for row_values in rows:
+                    model.append(row_values)
 
     def update_infobox(self):
         '''
@@ -621,11 +1105,8 @@ class SearchView(pluginmgr.View):
         Update the infobox and switch the accelerators depending on the
         type of the row that the cursor points to.
         '''
-        ## update all forward-looking info boxes
-        self.update_infobox()
-        ## update all backward-looking info boxes
-        self.update_bottom_notebook()
-        pictures_view.floating_window.set_selection(self.get_selected_values())
+        ## the info boxes get updated when the cursor stops
+        self.schedule_panel_update()
 
         for accel, cb in self.installed_accels:
             # disconnect previously installed accelerators by the key
@@ -668,85 +1149,253 @@ class SearchView(pluginmgr.View):
                 logger.warning(
                     'Could not parse accelerator: %s' % (action.accelerator))
 
+    ## milliseconds the cursor has to rest before the panels get updated
+    panel_delay = 150
+    ## the rows on each side of the cursor whose panels are prefetched
+    prefetch_rows = 2
+    ## the number of rows whose bottom notebook pages are kept
+    panel_cache_size = 50
+
+    def schedule_panel_update(self):
+        """
+        Update the infobox, the bottom notebook and the pictures once
+        the cursor rests for panel_delay milliseconds, so that scrolling
+        through the results doesn't query the panels of every row.
+        """
+        if self.panel_timeout is not None:
+            gobject.source_remove(self.panel_timeout)
+        self.panel_timeout = gobject.timeout_add(self.panel_delay,
+                                                 self.on_panel_timeout)
+
+    def get_row_key(self, model, path):
+        """
+        Return the (class, id) key of the row at path, None if the row
+        doesn't hold a database object or wasn't fetched yet.
+        """
+        if isinstance(model, ResultsModel):
+            return model.get_key(path)
+        try:
+            obj = model[path][0]
+        except (IndexError, ValueError):
+            return None
+        if not isinstance(obj, db.Base):
+            return None
+        return (type(obj), obj.id)
+
+    def on_panel_timeout(self):
+        """
+        Show the panels of the selected row, from the prefetched values
+        if ready, otherwise when a PanelJob has fetched them.  a job
+        also prefetches the panels of the rows next to the cursor.
+        """
+        self.panel_timeout = None
+        if self.panel_job is not None:
+            self.panel_job.cancel()
+            self.panel_job = None
+        values = self.get_selected_values()
+        model = self.results_view.get_model()
+        cursor = self.results_view.get_cursor()[0]
+        key = None
+        if values and len(values) == 1 and cursor is not None:
+            key = self.get_row_key(model, cursor)
+        if key is None:
+            self.show_panels()
+            return False
+
+        keys = []
+        if key in self.panel_cache:
+            self.show_panels(self.panel_cache[key])
+        else:
+            keys.append(key)
+        parent, index = cursor[:-1], cursor[-1]
+        if parent:
+            nrows = model.iter_n_children(model.get_iter(parent))
+        else:
+            nrows = model.iter_n_children(None)
+        for delta in range(1, self.prefetch_rows + 1):
+            for neighbour in (index + delta, index - delta):
+                if not 0 <= neighbour < nrows:
+                    continue
+                other = self.get_row_key(model, parent + (neighbour, ))
+                if other is not None and other not in self.panel_cache:
+                    keys.append(other)
+        if not keys:
+            return False
+        job = PanelJob(keys, self.bottom_info, self.on_panel_job_done)
+        self.panel_job = job
+        if search.can_search_in_thread(db.engine):
+            job.start()
+        else:
+            job.run_now()
+        return False
+
+    def on_panel_job_done(self, job):
+        """
+        Store the pages fetched by job and show those of the selected
+        row if the job was fetching them.
+        """
+        if job is not self.panel_job:
+            return False
+        self.panel_job = None
+        for key, pages in job.pages.iteritems():
+            self.panel_cache.pop(key, None)
+            self.panel_cache[key] = pages
+        while len(self.panel_cache) > self.panel_cache_size:
+            self.panel_cache.popitem(last=False)
+        cursor = self.results_view.get_cursor()[0]
+        if cursor is None:
+            return False
+        key = self.get_row_key(self.results_view.get_model(), cursor)
+        if key == job.keys[0]:
+            # the pages are missing if the fetch failed
+            self.show_panels(job.pages.get(key))
+        return False
+
+    def show_panels(self, pages=None):
+        """
+        Update the infobox, the bottom notebook and the pictures from
+        the selected rows.
+
+        :param pages: passed on to update_bottom_notebook
+        """
+        self.update_infobox()
+        if pages is None:
+            self.update_bottom_notebook()
+        else:
+            self.update_bottom_notebook(pages)
+        pictures_view.floating_window.set_selection(self.get_selected_values())
+
     nresults_statusbar_context = 'searchview.nresults'
 
     def search(self, text):
         """
         search the database using text
+
+        the search runs on a worker thread, see on_search_done, a new
+        search cancels the one still running.
         """
         # set the text in the entry even though in most cases the entry already
         # has the same text in it, this is in case this method was called from
         # outside the class so the entry and search results match
         logger.debug('SearchView.search(%s)' % text)
+        if self.search_job is not None:
+            self.search_job.cancel()
+        job = search.SearchJob(text, self.on_search_done,
+                               self.results_page_size)
+        self.search_job = job
+        self.set_searching(True)
+        if search.can_search_in_thread(db.engine):
+            job.start()
+        else:
+            job.run_now()
+
+    def set_searching(self, searching):
+        """
+        Show in the statusbar whether a search is running.
+        """
+        statusbar = bauble.gui.widgets.statusbar
+        sbcontext_id = statusbar.get_context_id('searchview.nresults')
+        statusbar.pop(sbcontext_id)
+        if not searching:
+            bauble.gui.progressbar.set_fraction(0)
+            return
+        statusbar.push(sbcontext_id, _('Searching...'))
+
+        def pulse(job):
+            if job is not self.search_job:
+                return False
+            bauble.gui.progressbar.pulse()
+            return True
+        gobject.timeout_add(100, pulse, self.search_job)
+
+    def on_search_done(self, job):
+        """
+        Show the results of the search job, called on the main loop
+        when the job is done.
+        """
+        if job is not self.search_job:
+            job.session.close()
+            return
+        self.search_job = None
+        self.set_searching(False)
+        text = job.text
         error_msg = None
         error_details_msg = None
-        self.session.close()
-        # create a new session for each search...maybe we shouldn't
-        # even have session as a class attribute
-        self.session = db.Session()
         bold = '<b>%s</b>'
-        results = []
-        try:
-            results = search.search(text, self.session)
-        except ParseException, err:
+        err = job.error
+        if isinstance(err, ParseException):
             error_msg = _('Error in search string at column %s') % err.column
-        except (BaubleError, AttributeError, Exception, SyntaxError), e:
-            logger.debug(traceback.format_exc())
-            error_msg = _('** Error: %s') % utils.xml_safe(e)
-            error_details_msg = utils.xml_safe(traceback.format_exc())
+        elif err is not None:
+            logger.debug(job.traceback)
+            error_msg = _('** Error: %s') % utils.xml_safe(err)
+            error_details_msg = utils.xml_safe(job.traceback)
 
         if error_msg:
+            job.session.close()
             bauble.gui.show_error_box(error_msg, error_details_msg)
             return
 
-        # not error
-        utils.clear_model(self.results_view)
+        # not error, the results live in the session of the job
+        self.clear_results()
+        self.session.close()
+        self.session = job.session
+        self.panel_cache.clear()
+        results = job.cursor
+        nresults = job.count
         self.update_infobox()
         statusbar = bauble.gui.widgets.statusbar
         sbcontext_id = statusbar.get_context_id('searchview.nresults')
         statusbar.pop(sbcontext_id)
-        if len(results) == 0:
+        if nresults == 0:
             model = gtk.ListStore(str)
             msg = bold % cgi.escape(
                 _('Couldn\'t find anything for search: "%s"') % text)
             model.append([msg])
             self.results_view.set_model(model)
         else:
-            if len(results) > 5000:
-                msg = _('This query returned %s results.  It may take a '
-                        'long time to get all the data. Are you sure you '
-                        'want to continue?') % len(results)
-                if not utils.yes_no_dialog(msg):
-                    return
             statusbar.push(sbcontext_id, _("Retrieving %s search "
-                                           "results...") % len(results))
-            try:
-                # don't bother with a task if the results are small,
-                # this keeps the screen from flickering when the main
-                # window is set to a busy state
-                import time
-                start = time.time()
-                if len(results) > 1000:
-                    self.populate_results(results)
-                else:
-                    task = self._populate_worker(results)
-                    while True:
-                        try:
-                            task.next()
-                        except StopIteration:
-                            break
-                logger.debug(time.time() - start)
-            except StopIteration:
-                return
-            else:
-                statusbar.pop(sbcontext_id)
-                statusbar.push(sbcontext_id,
-                               _("%s search results") % len(results))
-                self.results_view.set_cursor(0)
-                gobject.idle_add(lambda: self.results_view.scroll_to_cell(0))
+                                           "results...") % nresults)
+            import time
+            start = time.time()
+            # the rows are only fetched when they get shown
+            self.populate_cursor(results)
+            logger.debug(time.time() - start)
+            statusbar.pop(sbcontext_id)
+            statusbar.push(sbcontext_id,
+                           _("%s search results") % nresults)
+            self.results_view.set_cursor(0)
+            gobject.idle_add(lambda: self.results_view.scroll_to_cell(0))
 
         self.update_bottom_notebook()
 
+    results_page_size = 200
+
+    def clear_results(self):
+        """
+        Remove the results model from the view.
+        """
+        model = self.results_view.get_model()
+        if isinstance(model, ResultsModel):
+            # clear_model would fetch every row to clear it
+            self.results_view.set_model(None)
+        else:
+            utils.clear_model(self.results_view)
+
+    def populate_cursor(self, cursor):
+        """
+        Show the search results in cursor, in a ResultsModel.
+
+        :param cursor: a bauble.search.ResultCursor
+        """
+        has_children = lambda cls: self.row_meta[cls].children is not None
+        count_children = lambda cls, session, ids: \
+            self.row_meta[cls].count_children(cls, session, ids)
+        model = ResultsModel(cursor, self.session, has_children,
+                             count_children)
+        self.results_view.freeze_child_notify()
+        self.results_view.set_model(model)
+        self.results_view.thaw_child_notify()
+
     def remove_children(self, model, parent):
         """
         Remove all children of some parent in the model, reverse
@@ -765,15 +1414,17 @@ class SearchView(pluginmgr.View):
         model = view.get_model()
         row = model.get_value(treeiter, 0)
         view.collapse_row(path)
-        self.remove_children(model, treeiter)
+        if not isinstance(model, ResultsModel):
+            self.remove_children(model, treeiter)
         try:
             kids = self.row_meta[type(row)].get_children(row)
             if len(kids) == 0:
                 return True
+            self.load_children(kids)
         except saexc.InvalidRequestError, e:
             logger.debug(utils.utf8(e))
             model = self.results_view.get_model()
-            for found in utils.search_tree_model(model, row):
+            for found in self.find_in_results(model, row):
                 model.remove(found)
             return True
         except Exception, e:
@@ -781,9 +1432,50 @@ class SearchView(pluginmgr.View):
             logger.debug(traceback.format_exc())
             return True
         else:
-            self.append_children(model, treeiter, kids)
+            if isinstance(model, ResultsModel):
+                model.set_children(treeiter, kids)
+            else:
+                self.append_children(model, treeiter, kids)
             return False
 
+    def load_children(self, kids):
+        """
+        Load the relations shown by the rows of kids, the children of an
+        expanded row, in one query per class rather than one per row.
+        """
+        session = object_session(kids[0])
+        if session is None:
+            return
+        search.hydrate(session, [(type(kid), kid.id) for kid in kids])
+
+    def count_children(self, objects):
+        """
+        Return a dict from the (class, id) keys of objects to their
+        number of children, with one grouped query per class.  the
+        objects whose type has no children_count are missing.
+        """
+        by_class = {}
+        for obj in objects:
+            by_class.setdefault(type(obj), []).append(obj.id)
+        counts = {}
+        for cls, ids in by_class.iteritems():
+            found = self.row_meta[cls].count_children(cls, self.session,
+                                                      ids)
+            if found is None:
+                continue
+            for obj_id in ids:
+                counts[(cls, obj_id)] = found.get(obj_id, 0)
+        return counts
+
+    def find_in_results(self, model, obj):
+        """
+        Return the gtk.TreeIters of the rows of model holding obj.
+        """
+        if isinstance(model, ResultsModel):
+            # only look at the rows fetched so far
+            return model.find(obj)
+        return utils.search_tree_model(model, obj)
+
     def populate_results(self, results, check_for_kids=False):
         """
         Adds results to the search view in a task.
@@ -802,7 +1494,7 @@ class SearchView(pluginmgr.View):
         model = gtk.TreeStore(object)
         model.set_default_sort_func(lambda *args: -1)
         model.set_sort_column_id(-1, gtk.SORT_ASCENDING)
-        utils.clear_model(self.results_view)
+        self.clear_results()
 
         groups = []
 
@@ -812,7 +1504,7 @@ class SearchView(pluginmgr.View):
         for key, group in itertools.groupby(results, key=lambda x: type(x)):
             # return groups by type and natural sort each of the
             # groups by their strings
-            groups.append(sorted(group, key=utils.natsort_key, reverse=True))
+            groups.append(sorted(group, key=db.sort_key, reverse=True))
 
         # sort the groups by type so we more or less always get the
         # results by type in the same order
@@ -826,6 +1518,7 @@ class SearchView(pluginmgr.View):
         #for obj in itertools.islice(itertools.chain(*groups), 0,None, steps):
         #for obj in itertools.islice(itertools.chain(results), 0,None, steps):
 
+        counts = self.count_children(results)
         added = set()
         for obj in itertools.chain(*groups):
             if obj in added:  # only add unique object
@@ -834,7 +1527,11 @@ class SearchView(pluginmgr.View):
                 added.add(obj)
             parent = model.prepend(None, [obj])
             obj_type = type(obj)
-            if check_for_kids:
+            count = counts.get((obj_type, obj.id))
+            if count is not None:
+                if count > 0:
+                    model.prepend(parent, ['-'])
+            elif check_for_kids:
                 kids = self.row_meta[obj_type].get_children(obj)
                 if len(kids) > 0:
                     model.prepend(parent, ['-'])
@@ -861,22 +1558,35 @@ class SearchView(pluginmgr.View):
         @return: the model with the kids appended
         """
         check(parent is not None, "append_children(): need a parent")
+        counts = self.count_children(kids)
         for k in kids:
             i = model.append(parent, [k])
-            if self.row_meta[type(k)].children is not None:
+            count = counts.get((type(k), k.id))
+            if count is None:
+                has_kids = self.row_meta[type(k)].children is not None
+            else:
+                has_kids = count > 0
+            if has_kids:
                 model.append(i, ["_dummy"])
         return model
 
     def cell_data_func(self, col, cell, model, treeiter):
-        path = model.get_path(treeiter)
-        tree_rect = self.results_view.get_visible_rect()
-        cell_rect = self.results_view.get_cell_area(path, col)
-        if cell_rect.y > tree_rect.height:
-            # only update the cells if they're visible...this
-            # drastically speeds up populating the view with large
-            # datasets
-            return
+        if not isinstance(model, ResultsModel):
+            path = model.get_path(treeiter)
+            tree_rect = self.results_view.get_visible_rect()
+            cell_rect = self.results_view.get_cell_area(path, col)
+            if cell_rect.y > tree_rect.height:
+                # only update the cells if they're visible...this
+                # drastically speeds up populating the view with large
+                # datasets
+                return
+        # a ResultsModel only fetches the values of the rows the view
+        # asks for, which are those being drawn
         value = model[treeiter][0]
+        if value is None:
+            # deleted since the search
+            cell.set_property('markup', '')
+            return
         if isinstance(value, basestring):
             cell.set_property('markup', value)
         else:
@@ -916,7 +1626,7 @@ class SearchView(pluginmgr.View):
                 def remove():
                     model = self.results_view.get_model()
                     self.results_view.set_model(None)  # detach model
-                    for found in utils.search_tree_model(model, value):
+                    for found in self.find_in_results(model, value):
                         model.remove(found)
                     self.results_view.set_model(model)
                 gobject.idle_add(remove)
@@ -1031,6 +1741,7 @@ class SearchView(pluginmgr.View):
             pass
 
         self.session.expire_all()
+        self.panel_cache.clear()
 
         # the invalidate_str_cache() method are specific to Species
         # and Accession right now....it's a bit of a hack since there's
@@ -1040,7 +1751,13 @@ class SearchView(pluginmgr.View):
             obj = model[path][0]
             if hasattr(obj, 'invalidate_str_cache'):
                 obj.invalidate_str_cache()
-        model.foreach(invalidate_cache)
+        if isinstance(model, ResultsModel):
+            for obj in model.loaded_objects():
+                if hasattr(obj, 'invalidate_str_cache'):
+                    obj.invalidate_str_cache()
+            model.invalidate()
+        else:
+            model.foreach(invalidate_cache)
         expanded_rows = self.get_expanded_rows()
         self.results_view.collapse_all()
         # expand_to_all_refs will invalidate the ref so get the path first
@@ -1254,7 +1971,7 @@ def select_in_search_results(obj):
     if not isinstance(view, SearchView):
         return None
     model = view.results_view.get_model()
-    found = utils.search_tree_model(model, obj)
+    found = view.find_in_results(model, obj)
     row_iter = None
     if len(found) > 0:
         row_iter = found[0]
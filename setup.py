@@ -396,7 +396,8 @@ try:
 except ImportError:
     needs_sqlite = ["pysqlite>=2.3.2"]
 
-scripts = ["scripts/bauble", "scripts/bauble-admin"]
+scripts = ["scripts/bauble", "scripts/bauble-admin", "scripts/bauble-query",
+           "scripts/bauble-upgrade-schema"]
 if sys.platform == 'win32':
     scripts = ["scripts/bauble", "scripts/bauble.bat", "scripts/bauble.vbs",
                "scripts/bauble.lnk", "scripts/bauble-update.bat"]